@@ -0,0 +1,446 @@
+#!/usr/bin/env python3
+# ServerGuard controller benchmark.
+# Starts src/bot.py against a temp DB and a local fake Bot API server (no
+# network), drives /check-access and floods the UDP log port, then prints
+# a JSON report that can be diffed across commits with --compare.
+# --startup-runs N instead restarts the controller N times and reports how
+# long each phase of a cold start takes.
+import os
+import sys
+import json
+import time
+import random
+import socket
+import shutil
+import sqlite3
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+from aiohttp import web, ClientSession, TCPConnector
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC_DIR = os.path.join(ROOT, "src")
+BOT_TOKEN = "123456:BENCHMARK"
+ADMIN_KEY = "bench-admin-key"
+ADMIN_ID = 1
+COMMANDS = ("ls -la", "cd /var/log", "tail -f syslog", "systemctl status nginx",
+            "docker ps", "git pull", "vim /etc/hosts", "htop", "df -h", "rm -rf /tmp/build")
+
+
+def free_port(kind=socket.SOCK_STREAM):
+    with socket.socket(socket.AF_INET, kind) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(pct / 100 * (len(values) - 1)))))
+    return values[k]
+
+
+def rss_kb(pid):
+    out = {}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith(("VmRSS:", "VmHWM:")):
+                    key, value = line.split(":", 1)
+                    out[key] = int(value.split()[0])
+    except OSError:
+        pass
+    return {"rss": out.get("VmRSS"), "peak": out.get("VmHWM")}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+# --- Fake Telegram Bot API ---
+class FakeTelegram:
+    def __init__(self):
+        self.sent = 0
+        self.calls = {}
+        self.message_id = 0
+
+    def reply(self, result):
+        return web.json_response({"ok": True, "result": result})
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        data = await request.post()
+        if method == "getMe":
+            return self.reply({"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"})
+        if method == "getUpdates":
+            await asyncio.sleep(min(float(data.get("timeout") or 0), 1.0))
+            return self.reply([])
+        if method in ("sendMessage", "editMessageText"):
+            self.sent += 1
+            self.message_id += 1
+            return self.reply({"message_id": self.message_id, "date": int(time.time()),
+                               "chat": {"id": ADMIN_ID, "type": "private"}, "text": data.get("text", "")})
+        return self.reply(True)
+
+    def reset(self):
+        self.sent = 0
+        self.calls = {}
+
+    async def start(self, port):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", port).start()
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+# --- Fixture DB ---
+def seed_db(path, servers, approved_ips):
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE servers (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, ip TEXT UNIQUE, token TEXT, added_at INTEGER)")
+    conn.execute("CREATE TABLE approved_ips (ip TEXT PRIMARY KEY, expiry INTEGER)")
+    conn.execute("CREATE TABLE history (id INTEGER PRIMARY KEY AUTOINCREMENT, server_id INTEGER, ip TEXT, user TEXT, status TEXT, timestamp INTEGER)")
+    now = int(time.time())
+    tokens = ["local-token"] + [f"bench-token-{i:04d}" for i in range(servers - 1)]
+    conn.executemany("INSERT INTO servers (name, ip, token, added_at) VALUES (?, ?, ?, ?)",
+                     [(f"Bench {i}", f"10.255.{i // 250}.{i % 250}", t, now) for i, t in enumerate(tokens)])
+    conn.executemany("INSERT INTO approved_ips (ip, expiry) VALUES (?, ?)",
+                     [(ip, now + 86400) for ip in approved_ips])
+    conn.commit()
+    conn.close()
+    return tokens
+
+
+def count_rows(path, table):
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        return conn.execute(f"SELECT count(*) FROM {table}").fetchone()[0]
+    except sqlite3.OperationalError:
+        return 0
+    finally:
+        conn.close()
+
+
+# --- Load generators ---
+async def drive_check_access(port, tokens, ips, approved, args):
+    url = f"http://127.0.0.1:{port}/check-access"
+    latencies = []
+    statuses = {}
+    rng = random.Random(args.seed)
+    plan = []
+    for _ in range(args.requests):
+        token = rng.choice(tokens) if rng.random() < args.valid_token_ratio else f"bad-{rng.randint(0, 50)}"
+        ip = rng.choice(approved) if approved and rng.random() < args.allowed_ratio else rng.choice(ips)
+        plan.append((token, ip, rng.choice(("root", "deploy", "admin"))))
+    it = iter(plan)
+
+    async with ClientSession(connector=TCPConnector(limit=args.concurrency)) as session:
+        async def client():
+            for token, ip, user in it:
+                started = time.perf_counter()
+                async with session.get(url, params={"ip": ip, "user": user},
+                                       headers={"X-Guard-Token": token}) as resp:
+                    await resp.read()
+                latencies.append(time.perf_counter() - started)
+                statuses[resp.status] = statuses.get(resp.status, 0) + 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+
+    ms = [x * 1000 for x in latencies]
+    return {
+        "requests": len(latencies),
+        "seconds": round(elapsed, 3),
+        "rps": round(len(latencies) / elapsed, 1),
+        "latency_ms": {
+            "p50": round(percentile(ms, 50), 3),
+            "p95": round(percentile(ms, 95), 3),
+            "p99": round(percentile(ms, 99), 3),
+            "max": round(max(ms), 3),
+        },
+        "status": {str(k): v for k, v in sorted(statuses.items())},
+    }
+
+
+def logger_payload(token, user, ip, cmd):
+    # Same shape sg-logger emits (heredoc, two-space indent, trailing newline).
+    return ('{\n  "type": "cmd",\n  "token": "%s",\n  "user": "%s",\n  "ip": "%s",\n  "cmd": "%s"\n}\n'
+            % (token, user, ip, cmd))
+
+
+def flood_udp(port, tokens, args):
+    rng = random.Random(args.seed + 1)
+    per = args.records_per_datagram
+    datagrams = []
+    for _ in range(min(args.udp_datagrams, 4096)):
+        records = [logger_payload(rng.choice(tokens), "root", f"198.51.100.{rng.randint(1, 254)}",
+                                  rng.choice(COMMANDS)) for _ in range(per)]
+        body = records[0] if per == 1 else "[" + ",".join(records) + "]"
+        datagrams.append(body.encode())
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    target = ("127.0.0.1", port)
+    interval = 1 / args.udp_rate if args.udp_rate else 0
+    started = time.perf_counter()
+    sent = 0
+    for i in range(args.udp_datagrams):
+        sock.sendto(datagrams[i % len(datagrams)], target)
+        sent += 1
+        if interval and i % 100 == 99:
+            ahead = started + sent * interval - time.perf_counter()
+            if ahead > 0:
+                time.sleep(ahead)
+    elapsed = time.perf_counter() - started
+    sock.close()
+    return sent, sent * per, elapsed
+
+
+async def scrape_metrics(port, prefixes=("sg_udp_ingest_total", "sg_udp_kernel_drops", "sg_udp_receive_buffer",
+                                         "sg_check_access_total", "sg_telegram_total")):
+    # Controller-side counters from /metrics; empty if the endpoint is absent.
+    values = {}
+    try:
+        async with ClientSession() as session:
+            async with session.get(f"http://127.0.0.1:{port}/metrics",
+                                   headers={"X-Guard-Admin-Key": ADMIN_KEY}) as resp:
+                if resp.status != 200:
+                    return values
+                text = await resp.text()
+    except OSError:
+        return values
+    for line in text.splitlines():
+        if line.startswith(prefixes):
+            name, _, value = line.rpartition(" ")
+            values[name] = float(value)
+    return values
+
+
+async def settle(path, table, target, timeout):
+    # Wait for the controller's journals to stop growing the table.
+    last, stable_since = -1, time.monotonic()
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        count = count_rows(path, table)
+        if count >= target:
+            return count
+        if count != last:
+            last, stable_since = count, time.monotonic()
+        elif time.monotonic() - stable_since > 1.0:
+            return count
+        await asyncio.sleep(0.1)
+    return count_rows(path, table)
+
+
+# --- Controller process ---
+def start_controller(workdir, db_path, http_port, udp_port, tg_port, args):
+    env = dict(os.environ, TG_TOKEN=BOT_TOKEN, ADMIN_ID=str(ADMIN_ID), DB_PATH=db_path,
+               HTTP_PORT=str(http_port), UDP_PORT=str(udp_port),
+               TG_API_SERVER=f"http://127.0.0.1:{tg_port}", ADMIN_API_KEY=ADMIN_KEY,
+               PYTHONUNBUFFERED="1")
+    env.update(dict(kv.split("=", 1) for kv in args.env))
+    log = open(os.path.join(workdir, "controller.log"), "a")
+    proc = subprocess.Popen([sys.executable, "bot.py"], cwd=SRC_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+    return proc, log
+
+
+def stop_controller(proc, log):
+    proc.terminate()
+    try:
+        proc.wait(timeout=15)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+    log.close()
+
+
+async def startup_phases(port, proc, telegram, timeout=30):
+    # Seconds from spawn until: first /check-access answer, /readyz says 200
+    # (None if the endpoint does not exist) and the first getUpdates poll.
+    started = time.perf_counter()
+    phases = {"check_access": None, "ready": None, "telegram": None}
+    deadline = time.monotonic() + timeout
+    async with ClientSession() as session:
+        while None in phases.values() and time.monotonic() < deadline:
+            if proc.poll() is not None:
+                raise RuntimeError(f"Controller exited with {proc.returncode}")
+            elapsed = round(time.perf_counter() - started, 3)
+            try:
+                if phases["check_access"] is None:
+                    async with session.get(f"http://127.0.0.1:{port}/check-access",
+                                           params={"ip": "198.51.100.1", "user": "bench"}) as resp:
+                        await resp.read()
+                        phases["check_access"] = elapsed
+                if phases["ready"] is None:
+                    async with session.get(f"http://127.0.0.1:{port}/readyz") as resp:
+                        await resp.read()
+                        if resp.status == 200:
+                            phases["ready"] = elapsed
+                        elif resp.status == 404:
+                            phases["ready"] = phases["check_access"]
+            except OSError:
+                pass
+            if phases["telegram"] is None and telegram.calls.get("getUpdates"):
+                phases["telegram"] = elapsed
+            await asyncio.sleep(0.01)
+    return phases
+
+
+async def run_startup(args):
+    workdir = tempfile.mkdtemp(prefix="sg-bench-")
+    db_path = os.path.join(workdir, "guard.db")
+    ips = [f"100.64.{i // 256}.{i % 256}" for i in range(args.ips)]
+    seed_db(db_path, args.servers, ips[:max(1, int(len(ips) * args.approved_share))])
+    telegram = FakeTelegram()
+    tg_port = free_port()
+    await telegram.start(tg_port)
+    runs = []
+    report = {"commit": git_commit(), "timestamp": int(time.time()), "config": vars(args).copy()}
+    try:
+        for _ in range(args.startup_runs):
+            telegram.reset()
+            http_port, udp_port = free_port(), free_port(socket.SOCK_DGRAM)
+            proc, log = start_controller(workdir, db_path, http_port, udp_port, tg_port, args)
+            try:
+                phases = await startup_phases(http_port, proc, telegram)
+                phases["rss_kb"] = rss_kb(proc.pid)["rss"]
+                runs.append(phases)
+            finally:
+                stop_controller(proc, log)
+    finally:
+        await telegram.stop()
+        if args.keep:
+            report["workdir"] = workdir
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    report["startup"] = {}
+    for phase in ("check_access", "ready", "telegram", "rss_kb"):
+        values = [r[phase] for r in runs if r[phase] is not None]
+        report["startup"][phase] = {"p50": percentile(values, 50), "min": min(values, default=None),
+                                    "max": max(values, default=None)}
+    return report
+
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix="sg-bench-")
+    db_path = os.path.join(workdir, "guard.db")
+    rng = random.Random(args.seed)
+    ips = [f"203.0.113.{i % 250}" if i < 250 else f"100.{64 + i // 65536}.{(i // 256) % 256}.{i % 256}"
+           for i in range(args.ips)]
+    approved = rng.sample(ips, max(1, int(len(ips) * args.approved_share)))
+    tokens = seed_db(db_path, args.servers, approved)
+
+    tg_port, http_port, udp_port = free_port(), free_port(), free_port(socket.SOCK_DGRAM)
+    telegram = FakeTelegram()
+    await telegram.start(tg_port)
+
+    proc, log = start_controller(workdir, db_path, http_port, udp_port, tg_port, args)
+    report = {"commit": git_commit(), "timestamp": int(time.time()), "config": vars(args).copy()}
+    try:
+        # Load starts once Telegram is polling, so it measures steady state.
+        report["startup"] = await startup_phases(http_port, proc, telegram)
+        report["startup_seconds"] = report["startup"]["check_access"]
+        report["rss_kb_idle"] = rss_kb(proc.pid)
+
+        history_before = count_rows(db_path, "history")
+        report["check_access"] = await drive_check_access(http_port, tokens, ips, approved, args)
+        authorized = sum(v for k, v in report["check_access"]["status"].items() if k in ("200", "403"))
+        stored = await settle(db_path, "history", history_before + authorized, args.settle)
+        report["check_access"]["history_rows"] = stored - history_before
+
+        if args.udp_datagrams:
+            commands_before = count_rows(db_path, "commands")
+            loop = asyncio.get_running_loop()
+            sent, records, elapsed = await loop.run_in_executor(None, flood_udp, udp_port, tokens, args)
+            stored = await settle(db_path, "commands", commands_before + records, args.settle)
+            stored -= commands_before
+            report["udp"] = {
+                "datagrams": sent,
+                "records": records,
+                "send_seconds": round(elapsed, 3),
+                "send_rate": round(sent / elapsed, 1) if elapsed else None,
+                "records_stored": stored,
+                "records_dropped": records - stored,
+                "drop_ratio": round((records - stored) / records, 4) if records else 0,
+            }
+        report["rss_kb_loaded"] = rss_kb(proc.pid)
+        report["controller_metrics"] = await scrape_metrics(http_port)
+        report["telegram"] = {"messages": telegram.sent, "calls": telegram.calls}
+    finally:
+        stop_controller(proc, log)
+        await telegram.stop()
+        if args.keep:
+            report["workdir"] = workdir
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+
+# --- Comparison ---
+def flatten(data, prefix=""):
+    out = {}
+    for key, value in data.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            out.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            out[name] = value
+    return out
+
+
+def compare(old, new):
+    a, b = flatten({k: v for k, v in old.items() if k != "config"}), flatten({k: v for k, v in new.items() if k != "config"})
+    lines = [f"{'metric':<40} {old.get('commit') or 'old':>12} {new.get('commit') or 'new':>12} {'change':>9}"]
+    for key in sorted(set(a) & set(b)):
+        if key == "timestamp":
+            continue
+        change = f"{(b[key] - a[key]) / a[key] * 100:+.1f}%" if a[key] else "n/a"
+        lines.append(f"{key:<40} {a[key]:>12} {b[key]:>12} {change:>9}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ServerGuard controller benchmark")
+    parser.add_argument("--requests", type=int, default=20000, help="/check-access requests to send")
+    parser.add_argument("--concurrency", type=int, default=64, help="concurrent HTTP clients")
+    parser.add_argument("--servers", type=int, default=50, help="registered agent tokens")
+    parser.add_argument("--ips", type=int, default=2000, help="distinct source IPs")
+    parser.add_argument("--approved-share", type=float, default=0.2, help="share of IPs pre-approved")
+    parser.add_argument("--allowed-ratio", type=float, default=0.7, help="share of requests from approved IPs")
+    parser.add_argument("--valid-token-ratio", type=float, default=0.98, help="share of requests with a valid token")
+    parser.add_argument("--udp-datagrams", type=int, default=200000, help="UDP datagrams to send (0 disables)")
+    parser.add_argument("--udp-rate", type=float, default=0, help="datagrams per second (0 = as fast as possible)")
+    parser.add_argument("--records-per-datagram", type=int, default=1)
+    parser.add_argument("--settle", type=float, default=30, help="seconds to wait for writes to land")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="extra controller environment (repeatable)")
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--compare", help="previous JSON report to compare against")
+    parser.add_argument("--keep", action="store_true", help="keep the temp DB and controller log")
+    parser.add_argument("--startup-runs", type=int, default=0,
+                        help="only measure cold start, restarting the controller this many times")
+    args = parser.parse_args()
+
+    report = asyncio.run(run_startup(args) if args.startup_runs else run(args))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+    if args.compare:
+        with open(args.compare) as f:
+            print("\n" + compare(json.load(f), report))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,22 @@
 #!/usr/bin/env python3
 import os
 import sys
+import csv
+import json
+import calendar
 import sqlite3
+import argparse
 import subprocess
 import time
 
 if sys.version_info[0] < 3:
     raise Exception("Must be run using Python 3")
 
+# History paging is shared with the controller's /history (src/history.py),
+# so both read cursors and rollups the same way.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"))
+import history
+
 INSTALL_DIR = "/opt/server-guard"
 CONFIG_DIR = "/etc/server-guard"
 DB_PATH = os.path.join(INSTALL_DIR, "data/guard.db")
@@ -30,6 +39,45 @@ def check_status():
         print("Docker Error or Not Installed.")
     input("\nPress Enter to return...")
 
+HISTORY_PAGE = 50
+
+def fetch_history_page(conn, filters, cursor=None, direction="older"):
+    # history.plan on a plain sqlite3 connection: (rows newest first,
+    # newer cursor, older cursor); count (r[6]) is None for raw rows.
+    steps = history.plan(filters, cursor, direction, HISTORY_PAGE)
+    try:
+        sql, params = next(steps)
+        while True:
+            try:
+                rows = conn.execute(sql, params).fetchall()
+            except sqlite3.OperationalError as e:
+                # Controllers from before retention have no rollup table;
+                # any other schema problem is reported, not shown as empty.
+                if "no such table: history_hourly" not in str(e):
+                    raise
+                rows = []
+            sql, params = steps.send(rows)
+    except StopIteration as done:
+        return done.value
+
+def prompt_history_filters():
+    print("\nFilters (leave blank to skip):")
+    filters = {}
+    server = input("Server ID: ").strip()
+    if server.isdigit():
+        filters["server_id"] = int(server)
+    for key, label in (("ip", "IP Address"), ("user", "User")):
+        value = input(f"{label}: ").strip()
+        if value:
+            filters[key] = value
+    status = input("Status (ALLOWED/BLOCKED): ").strip().upper()
+    if status:
+        filters["status"] = status
+    hours = input("Last N hours: ").strip()
+    if hours.isdigit():
+        filters["since"] = int(time.time()) - int(hours) * 3600
+    return filters
+
 def view_history():
     header()
     if not os.path.exists(DB_PATH):
@@ -38,23 +86,50 @@ def view_history():
         return
 
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("SELECT id, ip, user, status, timestamp FROM history ORDER BY id DESC LIMIT 50")
-        rows = c.fetchall()
-        conn.close()
+        conn = sqlite3.connect(f"file:{DB_PATH}?mode=ro", uri=True)
+    except Exception as e:
+        print(f"Error reading DB: {e}")
+        input("\nPress Enter to return...")
+        return
 
-        print(f"{'ID':<6} {'IP Address':<18} {'User':<10} {'Status':<12} {'Time'}")
-        print("-" * 65)
-        for r in rows:
-            ts = time.strftime('%Y-%m-%d %H:%M', time.localtime(r[4]))
-            color = "\033[1;32m" if r[3] == "ALLOWED" else "\033[1;31m"
-            print(f"{r[0]:<6} {r[1]:<18} {r[2]:<10} {color}{r[3]:<12}\033[0m {ts}")
-        
+    filters, cursor, direction = {}, None, "older"
+    try:
+        while True:
+            rows, newer, older = fetch_history_page(conn, filters, cursor, direction)
+            header()
+            if filters:
+                print("Filters: " + ", ".join(f"{k}={v}" for k, v in filters.items()))
+            print(f"{'ID':<8} {'IP Address':<18} {'Geo':<12} {'User':<10} {'Status':<12} {'Time'}")
+            print("-" * 80)
+            for r in rows:
+                ts = time.strftime('%Y-%m-%d %H:%M', time.localtime(r[5]))
+                color = "\033[1;32m" if r[4] == "ALLOWED" else "\033[1;31m"
+                if history.is_rollup(r):
+                    ts += f" (hourly x{r[6]})"
+                geo = " ".join(p for p in (r[7], f"AS{r[8]}" if r[8] else None) if p)
+                print(f"{r[0]:<8} {r[2] or '?':<18} {geo:<12} {r[3] or '?':<10} {color}{r[4] or '?':<12}\033[0m {ts}")
+            if not rows:
+                print("No records.")
+
+            options = []
+            if older: options.append("[n] Older")
+            if newer: options.append("[p] Newer")
+            options += ["[f] Filter", "[q] Back"]
+            choice = input("\n" + "  ".join(options) + ": ").strip().lower()
+
+            if choice == 'n' and older:
+                cursor, direction = older, "older"
+            elif choice == 'p' and newer:
+                cursor, direction = newer, "newer"
+            elif choice == 'f':
+                filters, cursor, direction = prompt_history_filters(), None, "older"
+            elif choice == 'q' or choice == '':
+                break
     except Exception as e:
         print(f"Error reading DB: {e}")
-    
-    input("\nPress Enter to return...")
+        input("\nPress Enter to return...")
+    finally:
+        conn.close()
 
 def service_control(action):
     print(f"\n\033[1;33m[+] {action}ing Service...\033[0m")
@@ -80,6 +155,8 @@ def uninstall():
     os.system("rm -f /usr/local/bin/sg-logger")
     os.system("rm -f /usr/local/bin/ToolsServer")
     os.system("rm -f /etc/profile.d/z99-server-guard.sh")
+    # The controller's fleet key, if a deploy with fleet access added it here.
+    os.system("sed -i '/ serverguard-fleet$/d' ~/.ssh/authorized_keys 2>/dev/null")
     
     print("Restoring SSH config (Manual check recommended)...")
     print("Please manually check /etc/ssh/sshd_config and remove 'Subsystem sftp /usr/local/bin/sg-sftp-wrapper'")
@@ -124,7 +201,277 @@ def main_menu():
         elif choice == '5': uninstall()
         elif choice == '0': sys.exit()
 
+# --- Non-interactive commands ---
+# "manager.py export ..." and "manager.py report ..." run without the menu so
+# cron jobs and a SIEM shipper can use them; see "manager.py <cmd> --help".
+EXPORT_BATCH = 5000
+
+# name -> (table, time column, output columns, SELECT without WHERE)
+EXPORTS = {
+    "history": ("history", "timestamp",
+                ("id", "server_id", "server", "ip", "user", "status", "timestamp", "country", "asn", "org"),
+                "SELECT t.id, t.server_id, s.name, t.ip, t.user, t.status, t.timestamp, t.country, t.asn, t.org "
+                "FROM history t LEFT JOIN servers s ON s.id = t.server_id"),
+    "commands": ("commands", "timestamp",
+                 ("id", "server_id", "server", "user", "ip", "cmd", "timestamp"),
+                 "SELECT t.id, t.server_id, s.name, t.user, t.ip, t.cmd, t.timestamp "
+                 "FROM commands t LEFT JOIN servers s ON s.id = t.server_id"),
+    # Hourly rollups of history past raw retention. A row's count can still
+    # grow while the controller is rolling up its hour, so re-export the
+    # last hour if exact counts matter.
+    "hourly": ("history_hourly", "hour",
+               ("id", "server_id", "server", "ip", "user", "status", "hour", "count", "country", "asn", "org"),
+               "SELECT t.id, t.server_id, s.name, t.ip, t.user, t.status, t.hour, t.count, t.country, t.asn, t.org "
+               "FROM history_hourly t LEFT JOIN servers s ON s.id = t.server_id"),
+}
+
+def open_readonly(path):
+    if not os.path.exists(path):
+        raise SystemExit(f"Database not found: {path}")
+    return sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+
+def parse_time(value):
+    # Epoch seconds, an age back from now ("90m", "12h", "7d", "2w") or a
+    # UTC date "YYYY-MM-DD[THH:MM]".
+    units = {"m": 60, "h": 3600, "d": 86400, "w": 604800}
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    if value[:-1].isdigit() and value[-1:] in units:
+        return int(time.time()) - int(value[:-1]) * units[value[-1]]
+    for fmt in ("%Y-%m-%dT%H:%M", "%Y-%m-%d"):
+        try:
+            return calendar.timegm(time.strptime(value, fmt))
+        except ValueError:
+            continue
+    raise argparse.ArgumentTypeError(f"bad time: {value}")
+
+def load_checkpoint(path, name):
+    if not path or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        data = json.load(f)
+    if data.get("export") != name:
+        raise SystemExit(f"Checkpoint {path} belongs to '{data.get('export')}', not '{name}'")
+    return data["last_id"]
+
+def save_checkpoint(path, name, last_id):
+    # Write-then-rename so a crash never leaves a truncated checkpoint.
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump({"export": name, "last_id": last_id, "updated": int(time.time())}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def id_range(conn, table, ts, args, after_id):
+    # Resolve time bounds to an id window once through the time index, so the
+    # batches below are pure rowid range scans. Ids grow with insert time;
+    # the time clauses still apply per batch to stay exact.
+    low = after_id if after_id is not None else 0
+    high = conn.execute(f"SELECT max(id) FROM {table}").fetchone()[0] or 0
+    if args.until_id is not None:
+        high = min(high, args.until_id)
+    if args.since is not None and after_id is None:
+        first = conn.execute(f"SELECT min(id) FROM {table} WHERE {ts} >= ?", (args.since,)).fetchone()[0]
+        low = max(low, first - 1) if first is not None else high
+    if args.until is not None:
+        last = conn.execute(f"SELECT max(id) FROM {table} WHERE {ts} < ?", (args.until,)).fetchone()[0]
+        high = min(high, last or 0)
+    return low, high
+
+def export_rows(conn, name, args, after_id):
+    # Streams the id window in batches of (last_id, rows); memory use is one
+    # batch whatever the range. Ends with (high, []) so a checkpoint can skip
+    # past ids that matched nothing.
+    table, ts, columns, select = EXPORTS[name]
+    low, high = id_range(conn, table, ts, args, after_id)
+    clauses, params = ["t.id > ?", "t.id <= ?"], []
+    if args.since is not None:
+        clauses.append(f"t.{ts} >= ?")
+        params.append(args.since)
+    if args.until is not None:
+        clauses.append(f"t.{ts} < ?")
+        params.append(args.until)
+    sql = f"{select} WHERE {' AND '.join(clauses)} ORDER BY t.id LIMIT ?"
+    last_id = low
+    while last_id < high:
+        rows = conn.execute(sql, [last_id, high] + params + [args.batch]).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        yield last_id, rows
+    yield max(last_id, high), []
+
+def cmd_export(args):
+    columns = EXPORTS[args.table][2]
+    checkpoint = load_checkpoint(args.checkpoint, args.table)
+    after_id = checkpoint if checkpoint is not None else args.after_id
+    conn = open_readonly(args.db)
+    out = sys.stdout if args.output == "-" else open(args.output, "a" if args.append else "w", newline="")
+    total = 0
+    try:
+        writer = csv.writer(out) if args.format == "csv" else None
+        if writer is not None and not args.no_header:
+            writer.writerow(columns)
+        for last_id, rows in export_rows(conn, args.table, args, after_id):
+            if writer is not None:
+                writer.writerows(rows)
+            else:
+                out.writelines(json.dumps(dict(zip(columns, r)), ensure_ascii=False) + "\n" for r in rows)
+            total += len(rows)
+            # The checkpoint only moves past rows that have reached the output,
+            # so an interrupted run resumes without gaps.
+            out.flush()
+            if args.checkpoint:
+                save_checkpoint(args.checkpoint, args.table, last_id)
+    except sqlite3.OperationalError as e:
+        raise SystemExit(f"Export failed: {e}")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        conn.close()
+    print(f"Exported {total} {args.table} rows", file=sys.stderr)
+
+def time_clause(column, args):
+    clauses, params = [], []
+    if args.since is not None:
+        clauses.append(f"{column} >= ?")
+        params.append(args.since)
+    if args.until is not None:
+        clauses.append(f"{column} < ?")
+        params.append(args.until)
+    return " AND ".join(clauses) or "1", params
+
+def has_table(conn, name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone() is not None
+
+def grouped_counts(conn, key, args, status=None, limit=None):
+    # Raw rows and hourly rollups are counted separately (each through its
+    # own indexes) and merged, so ranges past raw retention still add up.
+    # Totals scan the covering (key, time) index; a status filter goes
+    # through (status, time) instead, which is an exact range.
+    sources = [("history", "count(*)", "timestamp", "idx_history_status_time")]
+    if has_table(conn, "history_hourly"):
+        sources.append(("history_hourly", "sum(count)", "hour", "idx_hourly_status_time"))
+    parts, params = [], []
+    for table, count, ts, status_index in sources:
+        where, where_params = time_clause(ts, args)
+        if status is not None:
+            table = f"{table} INDEXED BY {status_index}"
+            where = f"status = ? AND {where}"
+            where_params = [status] + where_params
+        parts.append(f"SELECT {key} AS k, {count} AS n FROM {table} WHERE {where} GROUP BY {key}")
+        params += where_params
+    sql = f"SELECT k, sum(n) AS total FROM ({' UNION ALL '.join(parts)}) GROUP BY k ORDER BY total DESC"
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+    return conn.execute(sql, params).fetchall()
+
+# "AS3320 Deutsche Telekom AG"; grouped as one key so the name needs no second lookup.
+ASN_LABEL = "'AS' || asn || coalesce(' ' || org, '')"
+
+def build_report(conn, args):
+    started = time.perf_counter()
+    names = dict(conn.execute("SELECT id, name FROM servers").fetchall())
+    totals = grouped_counts(conn, "server_id", args)
+    blocked = dict(grouped_counts(conn, "server_id", args, "BLOCKED"))
+    servers = [
+        {"server_id": sid, "server": names.get(sid), "attempts": n, "blocked": blocked.get(sid, 0),
+         "block_rate": round(blocked.get(sid, 0) / n, 4) if n else 0}
+        for sid, n in totals
+    ]
+    attempts = sum(n for _, n in totals)
+    return {
+        "since": args.since,
+        "until": args.until,
+        "attempts": attempts,
+        "blocked": sum(blocked.values()),
+        "block_rate": round(sum(blocked.values()) / attempts, 4) if attempts else 0,
+        "top_ips": [{"ip": k, "attempts": n} for k, n in grouped_counts(conn, "ip", args, limit=args.top)],
+        "top_blocked_ips": [{"ip": k, "attempts": n}
+                            for k, n in grouped_counts(conn, "ip", args, "BLOCKED", args.top)],
+        "top_users": [{"user": k, "attempts": n} for k, n in grouped_counts(conn, "user", args, limit=args.top)],
+        # From the GeoIP columns the controller stores with each row; rows
+        # recorded without a GeoIP database count as unknown (null).
+        "top_countries": [{"country": k, "attempts": n}
+                          for k, n in grouped_counts(conn, "country", args, "BLOCKED", args.top)],
+        "top_networks": [{"network": k, "attempts": n}
+                         for k, n in grouped_counts(conn, ASN_LABEL, args, "BLOCKED", args.top)],
+        "servers": servers,
+        "query_seconds": round(time.perf_counter() - started, 3),
+    }
+
+def print_report(report):
+    def window(ts):
+        return time.strftime('%Y-%m-%d %H:%M', time.localtime(ts)) if ts else "-"
+    print(f"Window: {window(report['since'])} .. {window(report['until'])}")
+    print(f"Attempts: {report['attempts']}  Blocked: {report['blocked']}  Block rate: {report['block_rate']:.1%}\n")
+    for title, key, label in (("Top IPs", "top_ips", "ip"), ("Top blocked IPs", "top_blocked_ips", "ip"),
+                              ("Top users", "top_users", "user"),
+                              ("Top blocked countries", "top_countries", "country"),
+                              ("Top blocked networks", "top_networks", "network")):
+        print(title)
+        for row in report[key]:
+            print(f"  {str(row[label]):<40} {row['attempts']:>10}")
+        print()
+    print(f"{'Server':<30} {'Attempts':>10} {'Blocked':>10} {'Rate':>8}")
+    for s in report["servers"]:
+        name = f"{s['server'] or '?'} (#{s['server_id']})"
+        print(f"{name:<30} {s['attempts']:>10} {s['blocked']:>10} {s['block_rate']:>8.1%}")
+    print(f"\n({report['query_seconds']}s)")
+
+def cmd_report(args):
+    conn = open_readonly(args.db)
+    # Reports walk whole indexes; a larger page cache and mmap keep them in memory.
+    conn.execute("PRAGMA cache_size=-65536")
+    conn.execute("PRAGMA mmap_size=1073741824")
+    try:
+        report = build_report(conn, args)
+    except sqlite3.OperationalError as e:
+        raise SystemExit(f"Report failed: {e}")
+    finally:
+        conn.close()
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="manager.py", description="ServerGuard management tool (no arguments: interactive menu)")
+    parser.add_argument("--db", default=DB_PATH, help=f"database path (default {DB_PATH})")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    def add_range(p):
+        p.add_argument("--since", type=parse_time, help="epoch, age (7d) or UTC date YYYY-MM-DD[THH:MM]")
+        p.add_argument("--until", type=parse_time, help="exclusive upper time bound, same formats")
+
+    export = sub.add_parser("export", help="stream rows as CSV or JSONL")
+    export.add_argument("table", choices=sorted(EXPORTS))
+    export.add_argument("--format", choices=("jsonl", "csv"), default="jsonl")
+    add_range(export)
+    export.add_argument("--after-id", type=int, help="only rows with id greater than this")
+    export.add_argument("--until-id", type=int, help="only rows with id up to and including this")
+    export.add_argument("--checkpoint", help="file holding the last exported id; resumes from it and advances per batch")
+    export.add_argument("--output", default="-", help="output file (default stdout)")
+    export.add_argument("--append", action="store_true", help="append to --output instead of truncating")
+    export.add_argument("--no-header", action="store_true", help="omit the CSV header row")
+    export.add_argument("--batch", type=int, default=EXPORT_BATCH, help=argparse.SUPPRESS)
+    export.set_defaults(func=cmd_export)
+
+    report = sub.add_parser("report", help="top IPs, top users and block rate per server")
+    add_range(report)
+    report.add_argument("--top", type=int, default=10)
+    report.add_argument("--json", action="store_true", help="print JSON instead of tables")
+    report.set_defaults(func=cmd_report)
+    return parser
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        args = build_parser().parse_args()
+        args.func(args)
+        sys.exit(0)
     if os.geteuid() != 0:
         print("This script must be run as root!")
         sys.exit(1)
@@ -0,0 +1,335 @@
+import os
+import time
+import heapq
+import bisect
+import asyncio
+import socket
+import logging
+import ipaddress
+
+logger = logging.getLogger("ServerGuard.allowlist")
+
+SWEEP_INTERVAL = 30
+SWEEP_BATCH = 500
+FAMILIES = ((4, socket.AF_INET), (6, socket.AF_INET6))
+# Shortest prefix an approval may use; 0.0.0.0/0 would switch the guard off.
+MIN_PREFIX = {4: int(os.getenv("ALLOW_MIN_PREFIX_V4", "8")), 6: int(os.getenv("ALLOW_MIN_PREFIX_V6", "32"))}
+
+
+def normalize(entry):
+    # "1.2.3.4" and "1.2.3.4/32" -> "1.2.3.4"; "1.2.3.77/24" -> "1.2.3.0/24".
+    # Raises ValueError for anything that is neither an address nor a CIDR.
+    network = ipaddress.ip_network(entry.strip(), strict=False)
+    if network.prefixlen == network.max_prefixlen:
+        return str(network.network_address)
+    return str(network)
+
+
+def is_prefix(entry):
+    return "/" in entry
+
+
+def check_breadth(entry):
+    # Raises ValueError for a normalized entry wider than MIN_PREFIX allows.
+    if not is_prefix(entry):
+        return
+    network = ipaddress.ip_network(entry)
+    minimum = MIN_PREFIX[network.version]
+    if network.prefixlen < minimum:
+        raise ValueError(f"{entry} is too broad: IPv{network.version} prefixes must be /{minimum} or longer")
+
+
+def parse_address(ip):
+    # (version, int) or None; inet_pton is ~8x cheaper than ipaddress here.
+    for version, family in FAMILIES:
+        try:
+            return version, int.from_bytes(socket.inet_pton(family, ip), "big")
+        except OSError:
+            continue
+    return None
+
+
+class PrefixTrie:
+    # Binary trie over address bits, one per family. A lookup walks at most
+    # 32 (IPv4) or 128 (IPv6) nodes no matter how many prefixes are stored.
+    # Nodes are [child0, child1, (prefix, expiry) or None].
+    def __init__(self, bits):
+        self.bits = bits
+        self.root = [None, None, None]
+        self.size = 0
+
+    def _path(self, network):
+        value = int(network.network_address)
+        return [(value >> (self.bits - 1 - i)) & 1 for i in range(network.prefixlen)]
+
+    def insert(self, network, key, expiry):
+        node = self.root
+        for bit in self._path(network):
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        if node[2] is None:
+            self.size += 1
+        node[2] = (key, expiry)
+
+    def remove(self, network):
+        node, trail = self.root, []
+        for bit in self._path(network):
+            if node[bit] is None:
+                return
+            trail.append((node, bit))
+            node = node[bit]
+        if node[2] is None:
+            return
+        node[2] = None
+        self.size -= 1
+        # Prune the now-empty tail so the trie only holds live paths.
+        for parent, bit in reversed(trail):
+            child = parent[bit]
+            if child[0] is None and child[1] is None and child[2] is None:
+                parent[bit] = None
+            else:
+                break
+
+    def match(self, value, now):
+        # Longest unexpired prefix covering the address int, as (prefix, expiry).
+        node, best, shift = self.root, None, self.bits - 1
+        while node is not None:
+            entry = node[2]
+            if entry is not None and entry[1] > now:
+                best = entry
+            if shift < 0:
+                break
+            node = node[(value >> shift) & 1]
+            shift -= 1
+        return best
+
+
+class Allowlist:
+    # approved_ips mirrored as entry -> expiry plus a min-heap of (expiry, entry).
+    # Heap entries superseded by a later approval are skipped when popped.
+    # Entries are single addresses (exact dict hit) or CIDR prefixes, which
+    # are also indexed in a per-family trie for longest-prefix matching.
+    #
+    # Every approval also gets a version (microseconds since the epoch, kept
+    # strictly increasing), so agents holding a copy can ask for just the
+    # entries approved after the version they have. Expiry needs no version:
+    # agents drop expired entries themselves. A revocation is versioned too
+    # and kept as a tombstone until the entry would have expired anyway;
+    # tombstones live in revoked_ips as well, so an agent that missed a
+    # revocation still gets it from a restarted controller.
+    def __init__(self, db):
+        self.db = db
+        self.expiry = {}
+        self.heap = []
+        self.tries = {4: PrefixTrie(32), 6: PrefixTrie(128)}
+        self.versions = {}
+        # entry -> (version, original expiry) for revoked entries.
+        self.tombstones = {}
+        # (version, entry) in version order; superseded or expired pairs are
+        # skipped by changes_since() and dropped by _compact().
+        self.log = []
+        self.version = 0
+        self.changed = asyncio.Event()
+
+    async def load(self):
+        rows = await self.db.fetchall("SELECT ip, expiry, version FROM approved_ips")
+        self.expiry = {ip: exp for ip, exp, _ in rows}
+        self.heap = [(exp, ip) for ip, exp, _ in rows]
+        heapq.heapify(self.heap)
+        self.tries = {4: PrefixTrie(32), 6: PrefixTrie(128)}
+        for ip, exp, _ in rows:
+            if is_prefix(ip):
+                self._index(ip, exp)
+        self.versions = {ip: version for ip, _, version in rows}
+        revoked = await self.db.fetchall("SELECT ip, version, expiry FROM revoked_ips WHERE expiry > ?",
+                                         (int(time.time()),))
+        self.tombstones = {ip: (version, exp) for ip, version, exp in revoked if ip not in self.expiry}
+        self.log = sorted([(version, ip) for ip, _, version in rows] +
+                          [(version, ip) for ip, (version, _) in self.tombstones.items()])
+        self.version = self.log[-1][0] if self.log else 0
+        logger.info(f"Allowlist loaded: {len(self.expiry)} entries "
+                    f"({self.tries[4].size + self.tries[6].size} prefixes, {len(self.tombstones)} revoked)")
+
+    def _index(self, entry, expiry):
+        try:
+            network = ipaddress.ip_network(entry)
+        except ValueError:
+            logger.warning(f"Ignoring malformed allowlist prefix: {entry}")
+            return
+        self.tries[network.version].insert(network, entry, expiry)
+
+    def _unindex(self, entry):
+        try:
+            network = ipaddress.ip_network(entry)
+        except ValueError:
+            return
+        self.tries[network.version].remove(network)
+
+    def match(self, ip, now=None):
+        # The entry that admits ip: itself, or the longest covering prefix.
+        now = now or time.time()
+        exp = self.expiry.get(ip)
+        if exp is None and ":" in ip:
+            # Entries are stored normalized, but one IPv6 address has many
+            # spellings ("2001:DB8::0001"); inet_pton only takes canonical IPv4.
+            try:
+                canonical = str(ipaddress.ip_address(ip))
+            except ValueError:
+                return None
+            if canonical != ip:
+                ip = canonical
+                exp = self.expiry.get(ip)
+        if exp is not None and exp > now:
+            return ip, exp
+        if not (self.tries[4].size or self.tries[6].size):
+            return None
+        address = parse_address(ip)
+        if address is None:
+            return None
+        return self.tries[address[0]].match(address[1], now)
+
+    def is_allowed(self, ip, now=None):
+        return self.match(ip, now) is not None
+
+    def next_version(self):
+        # Wall-clock based so versions keep growing across restarts even
+        # after the newest rows were swept from the table.
+        return max(self.version + 1, time.time_ns() // 1000)
+
+    async def approve(self, entry, expiry):
+        # Returns the normalized entry, which is what callers should publish
+        # (together with self.versions[entry]).
+        entry = normalize(entry)
+        check_breadth(entry)
+        version = self.next_version()
+        async with self.db.write() as conn:
+            await conn.execute("REPLACE INTO approved_ips (ip, expiry, version) VALUES (?, ?, ?)",
+                               (entry, expiry, version))
+            await conn.execute("DELETE FROM revoked_ips WHERE ip = ?", (entry,))
+        self.remember(entry, expiry, version)
+        return entry
+
+    def remember(self, entry, expiry, version=None):
+        # Memory-only update, for changes already persisted by another process.
+        self.expiry[entry] = expiry
+        heapq.heappush(self.heap, (expiry, entry))
+        if is_prefix(entry):
+            self._index(entry, expiry)
+        version = version or self.next_version()
+        self.versions[entry] = version
+        self.tombstones.pop(entry, None)
+        self._record(version, entry)
+
+    async def revoke(self, entry):
+        # Returns (normalized entry, version), or None if it was not allowed.
+        entry = normalize(entry)
+        if entry not in self.expiry:
+            return None
+        version = self.next_version()
+        async with self.db.write() as conn:
+            await conn.execute("DELETE FROM approved_ips WHERE ip = ?", (entry,))
+            await conn.execute("REPLACE INTO revoked_ips (ip, version, expiry) VALUES (?, ?, ?)",
+                               (entry, version, self.expiry[entry]))
+        self.forget(entry, version)
+        return entry, version
+
+    def forget(self, entry, version):
+        # Memory-only revocation, for changes already persisted by another process.
+        expiry = self.expiry.pop(entry, None)
+        if expiry is None:
+            return
+        self.versions.pop(entry, None)
+        if is_prefix(entry):
+            self._unindex(entry)
+        self.tombstones[entry] = (version, expiry)
+        self._record(version, entry)
+
+    def _record(self, version, entry):
+        if self.log and version < self.log[-1][0]:
+            bisect.insort(self.log, (version, entry))
+        else:
+            self.log.append((version, entry))
+        if version > self.version:
+            self.version = version
+            # Wake long-polling agents; later waiters get a fresh event.
+            self.changed.set()
+            self.changed = asyncio.Event()
+
+    def changes_since(self, version, now=None):
+        # Live (entry, expiry, version) approved after `version`, oldest first;
+        # changes_since(0) is the full snapshot. Deltas also carry revocations
+        # as (entry, 0, version), which agents apply as already expired.
+        now = now or time.time()
+        start = bisect.bisect_right(self.log, version, key=lambda item: item[0])
+        changes = []
+        for entry_version, entry in self.log[start:]:
+            exp = self.expiry.get(entry)
+            if exp is not None and exp > now and self.versions.get(entry) == entry_version:
+                changes.append((entry, exp, entry_version))
+            elif version and self.tombstones.get(entry, (None,))[0] == entry_version:
+                changes.append((entry, 0, entry_version))
+        return changes
+
+    async def wait_for_change(self, version, timeout):
+        # True once something newer than `version` exists, False on timeout.
+        if self.version > version:
+            return True
+        try:
+            await asyncio.wait_for(self.changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def _compact(self, now):
+        # Tombstones outlive their entry's expiry for no one: agents have
+        # dropped it by then.
+        for entry in [e for e, (_, exp) in self.tombstones.items() if exp <= now]:
+            del self.tombstones[entry]
+        if len(self.log) > 2 * (len(self.versions) + len(self.tombstones)) + 1024:
+            self.log = [(v, e) for v, e in self.log
+                        if self.versions.get(e) == v or self.tombstones.get(e, (None,))[0] == v]
+
+    def active(self, now=None):
+        now = now or time.time()
+        return sorted((ip, exp) for ip, exp in self.expiry.items() if exp > now)
+
+    def pop_expired(self, now=None, limit=SWEEP_BATCH):
+        now = now or time.time()
+        expired = []
+        while self.heap and self.heap[0][0] <= now and len(expired) < limit:
+            exp, ip = heapq.heappop(self.heap)
+            if self.expiry.get(ip) == exp:
+                del self.expiry[ip]
+                self.versions.pop(ip, None)
+                if is_prefix(ip):
+                    self._unindex(ip)
+                expired.append((ip, exp))
+        if expired or self.tombstones:
+            self._compact(now)
+        return expired
+
+    async def sweep(self, persist=True):
+        total = 0
+        while True:
+            batch = self.pop_expired()
+            if not batch:
+                break
+            if persist:
+                # Guard on expiry so a concurrent re-approval is never deleted.
+                await self.db.executemany("DELETE FROM approved_ips WHERE ip = ? AND expiry = ?", batch)
+            total += len(batch)
+            await asyncio.sleep(0)
+        if persist:
+            await self.db.execute("DELETE FROM revoked_ips WHERE expiry <= ?", (int(time.time()),))
+        if total:
+            logger.info(f"Allowlist sweep removed {total} expired entries")
+        return total
+
+    async def run_sweeper(self, interval=SWEEP_INTERVAL, persist=True):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.sweep(persist)
+            except Exception as e:
+                logger.error(f"Allowlist sweep failed: {e}")
@@ -0,0 +1,144 @@
+import time
+import logging
+import sqlite3
+
+from journal import Journal
+
+logger = logging.getLogger("ServerGuard.audit")
+
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 200
+# The trigram tokenizer matches any substring of 3+ characters, which is
+# what "rm -rf" or "/etc/shadow" searches need. Shorter terms use LIKE.
+MIN_FTS_TERM = 3
+
+INSERT_SQL = "INSERT INTO commands (server_id, user, ip, cmd, timestamp) VALUES (?, ?, ?, ?, ?)"
+
+SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS commands (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        server_id INTEGER,
+        user TEXT,
+        ip TEXT,
+        cmd TEXT,
+        timestamp INTEGER
+    )
+    """,
+    # Single-column indexes carry the rowid, so "WHERE user = ? AND id < ?
+    # ORDER BY id DESC" walks one index range for keyset pagination.
+    "CREATE INDEX IF NOT EXISTS idx_commands_server ON commands (server_id)",
+    "CREATE INDEX IF NOT EXISTS idx_commands_user ON commands (user)",
+    "CREATE INDEX IF NOT EXISTS idx_commands_ip ON commands (ip)",
+    "CREATE INDEX IF NOT EXISTS idx_commands_time ON commands (timestamp)",
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS commands_fts USING fts5(
+        cmd, content='commands', content_rowid='id', tokenize='trigram'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS commands_ai AFTER INSERT ON commands BEGIN
+        INSERT INTO commands_fts (rowid, cmd) VALUES (new.id, new.cmd);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS commands_ad AFTER DELETE ON commands BEGIN
+        INSERT INTO commands_fts (commands_fts, rowid, cmd) VALUES ('delete', old.id, old.cmd);
+    END
+    """,
+)
+
+
+async def create_schema(conn):
+    for statement in SCHEMA:
+        try:
+            await conn.execute(statement)
+        except sqlite3.OperationalError as e:
+            # SQLite without FTS5/trigram still records commands; search falls back to LIKE.
+            if "fts5" in statement or "commands_fts" in statement:
+                logger.warning(f"Command full-text index unavailable: {e}")
+                continue
+            raise
+
+
+def as_text(value):
+    return value if isinstance(value, str) else str(value)
+
+
+def fts_phrase(text):
+    return '"' + text.replace('"', '""') + '"'
+
+
+class AuditLog:
+    def __init__(self, db, **journal_args):
+        self.db = db
+        self.journal = Journal(db, INSERT_SQL, name="commands", **journal_args)
+        self.fts = True
+
+    async def load(self):
+        row = await self.db.fetchone("SELECT 1 FROM sqlite_master WHERE name = 'commands_fts'")
+        self.fts = row is not None
+
+    def start(self):
+        self.journal.start()
+
+    async def close(self):
+        await self.journal.close()
+
+    async def record(self, server_id, user, ip, cmd, timestamp=None):
+        # Fields come from agents: anything that is not text is stored as
+        # text, so a malformed record cannot fail its journal row.
+        if not isinstance(timestamp, int) or isinstance(timestamp, bool):
+            timestamp = None
+        await self.journal.put((int(server_id), as_text(user), as_text(ip), as_text(cmd),
+                                timestamp or int(time.time())))
+
+    async def search(self, text=None, server_id=None, user=None, ip=None,
+                     since=None, until=None, cursor=None, limit=PAGE_SIZE):
+        # Keyset pagination on id: cursor is the smallest id of the previous page.
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        clauses, params = [], []
+        source = "commands c"
+        order = "c.id"
+        if text:
+            if self.fts and len(text) >= MIN_FTS_TERM:
+                source = "commands_fts f JOIN commands c ON c.id = f.rowid"
+                # FTS5 can walk its own rowids backwards; keep the sort on them.
+                order = "f.rowid"
+                clauses.append("commands_fts MATCH ?")
+                params.append(fts_phrase(text))
+            else:
+                clauses.append("c.cmd LIKE ? ESCAPE '\\'")
+                escaped = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+                params.append(f"%{escaped}%")
+        for column, value in (("c.server_id", server_id), ("c.user", user), ("c.ip", ip)):
+            if value is not None:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        if since is not None:
+            clauses.append("c.timestamp >= ?")
+            params.append(int(since))
+        if until is not None:
+            clauses.append("c.timestamp < ?")
+            params.append(int(until))
+        if cursor is not None:
+            clauses.append(f"{order} < ?")
+            params.append(int(cursor))
+        where = " AND ".join(clauses) or "1"
+        sql = (f"SELECT c.id, c.server_id, s.name, c.user, c.ip, c.cmd, c.timestamp "
+               f"FROM {source} LEFT JOIN servers s ON s.id = c.server_id "
+               f"WHERE {where} ORDER BY {order} DESC LIMIT ?")
+        rows = await self.db.fetchall(sql, params + [limit + 1])
+        next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+        return rows[:limit], next_cursor
+
+
+def parse_age(text):
+    # "90m", "12h", "7d" -> seconds; plain numbers are seconds.
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+    text = text.strip().lower()
+    if text and text[-1] in units and text[:-1].isdigit():
+        return int(text[:-1]) * units[text[-1]]
+    if text.isdigit():
+        return int(text)
+    raise ValueError(f"Bad age: {text}")
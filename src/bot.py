@@ -1,21 +1,31 @@
 import asyncio
 import os
 import sys
-import json
 import time
 import secrets
+import signal
 import logging
-import aiosqlite
-import asyncssh
+import importlib
+import ipaddress
 from aiohttp import web
-from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters import Command
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.client.default import DefaultBotProperties
-from aiogram.enums import ParseMode
-from aiogram.fsm.context import FSMContext
-from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
+from storage import Storage
+from registry import ServerRegistry
+from allowlist import Allowlist
+from journal import HistoryJournal
+from ingest import LogIngest
+from dispatcher import TelegramDispatcher, ALERT, NOTICE, escape
+from retention import Retention
+from throttle import BruteForceGuard
+import audit
+import geoip
+import heartbeat
+import history
+import livestream
+import metrics
+import profiler
+import snapshot
+import sshpool
+import workers
 
 # --- Logging Setup ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -25,9 +35,13 @@ logger = logging.getLogger("ServerGuard")
 TOKEN = os.getenv("TG_TOKEN")
 ADMIN_ID = os.getenv("ADMIN_ID")
 PUBLIC_IP = os.getenv("PUBLIC_IP", "127.0.0.1")
-DB_PATH = "/data/guard.db"
-UDP_PORT = 9999
-HTTP_PORT = 8080
+# Admin HTTP endpoints (/search, ...) are disabled unless a key is set.
+ADMIN_API_KEY = os.getenv("ADMIN_API_KEY")
+DB_PATH = os.getenv("DB_PATH", "/data/guard.db")
+UDP_PORT = int(os.getenv("UDP_PORT", "9999"))
+HTTP_PORT = int(os.getenv("HTTP_PORT", "8080"))
+# Alternative Bot API base URL (self-hosted Bot API server, or a fake one for benchmarks).
+TG_API_SERVER = os.getenv("TG_API_SERVER")
 
 if not TOKEN or not ADMIN_ID:
     logger.fatal("TG_TOKEN or ADMIN_ID is missing in environment variables.")
@@ -39,23 +53,61 @@ except ValueError:
     logger.fatal("ADMIN_ID must be an integer.")
     sys.exit(1)
 
-# --- Bot Initialization ---
-bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
-
-# --- FSM States ---
-class AddServer(StatesGroup):
-    ip = State()
-    port = State()
-    user = State()
-    auth_method = State()
-    credentials = State()
+API_URL = f"http://{PUBLIC_IP}:{HTTP_PORT}/check-access"
+
+# --- Initialization ---
+# The Bot is attached by start_telegram() once the listeners are serving;
+# alerts raised before that wait in the dispatcher queue.
+# Followers replace this with a workers.RemoteDispatcher in main().
+sender = TelegramDispatcher(None, ADMIN_ID)
+bot = None
+telegram_task = None
+ipc_server = None
+ipc_client = None
+shutdown = asyncio.Event()
+db = Storage(DB_PATH)
+servers = ServerRegistry(db)
+allowlist = Allowlist(db)
+geo = geoip.GeoIP()
+# Alerts and command digests get a country/ASN line when they are sent.
+sender.annotate = geo.describe
+journal = HistoryJournal(db, geo=geo)
+ingest = LogIngest(servers)
+commands = audit.AuditLog(db)
+retention = Retention(db)
+feed = snapshot.SnapshotFeed(allowlist)
+# Leader only: loaded with the Telegram UI, which drives fleet operations.
+pool = sshpool.SSHPool(db)
+guard = BruteForceGuard()
+# Leader tracks agent liveness; followers forward what they receive.
+heartbeats = heartbeat.HeartbeatTracker(db)
+# Every worker watches its own loop and can profile itself.
+watchdog = profiler.LoopWatchdog()
+sampler = profiler.SamplingProfiler()
+# Live /events feed; the leader numbers events and correlates sessions.
+events = livestream.EventStream()
+# Leader: subscriber count per follower index.
+stream_followers = {}
+# Flipped by main(); /readyz reports them and fails until "serving".
+readiness = {"serving": False, "telegram": False}
 
 # --- Database Functions ---
-async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
+async def init_db(create=True):
+    await db.open()
+    if create:
+        await create_schema()
+    await servers.load()
+    await allowlist.load()
+    await commands.load()
+    await asyncio.to_thread(geo.open)
+    try:
+        feed.secret = await asyncio.to_thread(snapshot.load_secret)
+    except OSError as e:
+        logger.error(f"Allowlist sync disabled, cannot load signing secret: {e}")
+
+async def create_schema():
+    async with db.write() as conn:
+        await conn.execute("""
             CREATE TABLE IF NOT EXISTS servers (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 name TEXT,
@@ -64,234 +116,118 @@ async def init_db():
                 added_at INTEGER
             )
         """)
-        await db.execute("""
+        await conn.execute("""
             CREATE TABLE IF NOT EXISTS approved_ips (
                 ip TEXT PRIMARY KEY,
+                expiry INTEGER,
+                version INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        async with conn.execute("PRAGMA table_info(approved_ips)") as cursor:
+            columns = [row[1] for row in await cursor.fetchall()]
+        if "version" not in columns:
+            # Allowlist snapshot versions; rows from before count as version 0.
+            await conn.execute("ALTER TABLE approved_ips ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        # Allowlist tombstones, kept until the revoked entry would have expired.
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS revoked_ips (
+                ip TEXT PRIMARY KEY,
+                version INTEGER NOT NULL,
                 expiry INTEGER
             )
         """)
-        await db.execute("""
+        await conn.execute("""
             CREATE TABLE IF NOT EXISTS history (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 server_id INTEGER,
                 ip TEXT,
                 user TEXT,
                 status TEXT,
-                timestamp INTEGER
+                timestamp INTEGER,
+                country TEXT,
+                asn INTEGER,
+                org TEXT
             )
         """)
         
-        async with db.execute("SELECT count(*) FROM servers") as cursor:
+        async with conn.execute("SELECT count(*) FROM servers") as cursor:
             count = await cursor.fetchone()
             if count[0] == 0:
                 logger.info("Initializing DB with Master Node...")
-                await db.execute(
+                await conn.execute(
                     "INSERT INTO servers (name, ip, token, added_at) VALUES (?, ?, ?, ?)",
                     ("Master Node", "127.0.0.1", "local-token", int(time.time()))
                 )
-        await db.commit()
+        await audit.create_schema(conn)
+        await history.create_schema(conn)
+        await sshpool.create_schema(conn)
+        await heartbeat.create_schema(conn)
 
 async def get_server_by_token(token):
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT id, name, ip FROM servers WHERE token = ?", (token,)) as cursor:
-            return await cursor.fetchone()
+    return await servers.get(token)
 
 async def add_server_db(name, ip):
+    # REPLACE gives a re-registered host a new id; the old one stops beating.
+    old = servers.by_token.get(servers.token_by_ip.get(ip))
+    if old is not None:
+        heartbeats.forget(old[0])
     token = secrets.token_hex(16)
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("REPLACE INTO servers (name, ip, token, added_at) VALUES (?, ?, ?, ?)", 
-                         (name, ip, token, int(time.time())))
-        await db.commit()
+    async with db.write() as conn:
+        cursor = await conn.execute("REPLACE INTO servers (name, ip, token, added_at) VALUES (?, ?, ?, ?)", 
+                                    (name, ip, token, int(time.time())))
+        server_id = cursor.lastrowid
+    servers.put(token, (server_id, name, ip))
+    publish({"op": "server", "token": token, "server": [server_id, name, ip]})
     return token
 
-async def log_attempt(server_id, ip, user, status):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT INTO history (server_id, ip, user, status, timestamp) VALUES (?, ?, ?, ?, ?)",
-            (server_id, ip, user, status, int(time.time()))
-        )
-        await db.commit()
+async def log_attempt(server_id, ip, user, status, timestamp=None):
+    await journal.record(server_id, ip, user, status, timestamp)
+
+def stream_check(server, ip, user, status, via="api", hostile=False, ts=None):
+    events.emit({"type": "check", "ts": ts or round(time.time(), 3), "server_id": server[0], "server": server[1],
+                 "user": user, "ip": ip, "status": status, "via": via, "hostile": hostile})
 
 async def is_ip_allowed(ip: str) -> bool:
-    now = int(time.time())
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT expiry FROM approved_ips WHERE ip = ?", (ip,)) as cursor:
-            row = await cursor.fetchone()
-            if row and row[0] > now:
-                return True
-            if row: 
-                await db.execute("DELETE FROM approved_ips WHERE ip = ?", (ip,))
-                await db.commit()
-    return False
+    return allowlist.is_allowed(ip)
 
 async def approve_ip(ip: str, duration_hours: int = 1):
-    expiry = int(time.time()) + (duration_hours * 3600)
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("REPLACE INTO approved_ips (ip, expiry) VALUES (?, ?)", (ip, expiry))
-        await db.commit()
-
-# --- SSH Deployment Logic ---
-async def deploy_agent(ip, port, user, password=None, key_file=None):
-    token = await add_server_db(f"Agent {ip}", ip)
-    
-    files_to_send = [
-        ("scripts/check_access.sh", "sg-check-access"),
-        ("scripts/sftp_wrapper.sh", "sg-sftp-wrapper"),
-        ("scripts/logger.sh", "sg-logger"),
-        ("scripts/agent_installer.sh", "agent_installer.sh")
-    ]
-    
-    try:
-        conn_args = {'host': ip, 'port': port, 'username': user, 'known_hosts': None}
-        if password:
-            conn_args['password'] = password
-        if key_file:
-            conn_args['client_keys'] = [key_file]
-
-        async with asyncssh.connect(**conn_args) as conn:
-            for local_rel, remote_name in files_to_send:
-                local_path = os.path.abspath(local_rel)
-                if not os.path.exists(local_path):
-                    return False, f"Missing local file: {local_path}"
-                await asyncssh.scp(local_path, (conn, f"/tmp/{remote_name}"))
-            
-            # FIX: Append /check-access to the API URL
-            api_url = f"http://{PUBLIC_IP}:{HTTP_PORT}/check-access"
-            log_host = PUBLIC_IP
-            
-            cmd = f"chmod +x /tmp/agent_installer.sh && /tmp/agent_installer.sh '{api_url}' '{token}' '{log_host}'"
-            result = await conn.run(cmd, check=True)
-            return True, result.stdout
-
-    except Exception as e:
-        logger.error(f"Deploy Error: {e}")
-        return False, str(e)
-
-# --- Telegram Handlers ---
-
-@dp.message(Command("start"))
-async def cmd_start(message: types.Message):
-    if message.from_user.id != ADMIN_ID:
-        return
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="➕ Add Server", callback_data="add_server")],
-        [InlineKeyboardButton(text="📜 History", callback_data="menu_history")],
-        [InlineKeyboardButton(text="🔐 Whitelist", callback_data="menu_whitelist")]
-    ])
-    await message.answer(
-        f"🛡 <b>Server Guard Controller</b>\nIP: <code>{PUBLIC_IP}</code>\n\nSystem Online.",
-        reply_markup=kb
-    )
-
-@dp.callback_query(F.data == "add_server")
-async def start_add_server(call: types.CallbackQuery, state: FSMContext):
-    await call.message.answer("🌐 Enter <b>IP Address</b> of new server:")
-    await state.set_state(AddServer.ip)
-    await call.answer()
-
-@dp.message(AddServer.ip)
-async def process_ip(message: types.Message, state: FSMContext):
-    await state.update_data(ip=message.text.strip())
-    await message.answer("🔌 Enter SSH Port (default 22):")
-    await state.set_state(AddServer.port)
-
-@dp.message(AddServer.port)
-async def process_port(message: types.Message, state: FSMContext):
-    txt = message.text.strip()
-    port = int(txt) if txt.isdigit() else 22
-    await state.update_data(port=port)
-    await message.answer("👤 Enter SSH Username (default root):")
-    await state.set_state(AddServer.user)
-
-@dp.message(AddServer.user)
-async def process_user(message: types.Message, state: FSMContext):
-    user = message.text.strip() or "root"
-    await state.update_data(user=user)
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔑 Password", callback_data="auth_pass")],
-        [InlineKeyboardButton(text="📄 SSH Key", callback_data="auth_key")]
-    ])
-    await message.answer("🔐 Auth Method:", reply_markup=kb)
-    await state.set_state(AddServer.auth_method)
-
-@dp.callback_query(AddServer.auth_method)
-async def process_auth_method(call: types.CallbackQuery, state: FSMContext):
-    method = call.data.split("_")[1]
-    await state.update_data(auth_method=method)
-    if method == "pass":
-        await call.message.answer("⌨️ Enter Password:")
-    else:
-        await call.message.answer("📂 Send Private Key File:")
-    await state.set_state(AddServer.credentials)
-    await call.answer()
-
-@dp.message(AddServer.credentials)
-async def process_credentials(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    auth_method = data['auth_method']
-    password = None
-    key_file = None
-    status_msg = await message.answer(f"⏳ Connecting to {data['ip']}...")
-    
-    if auth_method == "pass":
-        password = message.text
-    else:
-        if not message.document:
-            await message.answer("❌ File expected.")
-            return
-        file_id = message.document.file_id
-        file = await bot.get_file(file_id)
-        key_file = f"/tmp/key_{data['ip']}_{int(time.time())}"
-        await bot.download_file(file.file_path, key_file)
-        os.chmod(key_file, 0o600)
-
-    success, log = await deploy_agent(data['ip'], data['port'], data['user'], password, key_file)
-    if key_file and os.path.exists(key_file):
-        os.remove(key_file)
-        
-    if success:
-        await status_msg.edit_text(f"✅ <b>Success!</b>\nServer {data['ip']} attached.")
-    else:
-        clean_log = str(log).replace("<", "&lt;")[:3000]
-        await status_msg.edit_text(f"❌ <b>Failed:</b>\n<pre>{clean_log}</pre>")
-    await state.clear()
-
-@dp.callback_query(F.data == "menu_history")
-async def show_history(call: types.CallbackQuery):
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("""
-            SELECT h.ip, h.user, h.status, h.timestamp, s.name 
-            FROM history h 
-            LEFT JOIN servers s ON h.server_id = s.id 
-            ORDER BY h.id DESC LIMIT 10
-        """) as cursor:
-            rows = await cursor.fetchall()
-    if not rows:
-        await call.message.edit_text("📜 History empty.", reply_markup=None)
-        return
-    msg = "📜 <b>Last Access Attempts:</b>\n"
-    for r in rows:
-        ts = time.strftime('%H:%M', time.localtime(r[3]))
-        icon = "✅" if r[2] == "ALLOWED" else "⛔"
-        srv = r[4] if r[4] else "?"
-        msg += f"{icon} <b>{srv}</b> | {r[1]}@{r[0]} ({ts})\n"
-    await call.message.edit_text(msg, reply_markup=None)
-
-@dp.callback_query(F.data == "menu_whitelist")
-async def show_whitelist(call: types.CallbackQuery):
-    now = int(time.time())
-    async with aiosqlite.connect(DB_PATH) as db:
-        async with db.execute("SELECT ip, expiry FROM approved_ips WHERE expiry > ?", (now,)) as cursor:
-            rows = await cursor.fetchall()
-    msg = "🔐 <b>Whitelisted IPs:</b>\n"
-    if not rows: msg += "None."
-    for r in rows:
-        left = int((r[1] - now) / 60)
-        msg += f"🌐 <code>{r[0]}</code> ({left}m)\n"
-    await call.message.edit_text(msg, reply_markup=None)
+    # ip may be an address or a CIDR prefix; returns the normalized entry.
+    expiry = int(time.time()) + int(duration_hours * 3600)
+    entry = await allowlist.approve(ip, expiry)
+    publish({"op": "approve", "ip": entry, "expiry": expiry, "version": allowlist.versions[entry]})
+    return entry
+
+async def revoke_ip(ip: str):
+    # Returns the normalized entry, or None if it was not on the allowlist.
+    revoked = await allowlist.revoke(ip)
+    if revoked is None:
+        return None
+    entry, version = revoked
+    publish({"op": "revoke", "ip": entry, "version": version})
+    return entry
+
+def agent_env(ip):
+    # agent.env as agent_installer.sh writes it, for fleet config pushes.
+    token = servers.token_by_ip.get(ip, "")
+    return (f'API_URL="{API_URL}"\nAPI_TOKEN="{token}"\nLOG_HOST="{PUBLIC_IP}"\n',
+            feed.agent_key(token) if token else "")
 
 # --- HTTP API Handlers ---
 
+CHECK_STAGE = metrics.histogram("sg_check_access_stage_seconds", "Time spent in each /check-access stage", ("stage",))
+STAGE_TOKEN = CHECK_STAGE.labels("token_lookup")
+STAGE_ALLOWLIST = CHECK_STAGE.labels("allowlist_check")
+STAGE_HISTORY = CHECK_STAGE.labels("history_write")
+STAGE_ALERT = CHECK_STAGE.labels("alert_enqueue")
+CHECK_RESULTS = metrics.counter("sg_check_access_total", "/check-access decisions", ("result",))
+RESULT_ALLOWED = CHECK_RESULTS.labels("allowed")
+RESULT_BLOCKED = CHECK_RESULTS.labels("blocked")
+RESULT_UNAUTHORIZED = CHECK_RESULTS.labels("unauthorized")
+# Allowed by an agent's synced allowlist copy and reported over UDP.
+RESULT_AGENT = CHECK_RESULTS.labels("allowed_by_agent")
+RESULT_FORGED = CHECK_RESULTS.labels("agent_unverified")
+RESULT_HOSTILE = CHECK_RESULTS.labels("hostile")
+
 async def handle_check_access(request):
     token = request.headers.get("X-Guard-Token") or request.query.get("token")
     ip = request.query.get('ip')
@@ -303,12 +239,16 @@ async def handle_check_access(request):
     if token == "None" or token is None:
         token = "local-token"
     
+    t0 = time.perf_counter()
     server = await get_server_by_token(token)
+    t1 = time.perf_counter()
+    STAGE_TOKEN.observe(t1 - t0)
     
     if not server:
         if token == "local-token":
              server = (1, "Master Node", "127.0.0.1")
         else:
+            RESULT_UNAUTHORIZED.inc()
             logger.warning(f"Unauthorized API call from {ip}. Token received: '{token}'")
             return web.json_response({"status": "unauthorized"}, status=401)
             
@@ -316,85 +256,538 @@ async def handle_check_access(request):
     server_name = server[1]
 
     allowed = await is_ip_allowed(ip)
+    t2 = time.perf_counter()
+    STAGE_ALLOWLIST.observe(t2 - t1)
+    if not allowed and guard.is_hostile(ip):
+        # Known brute-forcer: no alert, and only a sample reaches history.
+        if guard.suppress(ip):
+            await log_attempt(server_id, ip, user, "BLOCKED")
+        stream_check(server, ip, user, "BLOCKED", hostile=True)
+        RESULT_HOSTILE.inc()
+        return web.json_response({"status": "forbidden"}, status=403)
     status_log = "ALLOWED" if allowed else "BLOCKED"
     await log_attempt(server_id, ip, user, status_log)
+    stream_check(server, ip, user, status_log)
+    t3 = time.perf_counter()
+    STAGE_HISTORY.observe(t3 - t2)
     
     if allowed:
+        RESULT_ALLOWED.inc()
         return web.json_response({"status": "allowed"})
     
-    try:
-        kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text=f"✅ Allow {ip} (1h)", callback_data=f"allow_{ip}")]])
-        await bot.send_message(
-            chat_id=ADMIN_ID,
-            text=f"🚨 <b>BLOCKED</b>\n\n🏢 <b>{server_name}</b>\n👤 {user}\n🌐 <code>{ip}</code>",
-            reply_markup=kb
+    crossed = guard.observe(ip, server_id)
+    if crossed is not None:
+        mark_hostile(ip, server_name, *crossed)
+    else:
+        sender.alert(
+            (ip, server_id),
+            f"🚨 <b>BLOCKED</b>\n\n🏢 <b>{escape(server_name)}</b>\n👤 {escape(user)}\n🌐 <code>{escape(ip)}</code>",
+            reply_markup=approve_markup(ip), ip=ip
         )
-    except Exception as e:
-        logger.error(f"Failed to send alert: {e}")
+    STAGE_ALERT.observe(time.perf_counter() - t3)
+    RESULT_BLOCKED.inc()
 
     return web.json_response({"status": "forbidden"}, status=403)
 
-@dp.callback_query(F.data.startswith("allow_"))
-async def process_callback_allow(call: types.CallbackQuery):
-    ip = call.data.split("_")[1]
-    await approve_ip(ip)
+async def handle_allowlist(request):
+    # Agent allowlist sync. Without If-None-Match the body is the full
+    # snapshot; with If-None-Match: "<version>" it holds only entries
+    # approved since, and ?wait=N long-polls up to N seconds for one before
+    # answering 304. Bodies are signed in X-Signature (see snapshot.py).
+    token = request.headers.get("X-Guard-Token")
+    server = await get_server_by_token(token) if token else None
+    if not server:
+        RESULT_UNAUTHORIZED.inc()
+        return web.json_response({"status": "unauthorized"}, status=401)
+    if not feed.secret:
+        return web.json_response({"status": "unavailable"}, status=503)
+    since = snapshot.parse_etag(request.headers.get("If-None-Match"))
+    if since is not None and allowlist.version <= since:
+        try:
+            wait = min(float(request.query.get("wait", 0)), snapshot.MAX_WAIT)
+        except ValueError:
+            wait = 0
+        if wait <= 0 or not await allowlist.wait_for_change(since, wait):
+            feed.stats["not_modified"] += 1
+            return web.Response(status=304, headers={"ETag": f'"{since}"'})
+    version, body = feed.render(since)
+    return web.Response(body=body, content_type="application/json",
+                        headers={"ETag": f'"{version}"', "X-Signature": feed.sign(token, body)})
+
+def mark_hostile(ip, server_name, ip_count, pair_count):
+    expiry = int(time.time()) + guard.ttl
+    if not guard.mark(ip, expiry):
+        return
+    share_hostile(ip, expiry)
+    logger.warning(f"Hostile IP {ip}: {ip_count} blocked attempts in {int(guard.ip_counts.window)}s")
+    # The one summary for this IP; later attempts are answered silently.
+    sender.alert(
+        ("hostile", ip),
+        f"🛑 <b>HOSTILE IP</b>\n\n🌐 <code>{escape(ip)}</code>\n"
+        f"📈 ~{ip_count} blocked attempts in {int(guard.ip_counts.window)}s, "
+        f"~{pair_count} on 🏢 <b>{escape(server_name)}</b>\n"
+        f"⏳ Throttled for {guard.ttl // 60}m: no more alerts, 1 in {guard.sample} attempts kept in history.",
+        reply_markup=approve_markup(ip), ip=ip
+    )
+
+def approve_markup(ip):
+    # Plain Bot API markup: aiogram validates it at send time, so this path
+    # never needs aiogram imported. Offers the address and its enclosing
+    # /24 and /16 (/64 and /48 for IPv6).
+    try:
+        prefixes = (24, 16) if ipaddress.ip_address(ip).version == 4 else (64, 48)
+    except ValueError:
+        prefixes = ()
+    rows = [[{"text": f"✅ Allow {ip} (1h)", "callback_data": f"allow_{ip}"}]]
+    if prefixes:
+        rows.append([{"text": f"✅ /{p} (1h)", "callback_data": f"allow_{ip}/{p}"} for p in prefixes])
+    return {"inline_keyboard": rows}
+
+def is_admin_request(request):
+    key = request.headers.get("X-Guard-Admin-Key")
+    auth = request.headers.get("Authorization", "")
+    if key is None and auth.startswith("Bearer "):
+        key = auth[7:]
+    return bool(ADMIN_API_KEY) and key is not None and secrets.compare_digest(key, ADMIN_API_KEY)
+
+def int_param(request, name):
+    value = request.query.get(name)
+    return int(value) if value is not None else None
+
+async def handle_search(request):
+    if not is_admin_request(request):
+        return web.json_response({"status": "unauthorized"}, status=401)
+    try:
+        rows, next_cursor = await commands.search(
+            text=request.query.get("q"),
+            server_id=int_param(request, "server_id"),
+            user=request.query.get("user"),
+            ip=request.query.get("ip"),
+            since=int_param(request, "since"),
+            until=int_param(request, "until"),
+            cursor=int_param(request, "cursor"),
+            limit=int_param(request, "limit") or audit.PAGE_SIZE,
+        )
+    except ValueError:
+        return web.json_response({"status": "error", "msg": "bad_params"}, status=400)
+    results = []
+    for r in rows:
+        # Commands are not stored enriched; repeat IPs come from the LRU.
+        country, asn, org = geo.lookup(r[4])
+        results.append({"id": r[0], "server_id": r[1], "server": r[2], "user": r[3], "ip": r[4], "cmd": r[5],
+                        "timestamp": r[6], "country": country, "asn": asn, "org": org})
+    return web.json_response({"results": results, "next_cursor": next_cursor})
+
+async def handle_history(request):
+    if not is_admin_request(request):
+        return web.json_response({"status": "unauthorized"}, status=401)
+    filters = {key: request.query.get(key) for key in ("ip", "user", "status")}
     try:
-        await call.message.edit_text(f"✅ <b>Access Granted</b>\n🌐 {ip} (1h)")
-    except: pass
+        filters.update(server_id=int_param(request, "server_id"),
+                       since=int_param(request, "since"),
+                       until=int_param(request, "until"))
+        rows, newer, older = await history.page(
+            db, filters,
+            cursor=request.query.get("cursor"),
+            direction=request.query.get("direction", "older"),
+            limit=int_param(request, "limit") or history.PAGE_SIZE,
+        )
+    except ValueError:
+        return web.json_response({"status": "error", "msg": "bad_params"}, status=400)
+    results = [
+        {"id": r[0], "server_id": r[1], "server": servers.name(r[1]), "ip": r[2],
+         "user": r[3], "status": r[4], "timestamp": r[5],
+         # Rows past raw retention are hourly rollups: timestamp is the hour.
+         "count": r[6] or 1, "rollup": history.is_rollup(r),
+         "country": r[7], "asn": r[8], "org": r[9]}
+        for r in rows
+    ]
+    return web.json_response({"results": results, "newer_cursor": newer, "older_cursor": older})
+
+async def handle_metrics(request):
+    if not is_admin_request(request):
+        return web.json_response({"status": "unauthorized"}, status=401)
+    return web.Response(text=metrics.render(), headers={"Content-Type": metrics.CONTENT_TYPE})
+
+async def handle_profile(request):
+    # GET /debug/profile?seconds=10[&interval=0.005][&threads=1][&format=json]
+    # Samples the worker that answers for `seconds` and returns collapsed
+    # stacks for flamegraph.pl/speedscope, or JSON with the per-coroutine
+    # breakdown of loop time as well. sampler.profile refuses nan/inf (400)
+    # and clamps seconds/interval to the /profile command's limits.
+    if not is_admin_request(request):
+        return web.json_response({"status": "unauthorized"}, status=401)
+    try:
+        seconds = float(request.query.get("seconds", 10))
+        interval = float(request.query.get("interval", profiler.PROFILE_INTERVAL))
+        profile = await sampler.profile(seconds, interval, threads=request.query.get("threads") == "1")
+    except ValueError:
+        return web.json_response({"status": "error", "msg": "bad_params"}, status=400)
+    except RuntimeError:
+        return web.json_response({"status": "error", "msg": "profile_running"}, status=409)
+    if request.query.get("format") == "json":
+        return web.json_response({
+            "worker": workers.WORKER_INDEX, "samples": profile.samples, "seconds": profile.seconds,
+            "tasks": [{"name": name, "seconds": seconds, "share": share}
+                      for name, seconds, share in profile.attribution()],
+            "stacks": dict(profile.stacks),
+        })
+    filename = f"serverguard-{workers.WORKER_INDEX}-{int(time.time())}.folded"
+    return web.Response(text=profile.collapsed(),
+                        headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+async def handle_events(request):
+    # GET /events: check-access decisions and agent commands as they happen,
+    # as SSE, or over a WebSocket when the request asks to upgrade. Resumes
+    # after Last-Event-ID (?last_id= for WebSocket clients); ?backlog=N
+    # replays recent events first; filters are livestream.FILTERS.
+    if not is_admin_request(request):
+        return web.json_response({"status": "unauthorized"}, status=401)
+    try:
+        match = livestream.matcher(request.query)
+        last_id = request.headers.get("Last-Event-ID") or request.query.get("last_id")
+        last_id = int(last_id) if last_id else None
+        backlog = int_param(request, "backlog") or 0
+    except ValueError:
+        return web.json_response({"status": "error", "msg": "bad_params"}, status=400)
+    if request.headers.get("Upgrade", "").lower() == "websocket":
+        return await livestream.serve_websocket(events, request, last_id, backlog, match)
+    return await livestream.serve_sse(events, request, last_id, backlog, match)
+
+async def handle_sessions(request):
+    # Sessions (server, user, source IP) active within STREAM_SESSION_IDLE,
+    # most recent first; /sessions/<id> adds its latest events.
+    if not is_admin_request(request):
+        return web.json_response({"status": "unauthorized"}, status=401)
+    try:
+        session_id = request.match_info.get("session_id")
+        limit = int_param(request, "limit") or 100
+        if session_id is None:
+            return web.json_response({"sessions": events.active_sessions(limit=limit)})
+        session = events.session(int(session_id))
+    except ValueError:
+        return web.json_response({"status": "error", "msg": "bad_params"}, status=400)
+    if session is None:
+        return web.json_response({"status": "not_found"}, status=404)
+    return web.json_response(dict(session.summary(), events=list(session.events)))
+
+async def handle_healthz(request):
+    return web.json_response({"status": "ok"})
+
+async def handle_readyz(request):
+    ready = readiness["serving"] and not shutdown.is_set()
+    body = dict(readiness, status="ready" if ready else "starting", worker=workers.WORKER_INDEX)
+    return web.json_response(body, status=200 if ready else 503)
+
+def without(stats, *keys):
+    return lambda: {k: v for k, v in stats.items() if k not in keys}
+
+def register_metrics():
+    metrics.expose_stats("sg_udp_ingest_total", "UDP log pipeline events", ingest.stats, "event")
+    metrics.expose_value("sg_udp_buffer_depth", "Datagrams waiting in the UDP ring buffer", lambda: len(ingest.buffer))
+    metrics.expose_value("sg_udp_kernel_drops", "Datagrams the kernel dropped because the socket receive buffer was full",
+                         ingest.kernel_drops)
+    metrics.expose_value("sg_udp_receive_buffer_bytes", "UDP socket receive buffer granted by the kernel",
+                         lambda: ingest.rcvbuf or 0)
+    metrics.expose_stats("sg_journal_total", "Write-behind journal events", without(journal.stats, "max_depth"),
+                         "event", const_labels={"journal": "history"})
+    metrics.expose_stats("sg_commands_journal_total", "Write-behind journal events",
+                         without(commands.journal.stats, "max_depth"), "event", const_labels={"journal": "commands"})
+    metrics.expose_value("sg_history_queue_depth", "Rows waiting in the history journal", journal.queue.qsize)
+    metrics.expose_value("sg_commands_queue_depth", "Rows waiting in the commands journal", commands.journal.queue.qsize)
+    metrics.expose_stats("sg_telegram_total", "Outbound Telegram dispatcher events", sender.stats, "event")
+    metrics.expose_value("sg_telegram_queue_depth", "Messages waiting in the dispatcher", lambda: len(sender.heap))
+    metrics.expose_stats("sg_retention_total", "History retention events", retention.stats, "event")
+    metrics.expose_stats("sg_bruteforce_total", "Brute-force guard events", guard.stats, "event")
+    metrics.expose_value("sg_hostile_ips", "IPs currently marked hostile", lambda: len(guard.hostile))
+    metrics.expose_value("sg_servers", "Registered agent tokens", lambda: len(servers.by_token))
+    metrics.expose_value("sg_allowlist_entries", "Allowlist entries held in memory", lambda: len(allowlist.expiry))
+    metrics.expose_stats("sg_heartbeat_total", "Agent heartbeat tracker events", heartbeats.stats, "event")
+    metrics.expose_value("sg_agents_online", "Agents heard from within the offline timeout",
+                         lambda: heartbeats.counts()[0])
+    metrics.expose_value("sg_agents_offline", "Agents silent for longer than the offline timeout",
+                         lambda: heartbeats.counts()[1])
+    metrics.expose_stats("sg_loop_watchdog_total", "Event loop stalls over the watchdog threshold",
+                         watchdog.stats, "event")
+    metrics.expose_value("sg_loop_longest_stall_seconds", "Longest event loop stall since start",
+                         lambda: watchdog.longest)
+    metrics.expose_stats("sg_event_stream_total", "Live event stream events", events.stats, "event")
+    metrics.expose_value("sg_event_stream_subscribers", "Clients connected to /events in this process",
+                         lambda: len(events.subscribers))
+    metrics.expose_value("sg_event_stream_sessions", "Sessions tracked for /sessions", lambda: len(events.sessions))
+    metrics.expose_stats("sg_geoip_lookups_total", "GeoIP cache and lookup events", geo.stats, "event")
+    metrics.expose_value("sg_geoip_cache_entries", "Addresses held in the GeoIP LRU", lambda: len(geo.cache))
+    metrics.expose_stats("sg_ssh_pool_total", "Pooled fleet SSH connection events", pool.stats, "event")
+    metrics.expose_value("sg_ssh_pool_connections", "Open pooled fleet SSH connections", lambda: len(pool.conns))
+    metrics.expose_stats("sg_allowlist_sync_total", "Allowlist snapshots served to agents", feed.stats, "kind")
+    metrics.expose_value("sg_allowlist_version", "Newest allowlist version held by this process",
+                         lambda: allowlist.version)
+    metrics.expose_value("sg_allowlist_prefixes", "CIDR entries indexed in the prefix tries",
+                         lambda: sum(trie.size for trie in allowlist.tries.values()))
+    metrics.expose_value("sg_worker_index", "Index of the process that served this scrape", lambda: workers.WORKER_INDEX)
 
 class UDPLogProtocol(asyncio.DatagramProtocol):
     def connection_made(self, transport):
         self.transport = transport
 
     def datagram_received(self, data, addr):
-        try:
-            payload = json.loads(data.decode())
-            if payload.get("token") == "local-token" or payload.get("token"):
-                 asyncio.create_task(self.process_log(payload))
-        except Exception:
-            pass
+        ingest.feed(data, addr)
 
-    async def process_log(self, data):
+    async def process_log(self, server, data):
         log_type = data.get("type", "info")
         user = data.get("user", "?")
         ip = data.get("ip", "?")
         cmd = data.get("cmd", "")
+        # sg-agentd batches records, so it stamps each one when it happened.
+        ts = data.get("ts")
+        ts = ts if isinstance(ts, int) else None
         if log_type == "cmd" and cmd:
-            msg = f"💻 <b>CMD</b>: <code>{cmd}</code>\n👤 {user} | 🌐 {ip}"
-            try:
-                await bot.send_message(chat_id=ADMIN_ID, text=msg)
-            except: pass
+            await commands.record(server[0], user, ip, cmd, ts)
+            header = f"💻 <b>CMD</b> 🏢 <b>{escape(server[1])}</b>\n👤 {escape(user)} | 🌐 {escape(ip)}"
+            sender.cmd_log((server[0], user, ip), header, f"<code>{escape(cmd)}</code>", ip=ip)
+            events.emit({"type": "cmd", "ts": ts or round(time.time(), 3), "server_id": server[0],
+                         "server": server[1], "user": user, "ip": ip, "cmd": cmd})
+        elif log_type == "heartbeat":
+            heartbeats.seen(server[0], info={"bundle": data.get("bundle", ""), "synced": data.get("synced", 0)})
+        elif log_type == "access" and data.get("status") == "ALLOWED":
+            # A login the agent admitted from its allowlist copy. Only the
+            # agent holds its sync key, so unsigned records are forgeries.
+            if not feed.verify_access(data.get("token"), ip, user, ts, data.get("sig")):
+                RESULT_FORGED.inc()
+                logger.warning(f"Dropped unverified agent access record for {user}@{ip} ({server[1]})")
+                return
+            await log_attempt(server[0], ip, user, "ALLOWED", ts)
+            stream_check(server, ip, user, "ALLOWED", via="agent", ts=ts)
+            RESULT_AGENT.inc()
+
+# --- Agent Heartbeats ---
+AGENT_ALERT_LINES = 20
+
+def server_label(server_id):
+    name = escape(servers.name(server_id) or f"#{server_id}")
+    address = servers.address(server_id)
+    return f"{name} (<code>{escape(address)}</code>)" if address else name
+
+def report_agents(went, back):
+    # HeartbeatTracker.on_change: one message per alert window, however
+    # many agents changed state in it.
+    now = time.time()
+    lines = []
+    if went:
+        lines.append(f"🔴 <b>{len(went)} agent{'s' if len(went) != 1 else ''} offline</b>")
+        for server_id in went[:AGENT_ALERT_LINES]:
+            silent = heartbeat.format_age(now - heartbeats.offline.get(server_id, now))
+            lines.append(f"• {server_label(server_id)}, silent {silent}")
+        if len(went) > AGENT_ALERT_LINES:
+            lines.append(f"… and {len(went) - AGENT_ALERT_LINES} more")
+    if back:
+        names = ", ".join(server_label(s) for s in back[:AGENT_ALERT_LINES])
+        more = f" and {len(back) - AGENT_ALERT_LINES} more" if len(back) > AGENT_ALERT_LINES else ""
+        lines.append(f"🟢 <b>{len(back)} back online:</b> {names}{more}")
+    sender.send("\n".join(lines), priority=ALERT if went else NOTICE)
+
+# --- Worker IPC ---
+def publish(message):
+    # Leader -> followers: keep every process's in-memory indexes in sync.
+    if ipc_server is not None:
+        ipc_server.broadcast(message)
+
+def share_hostile(ip, expiry):
+    # Followers hand the mark to the leader, which applies it and
+    # re-broadcasts to every worker.
+    message = {"op": "hostile", "ip": ip, "expiry": expiry}
+    if ipc_client is not None:
+        ipc_client.send(message)
+    publish(message)
+
+async def on_follower_message(msg):
+    op = msg.get("op")
+    if op == "hostile":
+        guard.mark(msg["ip"], msg["expiry"])
+        publish(msg)
+    elif op == "alert":
+        sender.alert(tuple(msg["key"]), msg["text"], reply_markup=msg.get("markup"), ip=msg.get("ip"))
+    elif op == "cmd":
+        sender.cmd_log(tuple(msg["key"]), msg["header"], msg["line"], ip=msg.get("ip"))
+    elif op == "heartbeats":
+        for server_id, ts, info in msg["seen"]:
+            heartbeats.seen(server_id, ts, info)
+    elif op == "events":
+        for event in msg["events"]:
+            events.publish(event)
+    elif op == "stream_subscribers":
+        stream_followers[msg["worker"]] = msg["count"]
+        update_stream_relay()
+    elif op == "send":
+        sender.send(msg["text"], reply_markup=msg.get("markup"),
+                    priority=msg.get("priority") if msg.get("priority") is not None else NOTICE)
+
+async def on_leader_message(msg):
+    op = msg.get("op")
+    if op == "approve":
+        allowlist.remember(msg["ip"], msg["expiry"], msg.get("version"))
+    elif op == "revoke":
+        allowlist.forget(msg["ip"], msg["version"])
+    elif op == "server":
+        servers.put(msg["token"], msg["server"])
+    elif op == "hostile":
+        guard.mark(msg["ip"], msg["expiry"])
+    elif op == "events":
+        events.mirror(msg["events"])
+    elif op == "stream_relay":
+        events.collect = msg["collect"]
+
+def update_stream_relay():
+    # Leader: followers forward their events while anyone anywhere is
+    # subscribed, and get the numbered stream back while any of them is.
+    followers = sum(stream_followers.values())
+    events.fanout = followers > 0
+    events.collect = followers + len(events.subscribers) > 0
+    publish({"op": "stream_relay", "collect": events.collect})
+
+def on_leader_lost():
+    if not shutdown.is_set():
+        logger.error("Lost connection to leader process, shutting down worker")
+        shutdown.set()
 
 async def start_background_tasks(app):
     loop = asyncio.get_running_loop()
     transport, protocol = await loop.create_datagram_endpoint(
         lambda: UDPLogProtocol(),
-        local_addr=("0.0.0.0", UDP_PORT)
+        local_addr=("0.0.0.0", UDP_PORT),
+        reuse_port=workers.WORKERS > 1
     )
     app['udp_transport'] = transport
+    ingest.attach(transport)
+    ingest.start(protocol.process_log)
+    journal.start()
+    commands.start()
+    app['loop_lag'] = asyncio.create_task(metrics.monitor_loop_lag())
+    watchdog.start()
+    # Followers only prune their own map; the leader owns DB deletes.
+    app['allowlist_sweeper'] = asyncio.create_task(allowlist.run_sweeper(persist=workers.is_leader()))
+    if workers.is_leader():
+        retention.start()
+        heartbeats.on_change = report_agents
+        await heartbeats.load()
+        events.broadcast = lambda batch: publish({"op": "events", "events": batch})
+        events.on_subscribers = lambda count: update_stream_relay()
+    else:
+        heartbeats.forward = lambda seen: ipc_client.send({"op": "heartbeats", "seen": seen})
+        events.forward = lambda batch: ipc_client.send({"op": "events", "events": batch})
+        events.on_subscribers = lambda count: ipc_client.send(
+            {"op": "stream_subscribers", "worker": workers.WORKER_INDEX, "count": count})
+        # Also fetches the current relay state from the leader.
+        events.on_subscribers(0)
+    heartbeats.start()
+
+async def start_telegram():
+    global bot
+    # Importing aiogram costs seconds of CPU; doing it in a thread keeps the
+    # loop answering /check-access meanwhile (the GIL is released every few ms).
     try:
-        await bot.send_message(ADMIN_ID, f"🟢 <b>System Online</b>\nRunning on Port {HTTP_PORT}")
+        ui = await asyncio.to_thread(importlib.import_module, "telegram_ui")
+        bot, dp = ui.setup(sys.modules[__name__])
     except Exception as e:
-        logger.error(f"Startup Msg Failed: {e}")
-    asyncio.create_task(dp.start_polling(bot))
+        logger.error(f"Telegram bot failed to start: {e}")
+        return
+    await pool.load()
+    pool.start()
+    sender.bot = bot
+    sender.start()
+    sender.send(f"🟢 <b>System Online</b>\nRunning on Port {HTTP_PORT}")
+    readiness["telegram"] = True
+    logger.info("Telegram bot started")
+    await dp.start_polling(bot, handle_signals=False)
 
 async def cleanup_background_tasks(app):
+    readiness["serving"] = False
+    if telegram_task is not None:
+        telegram_task.cancel()
+    for name in ('allowlist_sweeper', 'loop_lag'):
+        if name in app:
+            app[name].cancel()
+    watchdog.stop()
     if 'udp_transport' in app:
         app['udp_transport'].close()
-    await bot.session.close()
+    await ingest.stop()
+    await sender.stop()
+    if bot is not None:
+        await bot.session.close()
+    await retention.stop()
+    await heartbeats.stop()
+    await pool.stop()
+    await journal.close()
+    await commands.close()
+    await db.close()
+    geo.close()
 
 async def main():
-    await init_db()
+    global sender, ipc_server, ipc_client, telegram_task
+    leader = workers.is_leader()
+    lock = supervisor = None
+    if leader and workers.WORKERS > 1:
+        lock = workers.acquire_leadership()
+    if leader:
+        await init_db()
+        if workers.WORKERS > 1:
+            ipc_server = workers.IPCServer(on_follower_message)
+            await ipc_server.start()
+    else:
+        # The leader creates the schema; connecting first means it is ready.
+        ipc_client = workers.IPCClient(on_leader_message, on_leader_lost)
+        await ipc_client.connect()
+        sender = workers.RemoteDispatcher(ipc_client)
+        await init_db(create=False)
+
     app = web.Application()
     app.router.add_get('/check-access', handle_check_access)
+    app.router.add_get('/allowlist', handle_allowlist)
+    app.router.add_get('/search', handle_search)
+    app.router.add_get('/history', handle_history)
+    app.router.add_get('/metrics', handle_metrics)
+    app.router.add_get('/debug/profile', handle_profile)
+    app.router.add_get('/events', handle_events)
+    app.router.add_get('/sessions', handle_sessions)
+    app.router.add_get('/sessions/{session_id}', handle_sessions)
+    app.router.add_get('/healthz', handle_healthz)
+    app.router.add_get('/readyz', handle_readyz)
+    register_metrics()
     app.on_startup.append(start_background_tasks)
     app.on_cleanup.append(cleanup_background_tasks)
     runner = web.AppRunner(app)
     await runner.setup()
-    site = web.TCPSite(runner, '0.0.0.0', HTTP_PORT)
-    print(f"ServerGuard Controller running on 0.0.0.0:{HTTP_PORT} (TCP) & {UDP_PORT} (UDP)")
+    site = web.TCPSite(runner, '0.0.0.0', HTTP_PORT, reuse_port=workers.WORKERS > 1)
+    role = f"worker {workers.WORKER_INDEX}/{workers.WORKERS}" if workers.WORKERS > 1 else "single process"
+    print(f"ServerGuard Controller running on 0.0.0.0:{HTTP_PORT} (TCP) & {UDP_PORT} (UDP), {role}")
     await site.start()
-    await asyncio.Event().wait()
+    readiness["serving"] = True
+    if leader:
+        telegram_task = asyncio.create_task(start_telegram())
+    if leader and workers.WORKERS > 1:
+        supervisor = workers.Supervisor(workers.WORKERS, os.path.abspath(__file__), os.getcwd())
+        supervisor.start()
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, shutdown.set)
+    try:
+        await shutdown.wait()
+    finally:
+        if supervisor is not None:
+            await supervisor.stop()
+        # Release long-polling agents; they get a 304 and reconnect elsewhere.
+        allowlist.changed.set()
+        # End /events subscriptions so the runner need not wait them out.
+        events.close()
+        # Runs on_cleanup: flushes journals and the outbound queue before exit.
+        await runner.cleanup()
+        if ipc_server is not None:
+            await ipc_server.stop()
+        if ipc_client is not None:
+            await ipc_client.close()
+        if lock is not None:
+            lock.close()
 
 if __name__ == "__main__":
     try:
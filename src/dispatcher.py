@@ -0,0 +1,333 @@
+import os
+import html
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+
+import metrics
+
+logger = logging.getLogger("ServerGuard.dispatcher")
+
+# --- Priorities (lower is sent first) ---
+ALERT = 0
+NOTICE = 1
+CMD = 2
+
+# --- Configuration ---
+# Telegram allows roughly one message per second into a single chat with
+# short bursts; 429 responses pause the bucket for retry_after seconds.
+SEND_RATE = float(os.getenv("TG_SEND_RATE", "1"))
+SEND_BURST = int(os.getenv("TG_SEND_BURST", "5"))
+DIGEST_WINDOW = float(os.getenv("TG_DIGEST_WINDOW", "3"))
+ALERT_COOLDOWN = float(os.getenv("TG_ALERT_COOLDOWN", "30"))
+# At one message per second anything beyond this is minutes stale; when
+# full, the least important queued message is dropped (see _shed).
+QUEUE_MAX = int(os.getenv("TG_QUEUE_MAX", "300"))
+DIGEST_MAX_LINES = 40
+MESSAGE_LIMIT = 4000
+NETWORK_RETRIES = 3
+DRAIN_TIMEOUT = 5
+
+SEND_SECONDS = metrics.histogram("sg_telegram_send_seconds", "Bot API sendMessage latency", ("outcome",))
+SEND_OK = SEND_SECONDS.labels("ok")
+SEND_ERROR = SEND_SECONDS.labels("error")
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+
+    def pause(self, seconds):
+        self.blocked_until = time.monotonic() + seconds
+        self.tokens = 0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+                continue
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Outgoing:
+    __slots__ = ("priority", "text", "reply_markup", "key", "count", "attempts", "ip", "note")
+
+    def __init__(self, priority, text, reply_markup=None, key=None, count=1, ip=None):
+        self.priority = priority
+        self.text = text
+        self.reply_markup = reply_markup
+        self.key = key
+        self.count = count
+        self.attempts = 0
+        self.ip = ip
+        self.note = None
+
+    def render(self):
+        text = f"{self.text}\n{self.note}" if self.note else self.text
+        if self.count > 1:
+            return f"{text}\n🔁 Repeated {self.count}×"
+        return text
+
+
+class TelegramDispatcher:
+    # Single outbound path to the admin chat. Callers enqueue and return at
+    # once; one sender task drains the queue under the token bucket.
+    def __init__(self, bot, chat_id, rate=SEND_RATE, burst=SEND_BURST,
+                 digest_window=DIGEST_WINDOW, alert_cooldown=ALERT_COOLDOWN, queue_max=QUEUE_MAX):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.bucket = TokenBucket(rate, burst)
+        self.digest_window = digest_window
+        self.alert_cooldown = alert_cooldown
+        self.queue_max = queue_max
+        self.heap = []
+        # Drops not yet reported to the chat.
+        self.unreported = 0
+        self.seq = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.pending_alerts = {}
+        self.alert_sent_at = {}
+        # Repeats inside a key's cooldown: key -> [count, text, reply_markup,
+        # ip, timer]; the timer sends them as one follow-up when it ends.
+        self.suppressed = {}
+        # One digest window for all command sessions: (server, user, ip) ->
+        # (header, lines, ip), sent together when the window closes.
+        self.digests = {}
+        self.digest_lines = 0
+        self.digest_timer = None
+        self.task = None
+        self.busy = False
+        # Optional annotate(ip) -> extra line (e.g. GeoIP). Called when a
+        # message is sent or a digest flushed, never from alert()/cmd_log(),
+        # so callers on the request path pay nothing for it.
+        self.annotate = None
+        self.stats = {
+            "sent": 0,
+            "failed": 0,
+            "retry_after": 0,
+            "alerts_collapsed": 0,
+            "cmds_merged": 0,
+            "dropped": 0,
+        }
+
+    def _push(self, msg):
+        if len(self.heap) >= self.queue_max and not self._shed(msg):
+            return
+        heapq.heappush(self.heap, (msg.priority, next(self.seq), msg))
+        self.wakeup.set()
+
+    def _shed(self, msg):
+        # Queue full: drop the newest message of the lowest priority, so
+        # digests go before notices and notices before alerts. Returns
+        # False when that is msg itself.
+        victim = msg
+        if msg.priority < CMD:
+            worst = max(range(len(self.heap)), key=lambda i: self.heap[i][:2])
+            priority, _, queued = self.heap[worst]
+            if msg.priority < priority:
+                victim = queued
+        if victim is not msg:
+            self.heap[worst] = self.heap[-1]
+            self.heap.pop()
+            heapq.heapify(self.heap)
+        if victim.key is not None and self.pending_alerts.get(victim.key) is victim:
+            del self.pending_alerts[victim.key]
+        if not self.unreported:
+            logger.warning(f"Telegram queue full ({self.queue_max} messages), dropping the least important")
+        self.unreported += 1
+        self.stats["dropped"] += 1
+        return victim is not msg
+
+    def send(self, text, reply_markup=None, priority=NOTICE):
+        self._push(Outgoing(priority, text, reply_markup))
+
+    def alert(self, key, text, reply_markup=None, ip=None):
+        pending = self.pending_alerts.get(key)
+        if pending is not None:
+            pending.count += 1
+            self.stats["alerts_collapsed"] += 1
+            return
+        sent_at = self.alert_sent_at.get(key)
+        if sent_at is not None and time.monotonic() - sent_at < self.alert_cooldown:
+            self._suppress(key, sent_at + self.alert_cooldown, text, reply_markup, ip)
+            return
+        count = 1
+        entry = self.suppressed.pop(key, None)
+        if entry is not None:
+            # Cooldown just ended but its follow-up has not run yet.
+            entry[4].cancel()
+            count += entry[0]
+        msg = Outgoing(ALERT, text, reply_markup, key=key, count=count, ip=ip)
+        self.pending_alerts[key] = msg
+        self._push(msg)
+
+    def _suppress(self, key, until, text, reply_markup, ip):
+        self.stats["alerts_collapsed"] += 1
+        entry = self.suppressed.get(key)
+        if entry is not None:
+            entry[0] += 1
+            entry[1:4] = text, reply_markup, ip
+            return
+        loop = asyncio.get_running_loop()
+        timer = loop.call_later(max(0, until - time.monotonic()), self._follow_up, key)
+        self.suppressed[key] = [1, text, reply_markup, ip, timer]
+
+    def _follow_up(self, key):
+        count, text, reply_markup, ip, _ = self.suppressed.pop(key)
+        pending = self.pending_alerts.get(key)
+        if pending is not None:
+            pending.count += count
+            return
+        # The latest suppressed alert, with how often it repeated; sending
+        # it starts a new cooldown for the key.
+        msg = Outgoing(ALERT, text, reply_markup, key=key, count=count, ip=ip)
+        self.pending_alerts[key] = msg
+        self._push(msg)
+
+    def cmd_log(self, key, header, line, ip=None):
+        entry = self.digests.get(key)
+        if entry is None:
+            entry = self.digests[key] = (header, [], ip)
+            if self.digest_timer is None:
+                loop = asyncio.get_running_loop()
+                self.digest_timer = loop.call_later(self.digest_window, self._flush_digests)
+        else:
+            self.stats["cmds_merged"] += 1
+        entry[1].append(line)
+        self.digest_lines += 1
+        if self.digest_lines >= DIGEST_MAX_LINES:
+            self._flush_digests()
+
+    def _flush_digests(self):
+        # One section per session, split only where a message would get too long.
+        if self.digest_timer is not None:
+            self.digest_timer.cancel()
+            self.digest_timer = None
+        digests, self.digests = self.digests, {}
+        self.digest_lines = 0
+        if len(self.heap) >= self.queue_max:
+            # Digests are the first thing _shed drops anyway.
+            self._shed(Outgoing(CMD, None))
+            return
+        text = ""
+        for header, lines, ip in digests.values():
+            note = self._note(ip)
+            if note:
+                header = f"{header}\n{note}"
+            if text and len(text) + len(header) + 2 > MESSAGE_LIMIT:
+                self._push(Outgoing(CMD, text))
+                text = ""
+            text = f"{text}\n\n{header}" if text else header
+            for line in lines:
+                if len(text) + len(line) + 1 > MESSAGE_LIMIT:
+                    self._push(Outgoing(CMD, text))
+                    text = header
+                text += "\n" + line
+        if text:
+            self._push(Outgoing(CMD, text))
+
+    def _note(self, ip):
+        if ip is None or self.annotate is None:
+            return None
+        try:
+            return self.annotate(ip)
+        except Exception as e:
+            logger.error(f"Message annotation failed for {ip}: {e}")
+            return None
+
+    def _forget_old_alerts(self):
+        cutoff = time.monotonic() - self.alert_cooldown
+        for key in [k for k, t in self.alert_sent_at.items() if t < cutoff]:
+            del self.alert_sent_at[key]
+
+    async def _deliver(self, msg):
+        # aiogram is loaded by the time anything is delivered; importing it
+        # here keeps it out of the controller's startup path.
+        from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError
+        if msg.key is not None:
+            # Repeats that arrive after this point start a new alert.
+            self.pending_alerts.pop(msg.key, None)
+            self.alert_sent_at[msg.key] = time.monotonic()
+            if len(self.alert_sent_at) > 4096:
+                self._forget_old_alerts()
+        if msg.ip is not None and msg.note is None:
+            msg.note = self._note(msg.ip)
+        started = time.perf_counter()
+        try:
+            await self.bot.send_message(chat_id=self.chat_id, text=msg.render(), reply_markup=msg.reply_markup)
+            SEND_OK.observe(time.perf_counter() - started)
+            self.stats["sent"] += 1
+        except TelegramRetryAfter as e:
+            SEND_ERROR.observe(time.perf_counter() - started)
+            self.stats["retry_after"] += 1
+            logger.warning(f"Telegram flood control: retry after {e.retry_after}s")
+            self.bucket.pause(e.retry_after)
+            if msg.key is not None:
+                self.pending_alerts.setdefault(msg.key, msg)
+            self._push(msg)
+        except TelegramNetworkError as e:
+            SEND_ERROR.observe(time.perf_counter() - started)
+            msg.attempts += 1
+            if msg.attempts < NETWORK_RETRIES:
+                self._push(msg)
+            else:
+                self.stats["failed"] += 1
+                logger.error(f"Failed to send message after {msg.attempts} attempts: {e}")
+        except Exception as e:
+            SEND_ERROR.observe(time.perf_counter() - started)
+            self.stats["failed"] += 1
+            logger.error(f"Failed to send message: {e}")
+
+    async def run(self):
+        while True:
+            if not self.heap:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            await self.bucket.acquire()
+            # Pop after waiting so a BLOCKED alert queued meanwhile goes first.
+            _, _, msg = heapq.heappop(self.heap)
+            self.busy = True
+            try:
+                await self._deliver(msg)
+            finally:
+                self.busy = False
+            if self.unreported and len(self.heap) < self.queue_max // 2:
+                self.send(f"⚠️ {self.unreported} Telegram messages were dropped while the queue was full")
+                self.unreported = 0
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self, timeout=DRAIN_TIMEOUT):
+        self._flush_digests()
+        for entry in self.suppressed.values():
+            entry[4].cancel()
+        self.suppressed.clear()
+        if self.task is None:
+            return
+        deadline = time.monotonic() + timeout
+        while (self.heap or self.busy) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        self.task = None
+        if self.heap:
+            logger.warning(f"Dispatcher stopped with {len(self.heap)} unsent messages")
+
+
+def escape(text):
+    return html.escape(str(text), quote=False)
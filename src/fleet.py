@@ -0,0 +1,228 @@
+import io
+import os
+import time
+import shlex
+import asyncio
+import hashlib
+import logging
+import tarfile
+
+logger = logging.getLogger("ServerGuard.fleet")
+
+# --- Configuration ---
+CONCURRENCY = int(os.getenv("FLEET_CONCURRENCY", "20"))
+HASH_FILE = "/etc/server-guard/bundle.sha256"
+# Comment on the authorized_keys line holding the controller's fleet key, so
+# a redeploy without fleet access (or an uninstall) can find and remove it.
+FLEET_MARK = "serverguard-fleet"
+
+AGENT_FILES = (
+    ("scripts/check_access.sh", "sg-check-access"),
+    ("scripts/sftp_wrapper.sh", "sg-sftp-wrapper"),
+    ("scripts/logger.sh", "sg-logger"),
+    ("scripts/agentd.py", "sg-agentd"),
+    ("scripts/agent_installer.sh", "agent_installer.sh"),
+)
+
+
+class AgentBundle:
+    def __init__(self, data, digest):
+        self.data = data
+        self.digest = digest
+
+
+_bundle_cache = {}
+
+
+def build_bundle(files=AGENT_FILES):
+    # One gzip'd tarball per script revision; rebuilt only when a file changes.
+    paths = [(os.path.abspath(local), remote) for local, remote in files]
+    for path, _ in paths:
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Missing local file: {path}")
+    key = tuple((path, os.stat(path).st_mtime_ns) for path, _ in paths)
+    if key in _bundle_cache:
+        return _bundle_cache[key]
+
+    digest = hashlib.sha256()
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:gz") as tar:
+        for path, remote in paths:
+            with open(path, "rb") as f:
+                content = f.read()
+            digest.update(remote.encode() + b"\0" + content)
+            info = tarfile.TarInfo(remote)
+            info.size = len(content)
+            info.mode = 0o755
+            info.mtime = 0
+            tar.addfile(info, io.BytesIO(content))
+    _bundle_cache.clear()
+    _bundle_cache[key] = AgentBundle(buf.getvalue(), digest.hexdigest())
+    return _bundle_cache[key]
+
+
+def parse_hosts(text, default_port=22, default_user="root"):
+    # One host per line: "ip", "ip:port" or "user@ip:port"; '#' starts a comment.
+    hosts = []
+    seen = set()
+    for line in text.splitlines():
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+        user = default_user
+        if "@" in line:
+            user, line = line.split("@", 1)
+        ip, port = line, default_port
+        if line.count(":") == 1:
+            ip, port_txt = line.split(":")
+            port = int(port_txt) if port_txt.isdigit() else default_port
+        if ip not in seen:
+            seen.add(ip)
+            hosts.append((ip, port, user))
+    return hosts
+
+
+def install_command(api_url, token, log_host, digest, sync_key="", fleet_key=""):
+    # The bundle arrives on stdin, so upload and install share one round trip.
+    args = " ".join(shlex.quote(a) for a in (api_url, token, log_host, digest, sync_key, fleet_key))
+    return ('set -e; d=$(mktemp -d); trap \'rm -rf "$d"\' EXIT; '
+            'tar -xzf - -C "$d"; '
+            f'"$d/agent_installer.sh" {args}')
+
+
+def authorize_command(public_key=""):
+    # Same as the installer's step, for hosts whose bundle is already current:
+    # drops any fleet key line, then adds public_key (if given) tagged FLEET_MARK.
+    command = f"sed -i '/ {FLEET_MARK}$/d' ~/.ssh/authorized_keys 2>/dev/null; "
+    if not public_key:
+        return command + "true"
+    line = shlex.quote(" ".join(public_key.split()[:2] + [FLEET_MARK]))
+    return command + f"umask 077; mkdir -p ~/.ssh; echo {line} >> ~/.ssh/authorized_keys"
+
+
+async def deploy_host(pool, ip, port, user, bundle, register, api_url, log_host,
+                      password=None, key_file=None, force=False, is_registered=None, agent_key=None,
+                      fleet_access=False):
+    # Returns (status, detail) where status is "installed", "skipped" or "failed".
+    # agent_key(token) gives the allowlist sync key, which only travels over SSH.
+    # fleet_access installs the pool's key for passwordless root SSH (the
+    # admin opts in per deploy); without it any earlier one is removed.
+    # The connection stays in `pool` (an sshpool.SSHPool) for fleet operations.
+    # A host seen for the first time has its key pinned now; a pinned host
+    # presenting another key fails the deploy (sshpool.HostKeyChanged).
+    try:
+        await pool.remember(ip, port, user, password, key_file)
+        async with pool.connection(ip, fresh=True) as conn:
+            if not force and is_registered is not None and is_registered(ip):
+                fleet_key = pool.public_key if fleet_access else ""
+                check = f"{authorize_command(fleet_key)}; cat {HASH_FILE} 2>/dev/null"
+                current = await conn.run(check, check=False)
+                if (current.stdout or "").strip() == bundle.digest:
+                    return "skipped", "bundle up to date"
+            token = await register(ip)
+            sync_key = agent_key(token) if agent_key is not None else ""
+            fleet_key = (pool.public_key or "") if fleet_access else ""
+            command = install_command(api_url, token, log_host, bundle.digest, sync_key, fleet_key)
+            result = await conn.run(command, input=bundle.data, encoding=None, check=True)
+            return "installed", result.stdout.decode(errors="replace")
+    except Exception as e:
+        logger.error(f"Deploy Error ({ip}): {e}")
+        return "failed", str(e)
+
+
+async def deploy_fleet(pool, hosts, register, api_url, log_host, password=None, key_file=None,
+                       force=False, is_registered=None, on_result=None, concurrency=CONCURRENCY,
+                       agent_key=None, fleet_access=False):
+    bundle = build_bundle()
+    sem = asyncio.Semaphore(concurrency)
+    results = {}
+
+    async def one(ip, port, user):
+        async with sem:
+            started = time.monotonic()
+            status, detail = await deploy_host(pool, ip, port, user, bundle, register, api_url, log_host,
+                                               password, key_file, force, is_registered, agent_key,
+                                               fleet_access)
+        results[ip] = (status, detail, time.monotonic() - started)
+        if on_result is not None:
+            on_result(ip, status, detail)
+
+    await asyncio.gather(*(one(*host) for host in hosts))
+    return results
+
+
+# --- Fleet operations ---
+# Run over pooled connections (sshpool.SSHPool.map) on every deployed host
+# at once; each returns {ip: (ok, result or error, seconds)}.
+
+STATUS_COMMAND = (
+    f'printf "bundle=%s\\n" "$(cat {HASH_FILE} 2>/dev/null)"; '
+    'if [ -S /run/server-guard/agentd.sock ]; then echo agentd=up; else echo agentd=down; fi; '
+    'printf "synced=%s\\n" "$(stat -c %Y /var/lib/server-guard/allowlist.json 2>/dev/null)"; '
+    'printf "load=%s\\n" "$(cut -d" " -f1 /proc/loadavg)"; '
+    'printf "sessions=%s\\n" "$(pgrep -c -f "^sshd: [^ ]+@")"'
+)
+
+# stdin: the sync key on the first line, then the new agent.env.
+PUSH_COMMAND = (
+    'set -e; { read -r key; cat > /etc/server-guard/agent.env.new; }; '
+    'chmod 644 /etc/server-guard/agent.env.new; '
+    'mv /etc/server-guard/agent.env.new /etc/server-guard/agent.env; '
+    'if [ -n "$key" ]; then (umask 077; printf "%s\\n" "$key" > /etc/server-guard/sync.key); fi; '
+    'if [ -d /run/systemd/system ]; then systemctl restart sg-agentd; '
+    'else pkill -f /usr/local/bin/sg-agentd || true; '
+    'nohup /usr/local/bin/sg-agentd >> /var/log/sg-agentd.log 2>&1 < /dev/null & fi; echo ok'
+)
+
+
+def kill_command(target):
+    # target is a normalized address or CIDR. Finds the sshd processes
+    # holding connections from it and kills them, sparing the session this
+    # command itself runs in; prints how many were killed.
+    if ":" in target:
+        address, _, length = target.partition("/")
+        target = f"[{address}]" + (f"/{length}" if length else "")
+    return (
+        'own=" "; p=$$; while [ "${p:-1}" -gt 1 ]; do own="$own$p "; p=$(ps -o ppid= -p "$p" | tr -d " "); done; '
+        f'pids=$(ss -Htnp state established dst {shlex.quote(target)} 2>/dev/null '
+        '| grep -o \'"sshd[^"]*",pid=[0-9]*\' | grep -o "[0-9]*$" | sort -u); '
+        'n=0; for pid in $pids; do case "$own" in *" $pid "*) continue;; esac; '
+        'kill -KILL "$pid" 2>/dev/null && n=$((n+1)); done; echo "$n"'
+    )
+
+
+def parse_status(text):
+    status = {}
+    for line in (text or "").splitlines():
+        key, sep, value = line.partition("=")
+        if sep:
+            status[key.strip()] = value.strip()
+    return status
+
+
+async def kill_sessions(pool, hosts, target, on_result=None):
+    command = kill_command(target)
+
+    async def op(conn, ip):
+        result = await conn.run(command, check=False)
+        return int((result.stdout or "0").strip() or 0)
+
+    return await pool.map(hosts, op, on_result=on_result)
+
+
+async def collect_status(pool, hosts, on_result=None):
+    async def op(conn, ip):
+        result = await conn.run(STATUS_COMMAND, check=False)
+        return parse_status(result.stdout)
+
+    return await pool.map(hosts, op, on_result=on_result)
+
+
+async def push_config(pool, hosts, render, on_result=None):
+    # render(ip) -> (agent.env text, sync key or "").
+    async def op(conn, ip):
+        env_text, sync_key = render(ip)
+        result = await conn.run(PUSH_COMMAND, input=f"{sync_key}\n{env_text}", check=True)
+        return (result.stdout or "").strip()
+
+    return await pool.map(hosts, op, on_result=on_result)
@@ -0,0 +1,119 @@
+import os
+import logging
+from collections import OrderedDict
+
+from dispatcher import escape
+
+logger = logging.getLogger("ServerGuard.geoip")
+
+# --- Configuration ---
+# Offline country/ASN lookups from MaxMind-format databases (GeoLite2 or
+# GeoIP2 Country/City and ASN). Files are memory-mapped, so every worker
+# shares one copy in the page cache; a missing file or a missing maxminddb
+# package only turns enrichment off.
+DATA_DIR = os.path.dirname(os.getenv("DB_PATH", "/data/guard.db"))
+COUNTRY_DB = os.getenv("GEOIP_DB", os.path.join(DATA_DIR, "GeoLite2-Country.mmdb"))
+ASN_DB = os.getenv("GEOIP_ASN_DB", os.path.join(DATA_DIR, "GeoLite2-ASN.mmdb"))
+CACHE_SIZE = int(os.getenv("GEOIP_CACHE_SIZE", "65536"))
+
+# (country ISO code, AS number, AS organization); any part may be None.
+UNKNOWN = (None, None, None)
+
+
+def flag(country):
+    # "DE" -> regional indicator pair, which clients render as a flag.
+    if not country or len(country) != 2 or not country.isalpha():
+        return ""
+    return "".join(chr(0x1F1E6 + ord(c) - ord("A")) for c in country.upper())
+
+
+def label(geo, org=True):
+    # "🇩🇪 DE · AS3320 Deutsche Telekom AG" (HTML-escaped), or "" if unknown.
+    country, asn, name = geo
+    parts = []
+    if country:
+        parts.append(f"{flag(country)} {escape(country)}".strip())
+    if asn:
+        parts.append(f"AS{asn} {escape(name)}" if org and name else f"AS{asn}")
+    return " · ".join(parts)
+
+
+class GeoIP:
+    # Lookups go through a bounded LRU keyed by address; unknown and private
+    # addresses are cached too, so repeat offenders never touch the files.
+    def __init__(self, country_db=COUNTRY_DB, asn_db=ASN_DB, cache_size=CACHE_SIZE):
+        self.paths = {"country": country_db, "asn": asn_db}
+        self.readers = {}
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "evicted": 0, "failed": 0}
+
+    def open(self):
+        # Blocking (mmap + metadata parse): run it through asyncio.to_thread.
+        paths = {kind: path for kind, path in self.paths.items() if path and os.path.exists(path)}
+        if not paths:
+            logger.info("GeoIP enrichment off: no database files found")
+            return
+        try:
+            import maxminddb
+        except ImportError:
+            logger.warning("GeoIP enrichment off: the maxminddb package is not installed")
+            return
+        for kind, path in paths.items():
+            try:
+                self.readers[kind] = maxminddb.open_database(path, maxminddb.MODE_MMAP)
+            except (OSError, ValueError) as e:
+                logger.error(f"GeoIP {kind} database unusable ({path}): {e}")
+                continue
+            meta = self.readers[kind].metadata()
+            logger.info(f"GeoIP {kind} database: {meta.database_type}, built {meta.build_epoch}")
+
+    def close(self):
+        for reader in self.readers.values():
+            reader.close()
+        self.readers.clear()
+        self.cache.clear()
+
+    @property
+    def enabled(self):
+        return bool(self.readers)
+
+    def lookup(self, ip):
+        if not self.readers:
+            return UNKNOWN
+        geo = self.cache.get(ip)
+        if geo is not None:
+            self.cache.move_to_end(ip)
+            self.stats["hits"] += 1
+            return geo
+        self.stats["misses"] += 1
+        geo = self._resolve(ip)
+        self.cache[ip] = geo
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+            self.stats["evicted"] += 1
+        return geo
+
+    def _resolve(self, ip):
+        country = asn = org = None
+        try:
+            reader = self.readers.get("country")
+            record = reader.get(ip) if reader is not None else None
+            if record:
+                # City/Country databases; fall back to where the block is registered.
+                place = record.get("country") or record.get("registered_country") or {}
+                country = place.get("iso_code")
+            reader = self.readers.get("asn")
+            record = reader.get(ip) if reader is not None else None
+            if record:
+                asn = record.get("autonomous_system_number")
+                org = record.get("autonomous_system_organization")
+        except (ValueError, TypeError):
+            # Not an address ("?", "LOCAL"), or a corrupt record.
+            self.stats["failed"] += 1
+        return (country, asn, org)
+
+    def describe(self, ip):
+        # Alert/digest annotation for the dispatcher; "" when nothing is known.
+        text = label(self.lookup(ip))
+        return f"📍 {text}" if text else ""
@@ -0,0 +1,236 @@
+import os
+import time
+import asyncio
+import logging
+
+logger = logging.getLogger("ServerGuard.heartbeat")
+
+# --- Configuration ---
+# sg-agentd sends a "heartbeat" record over the UDP log port every ~30s.
+# A server that has sent at least one and then stays silent for
+# AGENT_OFFLINE_AFTER seconds is reported offline; servers that never sent
+# one (hooks without sg-agentd) are only listed as unknown.
+OFFLINE_AFTER = float(os.getenv("AGENT_OFFLINE_AFTER", "120"))
+# last_seen reaches the servers table in one batch per interval.
+FLUSH_INTERVAL = float(os.getenv("HEARTBEAT_FLUSH_INTERVAL", "15"))
+# Changes within the window go out as one "N agents offline" message.
+ALERT_WINDOW = float(os.getenv("HEARTBEAT_ALERT_WINDOW", "10"))
+TICK = 1.0
+
+
+async def create_schema(conn):
+    async with conn.execute("PRAGMA table_info(servers)") as cursor:
+        columns = [row[1] for row in await cursor.fetchall()]
+    if "last_seen" not in columns:
+        await conn.execute("ALTER TABLE servers ADD COLUMN last_seen INTEGER")
+
+
+def format_age(seconds):
+    seconds = max(0, int(seconds))
+    for unit, size in (("d", 86400), ("h", 3600), ("m", 60)):
+        if seconds >= size:
+            return f"{seconds // size}{unit}"
+    return f"{seconds}s"
+
+
+class TimingWheel:
+    # Hierarchical timing wheel. Level 0 has `slots` buckets of one tick;
+    # a bucket on level L spans a full turn of level L-1 and is cascaded
+    # down when that turn starts. schedule() and cancel() are O(1), and
+    # advancing a tick only touches the keys due in it (plus one cascaded
+    # bucket whenever a level wraps), however many keys are waiting.
+    def __init__(self, tick=TICK, slots=64, levels=4, now=None):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+        self.spans = [slots ** level for level in range(levels + 1)]
+        self.wheels = [[set() for _ in range(slots)] for _ in range(levels)]
+        self.current = int((now if now is not None else time.time()) // tick)
+        # key -> (due tick, level, bucket)
+        self.due = {}
+
+    def __len__(self):
+        return len(self.due)
+
+    def __contains__(self, key):
+        return key in self.due
+
+    def schedule(self, key, deadline):
+        # Fires in the first advance() at or after `deadline` (seconds).
+        self.cancel(key)
+        self._place(key, max(-int(-deadline // self.tick), self.current + 1))
+
+    def cancel(self, key):
+        entry = self.due.pop(key, None)
+        if entry is not None:
+            self.wheels[entry[1]][entry[2]].discard(key)
+
+    def _place(self, key, due):
+        delta = due - self.current
+        level = 0
+        while level < self.levels - 1 and delta >= self.spans[level + 1]:
+            level += 1
+        bucket = (due // self.spans[level]) % self.slots
+        self.wheels[level][bucket].add(key)
+        self.due[key] = (due, level, bucket)
+
+    def advance(self, now):
+        # Returns the keys whose deadline has passed, oldest tick first.
+        target = int(now // self.tick)
+        expired = []
+        while self.current < target:
+            self.current += 1
+            for level in range(1, self.levels):
+                if self.current % self.spans[level]:
+                    break
+                bucket = self.wheels[level][(self.current // self.spans[level]) % self.slots]
+                keys = list(bucket)
+                bucket.clear()
+                for key in keys:
+                    self._place(key, self.due[key][0])
+            bucket = self.wheels[0][self.current % self.slots]
+            for key in list(bucket):
+                if self.due[key][0] <= self.current:
+                    bucket.discard(key)
+                    del self.due[key]
+                    expired.append(key)
+        return expired
+
+
+class HeartbeatTracker:
+    # Leader: keeps last_seen per server id, arms one wheel timer per server
+    # and re-arms it lazily, so a heartbeat is a dict write and the wheel
+    # only sees each server about once per timeout. Followers pass `forward`
+    # and just hand their sightings to the leader once a tick.
+    def __init__(self, db, timeout=OFFLINE_AFTER, flush_interval=FLUSH_INTERVAL,
+                 alert_window=ALERT_WINDOW, on_change=None, forward=None):
+        self.db = db
+        self.timeout = timeout
+        self.flush_interval = flush_interval
+        self.alert_window = alert_window
+        self.on_change = on_change
+        self.forward = forward
+        self.wheel = TimingWheel()
+        self.last_seen = {}
+        # server id -> {"bundle": ..., "synced": ...} from its last heartbeat.
+        self.info = {}
+        # server id -> last_seen when it was declared offline.
+        self.offline = {}
+        self.dirty = {}
+        self.went_offline = []
+        self.came_back = []
+        self.pending_since = None
+        self.task = None
+        self.stats = {"heartbeats": 0, "flushed": 0, "offline": 0, "recovered": 0, "forwarded": 0}
+
+    async def load(self, now=None):
+        # Silence while the controller was down is not the agents' fault:
+        # every known server gets a full timeout from now.
+        now = now or time.time()
+        rows = await self.db.fetchall("SELECT id, last_seen FROM servers WHERE last_seen IS NOT NULL")
+        for server_id, last_seen in rows:
+            self.last_seen[server_id] = last_seen
+            self.wheel.schedule(server_id, max(last_seen, now) + self.timeout)
+        logger.info(f"Heartbeat tracker loaded: {len(rows)} agents with a last-seen time")
+
+    def seen(self, server_id, ts=None, info=None):
+        # Receive time, not the agent's clock: a skewed host must not look
+        # offline. ts only comes from followers forwarding their sightings.
+        now = time.time()
+        ts = min(ts or now, now)
+        self.stats["heartbeats"] += 1
+        if info is not None:
+            self.info[server_id] = info
+        if ts <= self.last_seen.get(server_id, 0):
+            return
+        self.last_seen[server_id] = ts
+        self.dirty[server_id] = ts
+        if self.forward is not None:
+            return
+        if server_id in self.offline:
+            del self.offline[server_id]
+            self.came_back.append(server_id)
+            self.stats["recovered"] += 1
+            self._pending(now)
+        if server_id not in self.wheel:
+            self.wheel.schedule(server_id, ts + self.timeout)
+
+    def forget(self, server_id):
+        self.wheel.cancel(server_id)
+        for table in (self.last_seen, self.info, self.offline, self.dirty):
+            table.pop(server_id, None)
+
+    def _pending(self, now):
+        if self.pending_since is None:
+            self.pending_since = now
+
+    def tick(self, now=None):
+        now = now or time.time()
+        for server_id in self.wheel.advance(now):
+            last_seen = self.last_seen.get(server_id)
+            if last_seen is None:
+                continue
+            if last_seen + self.timeout > now:
+                self.wheel.schedule(server_id, last_seen + self.timeout)
+                continue
+            self.offline[server_id] = last_seen
+            self.went_offline.append(server_id)
+            self.stats["offline"] += 1
+            self._pending(now)
+        if self.pending_since is not None and now - self.pending_since >= self.alert_window:
+            # Flapping within the window cancels out.
+            went = [s for s in dict.fromkeys(self.went_offline) if s in self.offline]
+            back = [s for s in dict.fromkeys(self.came_back) if s not in self.offline]
+            self.went_offline, self.came_back, self.pending_since = [], [], None
+            if (went or back) and self.on_change is not None:
+                self.on_change(went, back)
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        rows = [(int(ts), server_id) for server_id, ts in self.dirty.items()]
+        self.dirty = {}
+        await self.db.executemany("UPDATE servers SET last_seen = ? WHERE id = ?", rows)
+        self.stats["flushed"] += len(rows)
+
+    def _forward(self):
+        if not self.dirty:
+            return
+        seen = [[server_id, ts, self.info.get(server_id)] for server_id, ts in self.dirty.items()]
+        self.dirty = {}
+        self.forward(seen)
+        self.stats["forwarded"] += len(seen)
+
+    async def run(self):
+        next_flush = time.monotonic() + self.flush_interval
+        while True:
+            await asyncio.sleep(TICK)
+            try:
+                if self.forward is not None:
+                    self._forward()
+                    continue
+                self.tick()
+                if time.monotonic() >= next_flush:
+                    next_flush = time.monotonic() + self.flush_interval
+                    await self.flush()
+            except Exception as e:
+                logger.error(f"Heartbeat tracker tick failed: {e}")
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        self.task = None
+        if self.forward is not None:
+            self._forward()
+        else:
+            await self.flush()
+
+    def counts(self):
+        # (online, offline): servers heard from and not currently offline.
+        return len(self.last_seen) - len(self.offline), len(self.offline)
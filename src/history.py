@@ -0,0 +1,177 @@
+import logging
+
+logger = logging.getLogger("ServerGuard.history")
+
+PAGE_SIZE = 10
+MAX_PAGE_SIZE = 500
+
+# Every index ends in timestamp (plus the implicit rowid), so any single
+# filter plus "ORDER BY timestamp DESC, id DESC" is one index range walk.
+INDEXES = (
+    "CREATE INDEX IF NOT EXISTS idx_history_server_time ON history (server_id, timestamp)",
+    "CREATE INDEX IF NOT EXISTS idx_history_ip_time ON history (ip, timestamp)",
+    "CREATE INDEX IF NOT EXISTS idx_history_status_time ON history (status, timestamp)",
+    "CREATE INDEX IF NOT EXISTS idx_history_user_time ON history (user, timestamp)",
+    "CREATE INDEX IF NOT EXISTS idx_history_time ON history (timestamp)",
+)
+
+# Raw rows older than the retention window are folded into one row per
+# (hour, server, ip, user, status). The table mirrors history's shape with
+# hour in place of timestamp, so the same keyset paging works on it. The key
+# columns are NOT NULL because UNIQUE treats NULLs as distinct: a NULL user
+# would get a new row on every retention pass instead of a count update
+# (retention.rollup stores missing values as 0 / '').
+ROLLUP_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS history_hourly (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        hour INTEGER NOT NULL,
+        server_id INTEGER NOT NULL DEFAULT 0,
+        ip TEXT NOT NULL DEFAULT '',
+        user TEXT NOT NULL DEFAULT '',
+        status TEXT NOT NULL DEFAULT '',
+        count INTEGER NOT NULL,
+        country TEXT,
+        asn INTEGER,
+        org TEXT,
+        UNIQUE (hour, server_id, ip, user, status)
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_hourly_server_time ON history_hourly (server_id, hour)",
+    "CREATE INDEX IF NOT EXISTS idx_hourly_ip_time ON history_hourly (ip, hour)",
+    "CREATE INDEX IF NOT EXISTS idx_hourly_status_time ON history_hourly (status, hour)",
+    "CREATE INDEX IF NOT EXISTS idx_hourly_user_time ON history_hourly (user, hour)",
+)
+
+# Tables created before the NOT NULL key columns may hold NULL-keyed
+# duplicates of one bucket; they are folded into a single row at startup.
+MERGE_NULL_KEYS = (
+    """INSERT INTO history_hourly (hour, server_id, ip, user, status, count, country, asn, org)
+       SELECT hour, coalesce(server_id, 0), coalesce(ip, ''), coalesce(user, ''), coalesce(status, ''),
+              sum(count), max(country), max(asn), max(org)
+       FROM history_hourly
+       WHERE server_id IS NULL OR ip IS NULL OR user IS NULL OR status IS NULL
+       GROUP BY 1, 2, 3, 4, 5
+       ON CONFLICT (hour, server_id, ip, user, status) DO UPDATE SET count = count + excluded.count""",
+    "DELETE FROM history_hourly WHERE server_id IS NULL OR ip IS NULL OR user IS NULL OR status IS NULL",
+)
+
+# GeoIP enrichment stored with each row (see geoip.py); NULL when unknown
+# or recorded before enrichment was configured.
+GEO_COLUMNS = (("country", "TEXT"), ("asn", "INTEGER"), ("org", "TEXT"))
+
+# Both sources return (id, server_id, ip, user, status, timestamp, count,
+# country, asn, org); count is NULL for raw rows, which is how callers tell
+# them apart.
+SOURCES = {
+    "raw": ("history", "timestamp", "id, server_id, ip, user, status, timestamp, NULL, country, asn, org"),
+    "rollup": ("history_hourly", "hour", "id, server_id, ip, user, status, hour, count, country, asn, org"),
+}
+FILTERS = ("server_id", "ip", "user", "status")
+ROLLUP_PREFIX = "h"
+
+
+async def create_schema(conn):
+    for statement in INDEXES + ROLLUP_SCHEMA:
+        await conn.execute(statement)
+    for table in ("history", "history_hourly"):
+        async with conn.execute(f"PRAGMA table_info({table})") as cursor:
+            columns = [row[1] for row in await cursor.fetchall()]
+        for name, kind in GEO_COLUMNS:
+            if name not in columns:
+                await conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {kind}")
+    async with conn.execute("SELECT 1 FROM history_hourly WHERE server_id IS NULL OR ip IS NULL "
+                            "OR user IS NULL OR status IS NULL LIMIT 1") as cursor:
+        if await cursor.fetchone() is not None:
+            logger.info("Merging NULL-keyed history_hourly rows")
+            for statement in MERGE_NULL_KEYS:
+                await conn.execute(statement)
+
+
+def geo(row):
+    return row[7:10]
+
+
+def is_rollup(row):
+    return row[6] is not None
+
+
+def encode_cursor(row):
+    prefix = ROLLUP_PREFIX if is_rollup(row) else ""
+    return f"{prefix}{row[5]}.{row[0]}"
+
+
+def decode_cursor(cursor):
+    # "ts.id" points into raw history, "hHOUR.id" into the rollups.
+    source = "rollup" if cursor.startswith(ROLLUP_PREFIX) else "raw"
+    ts, _, row_id = cursor.lstrip(ROLLUP_PREFIX).partition(".")
+    return source, (int(ts), int(row_id))
+
+
+def build_query(filters, cursor=None, direction="older", limit=PAGE_SIZE, source="raw"):
+    # Keyset pagination on (timestamp, id). "older" walks back from the
+    # cursor, "newer" walks forward and the caller reverses the page.
+    table, ts, columns = SOURCES[source]
+    clauses, params = [], []
+    for column in FILTERS:
+        value = filters.get(column)
+        if value is not None:
+            clauses.append(f"{column} = ?")
+            params.append(value)
+    if filters.get("since") is not None:
+        clauses.append(f"{ts} >= ?")
+        params.append(int(filters["since"]))
+    if filters.get("until") is not None:
+        clauses.append(f"{ts} < ?")
+        params.append(int(filters["until"]))
+    if cursor is not None:
+        clauses.append(f"({ts}, id) < (?, ?)" if direction == "older" else f"({ts}, id) > (?, ?)")
+        params.extend(cursor)
+    order = "DESC" if direction == "older" else "ASC"
+    where = " AND ".join(clauses) or "1"
+    sql = (f"SELECT {columns} FROM {table} WHERE {where} "
+           f"ORDER BY {ts} {order}, id {order} LIMIT ?")
+    return sql, params + [limit + 1]
+
+
+def shape_page(rows, cursor, direction, limit):
+    # Returns (rows newest first, newer_cursor, older_cursor).
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if direction == "newer":
+        rows.reverse()
+        newer = encode_cursor(rows[0]) if more and rows else None
+        older = encode_cursor(rows[-1]) if rows else cursor
+    else:
+        newer = encode_cursor(rows[0]) if cursor is not None and rows else None
+        older = encode_cursor(rows[-1]) if more else None
+    return rows, newer, older
+
+
+def plan(filters=None, cursor=None, direction="older", limit=PAGE_SIZE):
+    # Raw rows are always newer than the rollups, so paging older runs off
+    # the end of history into history_hourly (and newer the other way)
+    # without the caller knowing where retention cut the table. Yields
+    # (sql, params) and expects each query's rows sent back; returns what
+    # shape_page does. page() drives it on Storage, manager.py on sqlite3.
+    if direction not in ("older", "newer"):
+        raise ValueError(f"Unknown direction: {direction}")
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+    filters = filters or {}
+    source, key = decode_cursor(cursor) if cursor is not None else ("raw", None)
+    order = ("raw", "rollup") if direction == "older" else ("rollup", "raw")
+    rows = []
+    for source in order[order.index(source):]:
+        rows.extend((yield build_query(filters, key, direction, limit - len(rows), source)))
+        if len(rows) > limit:
+            break
+        key = None
+    return shape_page(rows, cursor, direction, limit)
+
+
+async def page(db, filters=None, cursor=None, direction="older", limit=PAGE_SIZE):
+    steps = plan(filters, cursor, direction, limit)
+    try:
+        sql, params = next(steps)
+        while True:
+            sql, params = steps.send(await db.fetchall(sql, params))
+    except StopIteration as done:
+        return done.value
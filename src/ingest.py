@@ -0,0 +1,213 @@
+import os
+import sys
+import json
+import socket
+import asyncio
+import logging
+from collections import deque
+
+logger = logging.getLogger("ServerGuard.ingest")
+
+# --- Configuration ---
+BUFFER_SIZE = int(os.getenv("UDP_BUFFER_SIZE", "65536"))
+WORKERS = int(os.getenv("UDP_WORKERS", "4"))
+BATCH_SIZE = int(os.getenv("UDP_BATCH_SIZE", "256"))
+# "drop_oldest" keeps the freshest datagrams when the ring is full,
+# "drop_newest" keeps what is already queued and rejects new arrivals.
+OVERFLOW = os.getenv("UDP_OVERFLOW", "drop_oldest")
+# The kernel silently caps this at net.core.rmem_max (often 208 KiB), which
+# only the host can raise; see README.
+SOCKET_RCVBUF = 4 * 1024 * 1024
+# Per-socket "drops" column: datagrams lost because the buffer was full.
+UDP_TABLES = ("/proc/net/udp", "/proc/net/udp6")
+
+# Tokenless records are only Master Node's own logging, so they are taken
+# from loopback senders alone; from anywhere else they are unauthorized.
+MISSING_TOKENS = (None, "", "None", "null")
+# Accepted types per record field. Records come from an unauthenticated
+# socket, so anything else (a list token, a dict user) rejects the record
+# before it reaches a dict lookup, a handler or a journal row.
+RECORD_FIELDS = {"token": str, "type": str, "user": str, "ip": str, "cmd": str,
+                 "status": str, "sig": str, "bundle": str, "ts": (int, float), "synced": int}
+
+
+def tune_socket(transport, rcvbuf=SOCKET_RCVBUF):
+    # Returns the receive buffer size the kernel actually granted.
+    sock = transport.get_extra_info("socket")
+    if sock is None:
+        return None
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    except OSError as e:
+        logger.warning(f"Could not raise UDP receive buffer: {e}")
+    granted = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+    if sys.platform.startswith("linux"):
+        # Linux reports twice the size it granted (bookkeeping overhead).
+        granted //= 2
+    if granted < rcvbuf:
+        logger.warning(f"UDP receive buffer is {granted} bytes, not the {rcvbuf} requested; bursts beyond it "
+                       f"are dropped by the kernel. Raise it on the host: sysctl -w net.core.rmem_max={rcvbuf}")
+    return granted
+
+
+def kernel_drops(sock):
+    # None where /proc/net/udp is unavailable (non-Linux) or lacks the socket.
+    inode = str(os.fstat(sock.fileno()).st_ino)
+    for path in UDP_TABLES:
+        try:
+            with open(path) as f:
+                lines = f.readlines()[1:]
+        except OSError:
+            continue
+        for line in lines:
+            fields = line.split()
+            if len(fields) > 12 and fields[9] == inode:
+                return int(fields[12])
+    return None
+
+
+def decode_datagram(data):
+    # One datagram may carry a single record, a JSON array of records,
+    # an envelope {"token": ..., "records": [...]}, or newline-delimited JSON.
+    try:
+        payloads = [json.loads(data)]
+    except ValueError:
+        payloads = [json.loads(line) for line in data.splitlines() if line.strip()]
+    records = []
+    for payload in payloads:
+        if isinstance(payload, list):
+            records.extend(r for r in payload if isinstance(r, dict))
+        elif isinstance(payload, dict) and isinstance(payload.get("records"), list):
+            token = payload.get("token")
+            for r in payload["records"]:
+                if isinstance(r, dict):
+                    r.setdefault("token", token)
+                    records.append(r)
+        elif isinstance(payload, dict):
+            records.append(payload)
+    return records
+
+
+def is_loopback(addr):
+    host = addr[0] if addr else ""
+    return host == "::1" or host.startswith("127.") or host.startswith("::ffff:127.")
+
+
+def valid_record(record):
+    for field, kind in RECORD_FIELDS.items():
+        value = record.get(field)
+        if value is not None and (not isinstance(value, kind) or isinstance(value, bool)):
+            return False
+    return True
+
+
+class LogIngest:
+    # Bounded ring buffer between UDPLogProtocol and a pool of workers that
+    # decode, authenticate and hand off records in batches.
+    def __init__(self, servers, buffer_size=BUFFER_SIZE, workers=WORKERS,
+                 batch_size=BATCH_SIZE, overflow=OVERFLOW):
+        if overflow not in ("drop_oldest", "drop_newest"):
+            raise ValueError(f"Unknown UDP overflow policy: {overflow}")
+        self.servers = servers
+        self.buffer = deque()
+        self.buffer_size = buffer_size
+        self.worker_count = workers
+        self.batch_size = batch_size
+        self.overflow = overflow
+        self.handler = None
+        self.wakeup = asyncio.Event()
+        self.tasks = []
+        self.sock = None
+        self.rcvbuf = None
+        self.stats = {
+            "received": 0,
+            "dropped": 0,
+            "decoded": 0,
+            "invalid": 0,
+            "records": 0,
+            "unauthorized": 0,
+            "rejected": 0,
+            "handled": 0,
+            "failed": 0,
+        }
+
+    def attach(self, transport):
+        # The listening socket, so the kernel's own drops can be reported
+        # next to the ring buffer's.
+        self.sock = transport.get_extra_info("socket")
+        self.rcvbuf = tune_socket(transport)
+
+    def kernel_drops(self):
+        drops = kernel_drops(self.sock) if self.sock is not None else None
+        return float("nan") if drops is None else drops
+
+    def feed(self, data, addr):
+        self.stats["received"] += 1
+        if len(self.buffer) >= self.buffer_size:
+            self.stats["dropped"] += 1
+            if self.overflow == "drop_newest":
+                return
+            self.buffer.popleft()
+        self.buffer.append((data, addr))
+        self.wakeup.set()
+
+    def start(self, handler):
+        self.handler = handler
+        for _ in range(self.worker_count):
+            self.tasks.append(asyncio.create_task(self.worker()))
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks.clear()
+        logger.info(f"UDP ingest stopped: {self.stats}")
+
+    async def worker(self):
+        while True:
+            if not self.buffer:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            take = min(self.batch_size, len(self.buffer))
+            batch = [self.buffer.popleft() for _ in range(take)]
+            await self.process_batch(batch)
+            # Let aiohttp handlers run between batches under a flood.
+            await asyncio.sleep(0)
+
+    async def process_batch(self, batch):
+        records = []
+        for data, addr in batch:
+            try:
+                decoded = decode_datagram(data)
+            except (ValueError, UnicodeDecodeError):
+                self.stats["invalid"] += 1
+                continue
+            self.stats["decoded"] += 1
+            records.extend((record, addr) for record in decoded)
+        self.stats["records"] += len(records)
+
+        resolved = {}
+        for record, addr in records:
+            if not valid_record(record):
+                self.stats["rejected"] += 1
+                continue
+            # One bad record must not take the worker (and its batch) down.
+            try:
+                token = record.get("token")
+                if token in MISSING_TOKENS:
+                    if not is_loopback(addr):
+                        self.stats["unauthorized"] += 1
+                        continue
+                    token = "local-token"
+                if token not in resolved:
+                    resolved[token] = await self.servers.get(token)
+                server = resolved[token]
+                if server is None:
+                    self.stats["unauthorized"] += 1
+                    continue
+                await self.handler(server, record)
+                self.stats["handled"] += 1
+            except Exception as e:
+                self.stats["failed"] += 1
+                logger.error(f"UDP record handler failed: {e}")
@@ -0,0 +1,164 @@
+import os
+import time
+import asyncio
+import logging
+
+logger = logging.getLogger("ServerGuard.journal")
+
+# --- Configuration ---
+# "enqueue": log_attempt returns once the row is queued (fastest, a crash can
+#            lose up to one flush window of history).
+# "commit":  log_attempt returns after the batch holding the row is committed.
+DURABILITY = os.getenv("HISTORY_DURABILITY", "enqueue")
+BATCH_SIZE = int(os.getenv("HISTORY_BATCH_SIZE", "256"))
+FLUSH_MS = int(os.getenv("HISTORY_FLUSH_MS", "50"))
+QUEUE_SIZE = int(os.getenv("HISTORY_QUEUE_SIZE", "10000"))
+
+INSERT_SQL = ("INSERT INTO history (server_id, ip, user, status, timestamp, country, asn, org) "
+              "VALUES (?, ?, ?, ?, ?, ?, ?, ?)")
+
+
+class Journal:
+    # Write-behind queue for one INSERT statement: a single writer task
+    # drains it and commits each batch with one executemany.
+    def __init__(self, db, sql, durability=DURABILITY, batch_size=BATCH_SIZE,
+                 flush_ms=FLUSH_MS, queue_size=QUEUE_SIZE, name="journal"):
+        if durability not in ("enqueue", "commit"):
+            raise ValueError(f"Unknown {name} durability mode: {durability}")
+        self.db = db
+        self.sql = sql
+        self.name = name
+        self.durability = durability
+        self.batch_size = batch_size
+        self.flush_interval = flush_ms / 1000
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.task = None
+        self.stats = {
+            "enqueued": 0,
+            "written": 0,
+            "batches": 0,
+            "failed": 0,
+            "queue_full": 0,
+            "max_depth": 0,
+        }
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def put(self, row):
+        done = None
+        if self.durability == "commit":
+            done = asyncio.get_running_loop().create_future()
+        if self.queue.full():
+            # Backpressure: the caller waits for the writer instead of
+            # growing memory; counted so saturation is visible.
+            self.stats["queue_full"] += 1
+        await self.queue.put((row, done))
+        self.stats["enqueued"] += 1
+        depth = self.queue.qsize()
+        if depth > self.stats["max_depth"]:
+            self.stats["max_depth"] = depth
+        if done is not None:
+            await done
+
+    async def _next_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.flush_interval
+        while len(batch) < self.batch_size and batch[-1] is not None:
+            try:
+                batch.append(self.queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def prepare(self, rows):
+        # Last look at a batch before it is written, in the writer task.
+        return rows
+
+    async def _commit_rows(self, rows):
+        # Fallback for a failed batch: one transaction, one statement per
+        # row, so a row SQLite refuses costs only itself. Returns the
+        # failures as {index: exception}.
+        errors = {}
+        try:
+            async with self.db.write() as conn:
+                for i, row in enumerate(rows):
+                    try:
+                        await conn.execute(self.sql, self.prepare([row])[0])
+                    except Exception as e:
+                        errors[i] = e
+        except Exception as e:
+            # The commit itself failed: nothing was written.
+            errors = dict.fromkeys(range(len(rows)), e)
+        return errors
+
+    async def _commit(self, batch):
+        rows = [row for row, _ in batch]
+        errors = {}
+        try:
+            await self.db.executemany(self.sql, self.prepare(rows))
+        except Exception as e:
+            logger.warning(f"{self.name.capitalize()} batch of {len(rows)} rows failed ({e}), retrying row by row")
+            errors = await self._commit_rows(rows)
+        if errors:
+            self.stats["failed"] += len(errors)
+            first = next(iter(errors.values()))
+            logger.error(f"{self.name.capitalize()} flush lost {len(errors)} of {len(rows)} rows: {first}")
+        written = len(rows) - len(errors)
+        if written:
+            self.stats["written"] += written
+            self.stats["batches"] += 1
+        for i, (_, done) in enumerate(batch):
+            if done is None or done.done():
+                continue
+            if i in errors:
+                done.set_exception(errors[i])
+            else:
+                done.set_result(None)
+
+    async def run(self):
+        while True:
+            batch = await self._next_batch()
+            stop = batch[-1] is None
+            if stop:
+                batch.pop()
+            if batch:
+                await self._commit(batch)
+            if stop:
+                return
+
+    async def close(self):
+        if self.task is None:
+            return
+        # The sentinel queues behind every pending row, so they all commit first.
+        await self.queue.put(None)
+        await self.task
+        self.task = None
+        logger.info(f"{self.name.capitalize()} journal flushed: {self.stats}")
+
+
+class HistoryJournal(Journal):
+    # Rows are GeoIP-enriched at flush time (geo is a geoip.GeoIP), so
+    # log_attempt never waits for a lookup and reports read stored values.
+    def __init__(self, db, geo=None, **kwargs):
+        kwargs.setdefault("name", "history")
+        super().__init__(db, INSERT_SQL, **kwargs)
+        self.geo = geo
+
+    def prepare(self, rows):
+        if self.geo is None or not self.geo.enabled:
+            return [row + (None, None, None) for row in rows]
+        return [row + self.geo.lookup(row[1]) for row in rows]
+
+    async def record(self, server_id, ip, user, status, timestamp=None):
+        await self.put((server_id, ip, user, status, timestamp or int(time.time())))
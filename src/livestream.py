@@ -0,0 +1,375 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+
+from aiohttp import web, WSMsgType
+
+logger = logging.getLogger("ServerGuard.livestream")
+
+# --- Configuration ---
+# GET /events streams check-access decisions and agent command records as
+# they happen, as SSE or as a WebSocket on Upgrade. Each process keeps one
+# ring of recent events and a subscriber is only a cursor into it, so a
+# dashboard costs no DB reads and every event is encoded once, however many
+# are watching. A subscriber the ring laps, or whose socket stops draining,
+# is dropped instead of being buffered for.
+BUFFER_SIZE = int(os.getenv("STREAM_BUFFER", "8192"))
+# Events for one (server, user, source IP) belong to the same session until
+# it has been quiet this long. Logins and commands open sessions; a blocked
+# attempt only joins an open one, so a flood of one-off addresses can't push
+# real sessions out of the table.
+SESSION_IDLE = float(os.getenv("STREAM_SESSION_IDLE", "1800"))
+MAX_SESSIONS = int(os.getenv("STREAM_MAX_SESSIONS", "4096"))
+SESSION_EVENTS = 32
+# Subscribers are woken, and events relayed between workers, in batches.
+FLUSH_INTERVAL = 0.05
+WRITE_TIMEOUT = 10
+KEEPALIVE = 15
+FILTERS = ("type", "server_id", "user", "ip", "session")
+
+
+class Session:
+    __slots__ = ("id", "key", "started", "last", "checks", "blocked", "cmds", "events")
+
+    def __init__(self, session_id, key, ts):
+        self.id = session_id
+        self.key = key
+        self.started = ts
+        self.last = ts
+        self.checks = 0
+        self.blocked = 0
+        self.cmds = 0
+        self.events = deque(maxlen=SESSION_EVENTS)
+
+    def add(self, event):
+        if event["ts"] > self.last:
+            self.last = event["ts"]
+        if event["type"] == "cmd":
+            self.cmds += 1
+        else:
+            self.checks += 1
+            if event.get("status") == "BLOCKED":
+                self.blocked += 1
+        self.events.append(event)
+
+    def summary(self):
+        server_id, user, ip = self.key
+        return {"session": self.id, "server_id": server_id, "server": self.events[-1].get("server"),
+                "user": user, "ip": ip, "started": self.started, "last": self.last,
+                "checks": self.checks, "blocked": self.blocked, "cmds": self.cmds}
+
+
+class Subscriber:
+    __slots__ = ("cursor", "task", "dropped")
+
+    def __init__(self, cursor, task):
+        self.cursor = cursor
+        self.task = task
+        self.dropped = False
+
+
+def matcher(query):
+    # ?type=check,cmd&server_id=3&user=root&ip=1.2.3.4&session=17; ValueError
+    # on a non-numeric server_id/session.
+    wanted = {}
+    for name in FILTERS:
+        value = query.get(name)
+        if not value:
+            continue
+        values = value.split(",")
+        wanted[name] = {int(v) for v in values} if name in ("server_id", "session") else set(values)
+    if not wanted:
+        return None
+    return lambda event: all(event.get(name) in values for name, values in wanted.items())
+
+
+class EventStream:
+    # The leader (or the only process) numbers events and assigns sessions.
+    # Followers pass `forward` and hand their events to the leader while it
+    # wants them (`collect`); the leader passes `broadcast` and sends the
+    # numbered events back to followers while any of them has subscribers
+    # (`fanout`), so ids and sessions are the same on every worker.
+    def __init__(self, size=BUFFER_SIZE, session_idle=SESSION_IDLE, max_sessions=MAX_SESSIONS):
+        self.size = size
+        self.ring = [None] * size
+        self.encoded = [None] * size
+        # Id of the next event; ids below `floor` were never seen here.
+        self.head = 0
+        self.floor = 0
+        self.session_idle = session_idle
+        self.max_sessions = max_sessions
+        # (server_id, user, ip) -> Session, least recently active first.
+        self.sessions = OrderedDict()
+        self.forward = None
+        self.broadcast = None
+        self.on_subscribers = None
+        self.collect = False
+        self.fanout = False
+        self.pending = []
+        self.outbox = []
+        self.subscribers = set()
+        self.changed = asyncio.Event()
+        self.timer = None
+        self.closed = False
+        self.stats = {"published": 0, "relayed": 0, "mirrored": 0, "delivered": 0,
+                      "subscribers_dropped": 0, "resumed_with_gap": 0}
+
+    def emit(self, event):
+        if self.forward is None:
+            self.publish(event)
+        elif self.collect:
+            self.pending.append(event)
+            self._schedule()
+
+    def publish(self, event):
+        event["id"] = self.head
+        self._open(event)
+        self._store(event)
+        self.stats["published"] += 1
+        if self.fanout:
+            self.outbox.append(event)
+            self._schedule()
+        elif self.subscribers:
+            self._schedule()
+
+    def mirror(self, events):
+        # Followers: numbered events from the leader.
+        for event in events:
+            if event["id"] < self.head:
+                continue
+            if event["id"] > self.head:
+                # Relay was off in between: nothing here to hand out.
+                self.floor = event["id"]
+                self.head = event["id"]
+            self._join(event)
+            self._store(event)
+        self.stats["mirrored"] += len(events)
+        if self.subscribers:
+            self._schedule()
+
+    def _store(self, event):
+        slot = self.head % self.size
+        self.ring[slot] = event
+        self.encoded[slot] = None
+        self.head += 1
+
+    def _open(self, event):
+        # Leader: a session is named after the id of its first event.
+        key = (event["server_id"], event["user"], event["ip"])
+        session = self.sessions.get(key)
+        if session is None or event["ts"] - session.last > self.session_idle:
+            if event.get("status") == "BLOCKED":
+                event["session"] = None
+                return
+            session = self._new_session(event["id"], key, event["ts"], session is not None)
+        else:
+            self.sessions.move_to_end(key)
+        session.add(event)
+        event["session"] = session.id
+
+    def _join(self, event):
+        # Followers: the leader already decided.
+        session_id = event.get("session")
+        if session_id is None:
+            return
+        key = (event["server_id"], event["user"], event["ip"])
+        session = self.sessions.get(key)
+        if session is None or session.id != session_id:
+            session = self._new_session(session_id, key, event["ts"], session is not None)
+        else:
+            self.sessions.move_to_end(key)
+        session.add(event)
+
+    def _new_session(self, session_id, key, ts, replaces):
+        if replaces:
+            del self.sessions[key]
+        session = self.sessions[key] = Session(session_id, key, ts)
+        if len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+        return session
+
+    def session(self, session_id):
+        # Admin lookups only: a scan of at most STREAM_MAX_SESSIONS.
+        for session in self.sessions.values():
+            if session.id == session_id:
+                return session
+        return None
+
+    def _schedule(self):
+        if self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(FLUSH_INTERVAL, self._flush)
+
+    def _flush(self):
+        self.timer = None
+        if self.outbox:
+            if self.broadcast is not None and self.fanout:
+                self.broadcast(self.outbox)
+            self.outbox = []
+        if self.pending:
+            self.forward(self.pending)
+            self.stats["relayed"] += len(self.pending)
+            self.pending = []
+        self._drop_lapped()
+        self.changed.set()
+
+    def _drop_lapped(self):
+        # A subscriber stuck writing to a stalled socket is cancelled as soon
+        # as the ring laps it, not when its write finally times out.
+        oldest = self.head - self.size
+        for subscriber in self.subscribers:
+            if subscriber.cursor < oldest and not subscriber.dropped:
+                subscriber.dropped = True
+                subscriber.task.cancel()
+
+    def _encode(self, slot):
+        data = self.encoded[slot]
+        if data is None:
+            data = self.encoded[slot] = json.dumps(self.ring[slot], separators=(",", ":"))
+        return data
+
+    def read(self, cursor, match=None):
+        # (events as (id, type, json) after `cursor`, new cursor).
+        batch = []
+        for event_id in range(max(cursor, self.floor), self.head):
+            slot = event_id % self.size
+            event = self.ring[slot]
+            if event is None or event["id"] != event_id:
+                continue
+            if match is None or match(event):
+                batch.append((event_id, event["type"], self._encode(slot)))
+        return batch, self.head
+
+    def start_cursor(self, last_id=None, backlog=0):
+        # Resuming from Last-Event-ID, or `backlog` recent events back. The
+        # second value is True when events the client asked for are gone.
+        oldest = max(self.floor, self.head - self.size)
+        if last_id is not None:
+            wanted = last_id + 1
+            if wanted > self.head:
+                # An id from before a controller restart: start afresh.
+                return self.head, False
+            return max(wanted, oldest), wanted < oldest
+        return max(self.head - max(0, backlog), oldest), False
+
+    def _count(self):
+        if self.on_subscribers is not None:
+            self.on_subscribers(len(self.subscribers))
+
+    async def subscribe(self, send, keepalive, cursor, match=None):
+        # Runs one subscriber until the stream closes, the client goes away
+        # or falls behind. send(batch) and keepalive() write to the client.
+        task = asyncio.current_task()
+        subscriber = Subscriber(cursor, task)
+        self.subscribers.add(subscriber)
+        self._count()
+        try:
+            while not self.closed:
+                if subscriber.cursor < self.head - self.size:
+                    self.stats["subscribers_dropped"] += 1
+                    return "lapped"
+                if subscriber.cursor >= self.head:
+                    self.changed.clear()
+                    try:
+                        await asyncio.wait_for(self.changed.wait(), KEEPALIVE)
+                    except asyncio.TimeoutError:
+                        await asyncio.wait_for(keepalive(), WRITE_TIMEOUT)
+                    continue
+                batch, subscriber.cursor = self.read(subscriber.cursor, match)
+                if batch:
+                    await asyncio.wait_for(send(batch), WRITE_TIMEOUT)
+                    self.stats["delivered"] += len(batch)
+            return "closed"
+        except asyncio.CancelledError:
+            if not subscriber.dropped:
+                raise
+            task.uncancel()
+            self.stats["subscribers_dropped"] += 1
+            return "lapped"
+        except asyncio.TimeoutError:
+            self.stats["subscribers_dropped"] += 1
+            return "stalled"
+        except (ConnectionError, RuntimeError):
+            return "gone"
+        finally:
+            self.subscribers.discard(subscriber)
+            self._count()
+
+    def close(self):
+        # Shutdown: every subscriber returns within one wakeup.
+        self.closed = True
+        self.changed.set()
+
+    def active_sessions(self, now=None, limit=100):
+        cutoff = (now or time.time()) - self.session_idle
+        active = []
+        for session in reversed(self.sessions.values()):
+            if session.last < cutoff or len(active) >= limit:
+                break
+            active.append(session.summary())
+        return active
+
+
+def sse_frame(event_id, kind, data):
+    return f"id: {event_id}\nevent: {kind}\ndata: {data}\n\n"
+
+
+async def serve_sse(stream, request, last_id=None, backlog=0, match=None):
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache",
+                                           "X-Accel-Buffering": "no"})
+    await response.prepare(request)
+    cursor, gap = stream.start_cursor(last_id, backlog)
+    if gap:
+        stream.stats["resumed_with_gap"] += 1
+        await response.write(f"event: gap\ndata: {json.dumps({'resumed_at': cursor})}\n\n".encode())
+
+    async def send(batch):
+        await response.write("".join(sse_frame(*event) for event in batch).encode())
+
+    async def keepalive():
+        await response.write(b": keepalive\n\n")
+
+    reason = await stream.subscribe(send, keepalive, cursor, match)
+    if reason in ("lapped", "stalled"):
+        try:
+            await asyncio.wait_for(response.write(f"event: dropped\ndata: {json.dumps({'reason': reason})}\n\n".encode()),
+                                   WRITE_TIMEOUT)
+        except (asyncio.TimeoutError, ConnectionError, RuntimeError):
+            pass
+    return response
+
+
+async def serve_websocket(stream, request, last_id=None, backlog=0, match=None):
+    ws = web.WebSocketResponse(heartbeat=KEEPALIVE)
+    await ws.prepare(request)
+    cursor, gap = stream.start_cursor(last_id, backlog)
+    if gap:
+        stream.stats["resumed_with_gap"] += 1
+        await ws.send_str(json.dumps({"type": "gap", "resumed_at": cursor}))
+
+    async def send(batch):
+        for _, _, data in batch:
+            await ws.send_str(data)
+
+    async def keepalive():
+        pass
+
+    async def drain_incoming():
+        # Nothing is expected from the client; reading processes pings and close.
+        async for msg in ws:
+            if msg.type == WSMsgType.ERROR:
+                break
+
+    subscription = asyncio.create_task(stream.subscribe(send, keepalive, cursor, match))
+    reader = asyncio.create_task(drain_incoming())
+    done, _ = await asyncio.wait((subscription, reader), return_when=asyncio.FIRST_COMPLETED)
+    reader.cancel()
+    subscription.cancel()
+    await asyncio.gather(reader, subscription, return_exceptions=True)
+    if subscription in done and subscription.result() in ("lapped", "stalled"):
+        await ws.close(code=1008, message=f"dropped: {subscription.result()}".encode())
+    else:
+        await ws.close()
+    return ws
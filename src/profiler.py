@@ -0,0 +1,266 @@
+import os
+import sys
+import math
+import time
+import signal
+import asyncio
+import logging
+import threading
+import traceback
+from collections import Counter
+
+logger = logging.getLogger("ServerGuard.profiler")
+
+# --- Configuration ---
+# HTTP, UDP ingest, Telegram polling and fleet SSH all share one event loop.
+# A watchdog thread checks that it keeps ticking; when a single callback
+# holds it for longer than LOOP_STALL_THRESHOLD, the thread logs the loop
+# thread's stack while it is still stuck, so the log names the culprit
+# rather than whatever ran next.
+STALL_THRESHOLD = float(os.getenv("LOOP_STALL_THRESHOLD", "0.25"))
+BEAT_INTERVAL = 0.1
+WATCH_INTERVAL = 0.05
+# The same stack is logged in full at most once per cooldown.
+STACK_COOLDOWN = 60
+STACK_DEPTH = 30
+# On-demand sampling (GET /debug/profile, /profile in the bot).
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+# Below ~1ms the SIGALRM handler itself starts to starve the loop.
+PROFILE_MIN_INTERVAL = 0.001
+PROFILE_MAX_INTERVAL = 1.0
+
+# Innermost Python frame of a loop thread waiting for I/O or a timer.
+IDLE_LABEL = "select (selectors.py:"
+
+
+def task_name(task):
+    # The coroutine's qualified name: "handle_check_access", "Ingest.run".
+    if task is None:
+        return None
+    coro = task.get_coro()
+    return getattr(coro, "__qualname__", None) or task.get_name()
+
+
+def loop_task(loop):
+    # asyncio keeps the running task per loop in a plain dict, so reading it
+    # from another thread is safe under the GIL; it may be a tick stale.
+    try:
+        return task_name(asyncio.current_task(loop))
+    except RuntimeError:
+        return None
+
+
+def callback_stack(frame):
+    # Stack of whatever the loop is running, without asyncio's own frames.
+    stack = traceback.extract_stack(frame)
+    for i in range(len(stack) - 1, -1, -1):
+        if stack[i].name == "_run" and stack[i].filename.endswith(os.path.join("asyncio", "events.py")):
+            return stack[i + 1:]
+    return stack
+
+
+class LoopWatchdog:
+    # The loop re-arms a call_later beat every BEAT_INTERVAL; the thread only
+    # compares the next beat's deadline with the clock. Cost on the loop is
+    # one timer callback per beat.
+    def __init__(self, threshold=STALL_THRESHOLD):
+        self.threshold = threshold
+        self.loop = None
+        self.thread_id = None
+        self.expected = None
+        self.handle = None
+        self.thread = None
+        self.stopping = threading.Event()
+        # Set by the thread while the loop is stuck: (since, task).
+        self.stall = None
+        self.logged = {}
+        self.longest = 0.0
+        self.stats = {"stalls": 0, "stacks_logged": 0}
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.loop = asyncio.get_running_loop()
+        self.thread_id = threading.get_ident()
+        self.stopping.clear()
+        self._arm()
+        self.thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+    def _arm(self):
+        self.expected = time.monotonic() + BEAT_INTERVAL
+        self.handle = self.loop.call_later(BEAT_INTERVAL, self._beat)
+
+    def _beat(self):
+        lag = time.monotonic() - self.expected
+        stall = self.stall
+        if lag > self.threshold:
+            self.stats["stalls"] += 1
+            self.longest = max(self.longest, lag)
+            if stall is not None:
+                logger.warning(f"Event loop was blocked for {lag:.3f}s (in {stall[1] or 'a plain callback'})")
+            else:
+                # Shorter than the thread's polling gap: no stack to show.
+                logger.warning(f"Event loop was blocked for {lag:.3f}s")
+        self.stall = None
+        self._arm()
+
+    def _watch(self):
+        while not self.stopping.wait(WATCH_INTERVAL):
+            expected = self.expected
+            if self.stall is not None or expected is None:
+                continue
+            stuck = time.monotonic() - expected
+            if stuck <= self.threshold:
+                continue
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            task = loop_task(self.loop)
+            stack = callback_stack(frame)[-STACK_DEPTH:]
+            del frame
+            if self.expected is not expected:
+                # The beat ran meanwhile: the stall was already over.
+                continue
+            self.stall = (expected, task)
+            self._report(stuck, task, stack)
+
+    def _report(self, stuck, task, stack):
+        key = tuple((f.filename, f.lineno) for f in stack[-3:])
+        now = time.monotonic()
+        if now - self.logged.get(key, 0) < STACK_COOLDOWN:
+            where = f"{stack[-1].name} ({stack[-1].filename}:{stack[-1].lineno})" if stack else "?"
+            logger.warning(f"Event loop blocked for {stuck:.3f}s+ at {where} (stack logged earlier)")
+            return
+        if len(self.logged) > 1024:
+            self.logged.clear()
+        self.logged[key] = now
+        self.stats["stacks_logged"] += 1
+        logger.warning(f"Event loop blocked for {stuck:.3f}s+ in {task or 'a plain callback'}, "
+                       f"still running:\n{''.join(traceback.format_list(stack)).rstrip()}")
+
+
+class Profile:
+    def __init__(self, interval):
+        self.interval = interval
+        self.samples = 0
+        self.seconds = 0.0
+        # Collapsed stack "root;frame;...;leaf" -> samples.
+        self.stacks = Counter()
+        # Loop time per coroutine; "(idle)" is time spent waiting for I/O and
+        # "(callbacks)" is protocol/timer callbacks outside any task.
+        self.tasks = Counter()
+
+    def collapsed(self):
+        # Brendan Gregg's folded format: flamegraph.pl, speedscope, inferno.
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def attribution(self):
+        total = sum(self.tasks.values()) or 1
+        return [(name, count * self.seconds / total, count / total) for name, count in self.tasks.most_common()]
+
+
+class SamplingProfiler:
+    # Statistical profiler for the live process, driven by SIGALRM. The
+    # handler runs on the loop thread between bytecodes, so it sees the exact
+    # frame and task; a sampler thread would only get the GIL when the loop
+    # releases it, i.e. mostly in select(), and over-report idle time. A
+    # sample is weighted by the wall time since the previous one, so a
+    # blocking C call that delays the signal still counts in full. Nothing
+    # runs outside a profile; during one, the loop wakes once per interval.
+    def __init__(self, max_seconds=PROFILE_MAX_SECONDS):
+        self.max_seconds = max_seconds
+        self.running = False
+        self.labels = {}
+
+    @property
+    def busy(self):
+        return self.running
+
+    def _label(self, code):
+        label = self.labels.get(code)
+        if label is None:
+            label = self.labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        return label
+
+    def _stack(self, frame):
+        labels = []
+        while frame is not None:
+            labels.append(self._label(frame.f_code))
+            frame = frame.f_back
+        labels.reverse()
+        return labels
+
+    async def profile(self, seconds, interval=PROFILE_INTERVAL, threads=False):
+        # Samples the running loop, which must be on the main thread (as in
+        # bot.py). With threads=True, other threads are sampled alongside.
+        # Both callers pass user input straight through: nan/inf are refused
+        # and the rest clamped, so one request can't hold the sampler (and
+        # 409 everyone else) for longer than max_seconds.
+        if not (math.isfinite(seconds) and math.isfinite(interval)) or interval <= 0 or seconds <= 0:
+            raise ValueError("seconds and interval must be positive and finite")
+        seconds = min(seconds, self.max_seconds)
+        interval = min(max(interval, PROFILE_MIN_INTERVAL), PROFILE_MAX_INTERVAL, seconds)
+        if threading.current_thread() is not threading.main_thread():
+            raise RuntimeError("profiling needs the event loop on the main thread")
+        if self.running:
+            raise RuntimeError("a profile is already running")
+        loop = asyncio.get_running_loop()
+        profile = Profile(interval)
+        main = threading.get_ident()
+        names = {}
+        last = [time.perf_counter()]
+
+        def sample(signum, frame):
+            now = time.perf_counter()
+            weight = max(1, round((now - last[0]) / interval))
+            last[0] = now
+            stack = self._stack(frame)
+            if stack and stack[-1].startswith(IDLE_LABEL):
+                task = "(idle)"
+            else:
+                task = loop_task(loop) or "(callbacks)"
+            profile.tasks[task] += weight
+            profile.stacks[";".join(["loop", task] + stack)] += weight
+            profile.samples += 1
+            if not threads:
+                return
+            for thread_id, other in sys._current_frames().items():
+                if thread_id == main:
+                    continue
+                if thread_id not in names:
+                    names.update((t.ident, t.name) for t in threading.enumerate())
+                root = f"thread {names.get(thread_id, thread_id)}"
+                profile.stacks[";".join([root] + self._stack(other))] += weight
+
+        self.running = True
+        previous = signal.signal(signal.SIGALRM, sample)
+        started = time.perf_counter()
+        signal.setitimer(signal.ITIMER_REAL, interval, interval)
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+            self.running = False
+        profile.seconds = time.perf_counter() - started
+        return profile
+
+
+def render_summary(profile, limit=15):
+    lines = [f"{profile.samples} samples over {profile.seconds:.1f}s "
+             f"(every {profile.interval * 1000:g}ms)"]
+    for name, seconds, share in profile.attribution()[:limit]:
+        lines.append(f"{share * 100:5.1f}%  {seconds:7.3f}s  {name}")
+    return "\n".join(lines)
@@ -0,0 +1,79 @@
+import time
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger("ServerGuard.registry")
+
+NEGATIVE_TTL = 60
+NEGATIVE_MAX = 1024
+
+
+class ServerRegistry:
+    # In-process mirror of the servers table keyed by agent token.
+    # Misses fall through to the DB once and are then remembered for
+    # NEGATIVE_TTL seconds, so a broken agent can't turn every call into a query.
+    def __init__(self, db):
+        self.db = db
+        self.by_token = {}
+        self.token_by_ip = {}
+        self.names = {}
+        self.addresses = {}
+        self.negative = OrderedDict()
+
+    async def load(self):
+        rows = await self.db.fetchall("SELECT id, name, ip, token FROM servers")
+        self.by_token.clear()
+        self.token_by_ip.clear()
+        self.names.clear()
+        self.addresses.clear()
+        self.negative.clear()
+        for server_id, name, ip, token in rows:
+            self._put(token, (server_id, name, ip))
+        logger.info(f"Server index loaded: {len(self.by_token)} tokens")
+
+    def _put(self, token, server):
+        old = self.token_by_ip.get(server[2])
+        if old is not None and old != token:
+            self.by_token.pop(old, None)
+        self.by_token[token] = server
+        self.token_by_ip[server[2]] = token
+        self.names[server[0]] = server[1]
+        self.addresses[server[0]] = server[2]
+        self.negative.pop(token, None)
+
+    def name(self, server_id):
+        return self.names.get(server_id)
+
+    def address(self, server_id):
+        return self.addresses.get(server_id)
+
+    def put(self, token, server):
+        self._put(token, tuple(server))
+
+    def _remember_miss(self, token):
+        self.negative[token] = time.monotonic() + NEGATIVE_TTL
+        self.negative.move_to_end(token)
+        while len(self.negative) > NEGATIVE_MAX:
+            self.negative.popitem(last=False)
+
+    def _known_miss(self, token):
+        deadline = self.negative.get(token)
+        if deadline is None:
+            return False
+        if deadline > time.monotonic():
+            return True
+        del self.negative[token]
+        return False
+
+    async def get(self, token):
+        server = self.by_token.get(token)
+        if server is not None or token is None:
+            return server
+        if self._known_miss(token):
+            return None
+        row = await self.db.fetchone("SELECT id, name, ip FROM servers WHERE token = ?", (token,))
+        if row:
+            self._put(token, tuple(row))
+            return self.by_token[token]
+        self._remember_miss(token)
+        return None
@@ -0,0 +1,172 @@
+import os
+import gzip
+import json
+import time
+import asyncio
+import logging
+from collections import Counter
+
+logger = logging.getLogger("ServerGuard.retention")
+
+# --- Configuration ---
+# Raw history rows older than RETENTION_DAYS are rolled up into
+# history_hourly, appended to gzipped JSONL archives (one file per UTC day)
+# and deleted. ARCHIVE_DIR="" skips the archive.
+RETENTION_DAYS = float(os.getenv("HISTORY_RETENTION_DAYS", "30"))
+ARCHIVE_DIR = os.getenv("HISTORY_ARCHIVE_DIR", "/data/archive")
+INTERVAL = float(os.getenv("RETENTION_INTERVAL", "3600"))
+BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "2000"))
+VACUUM_PAGES = int(os.getenv("RETENTION_VACUUM_PAGES", "256"))
+# Pause between slices so journal commits and request reads interleave.
+SLICE_PAUSE = 0.05
+HOUR = 3600
+
+SELECT_SQL = ("SELECT id, server_id, ip, user, status, timestamp, country, asn, org FROM history "
+              "WHERE timestamp < ? ORDER BY timestamp, id LIMIT ?")
+ROLLUP_SQL = ("INSERT INTO history_hourly (hour, server_id, ip, user, status, count, country, asn, org) "
+              "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+              "ON CONFLICT (hour, server_id, ip, user, status) DO UPDATE SET count = count + excluded.count, "
+              "country = coalesce(country, excluded.country), asn = coalesce(asn, excluded.asn), "
+              "org = coalesce(org, excluded.org)")
+DELETE_SQL = "DELETE FROM history WHERE id = ?"
+
+
+def horizon(now=None, days=RETENTION_DAYS):
+    # Cut on an hour boundary so no hour is split between raw and rolled-up rows.
+    cutoff = int((now or time.time()) - days * 86400)
+    return cutoff - cutoff % HOUR
+
+
+def bucket(row):
+    # Missing key values become 0 / '' so the ON CONFLICT upsert can match
+    # them (UNIQUE never matches NULLs); history_hourly's key is NOT NULL.
+    return (row[5] - row[5] % HOUR, 0 if row[1] is None else row[1],
+            row[2] or "", row[3] or "", row[4] or "")
+
+
+def rollup(rows):
+    # GeoIP columns follow the IP, so any enriched row of a group will do.
+    counts = Counter(bucket(r) for r in rows)
+    geo = {}
+    for r in rows:
+        if r[6] is not None or r[7] is not None:
+            geo[r[2] or ""] = r[6:9]
+    return [key + (count,) + geo.get(key[2], (None, None, None)) for key, count in counts.items()]
+
+
+def write_archive(directory, rows):
+    by_day = {}
+    for r in rows:
+        day = time.strftime("%Y-%m-%d", time.gmtime(r[5]))
+        by_day.setdefault(day, []).append(r)
+    os.makedirs(directory, exist_ok=True)
+    for day, day_rows in by_day.items():
+        lines = "".join(
+            json.dumps({"id": r[0], "server_id": r[1], "ip": r[2], "user": r[3],
+                        "status": r[4], "timestamp": r[5], "country": r[6], "asn": r[7],
+                        "org": r[8]}, separators=(",", ":")) + "\n"
+            for r in day_rows
+        )
+        # Appending a new gzip member per slice keeps each file a valid .gz.
+        with gzip.open(os.path.join(directory, f"history-{day}.jsonl.gz"), "at", encoding="utf-8") as f:
+            f.write(lines)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class Retention:
+    # Leader-only background job. Each slice is archived first and then
+    # rolled up and deleted in one transaction, so a crash can at worst
+    # archive a slice twice, never lose it.
+    def __init__(self, db, days=RETENTION_DAYS, archive_dir=ARCHIVE_DIR,
+                 batch_size=BATCH_SIZE, vacuum_pages=VACUUM_PAGES, interval=INTERVAL):
+        self.db = db
+        self.days = days
+        self.archive_dir = archive_dir
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self.interval = interval
+        self.incremental = False
+        self.stopping = asyncio.Event()
+        self.task = None
+        self.stats = {"runs": 0, "rolled_up": 0, "archived": 0, "vacuumed_pages": 0, "failed": 0}
+
+    async def check_vacuum_mode(self):
+        # auto_vacuum can only change on an empty DB or through a full VACUUM,
+        # which would block the controller. Without it freed pages are still
+        # reused by new rows, so the file stops growing but does not shrink.
+        row = await self.db.fetchone("PRAGMA auto_vacuum")
+        self.incremental = row is not None and row[0] == 2
+        if not self.incremental:
+            logger.info("auto_vacuum is not INCREMENTAL; pruned pages are reused but the file will not shrink. "
+                        "Run 'PRAGMA auto_vacuum=INCREMENTAL; VACUUM;' once while the controller is stopped to enable it.")
+
+    async def prune_slice(self, cutoff):
+        rows = await self.db.fetchall(SELECT_SQL, (cutoff, self.batch_size))
+        if not rows:
+            return 0
+        if self.archive_dir:
+            await asyncio.to_thread(write_archive, self.archive_dir, rows)
+            self.stats["archived"] += len(rows)
+        async with self.db.write() as conn:
+            await conn.executemany(ROLLUP_SQL, rollup(rows))
+            await conn.executemany(DELETE_SQL, [(r[0],) for r in rows])
+        self.stats["rolled_up"] += len(rows)
+        return len(rows)
+
+    async def vacuum_slice(self):
+        async with self.db.write() as conn:
+            async with conn.execute("PRAGMA freelist_count") as cursor:
+                free = (await cursor.fetchone())[0]
+            if not free:
+                return 0
+            pages = min(free, self.vacuum_pages)
+            # sqlite3's execute() steps this pragma once (one page);
+            # executescript runs it to completion.
+            await conn.executescript(f"PRAGMA incremental_vacuum({pages})")
+        self.stats["vacuumed_pages"] += pages
+        return pages
+
+    async def run_once(self, now=None):
+        cutoff = horizon(now, self.days)
+        total = 0
+        while not self.stopping.is_set():
+            count = await self.prune_slice(cutoff)
+            if not count:
+                break
+            total += count
+            await asyncio.sleep(SLICE_PAUSE)
+        while self.incremental and not self.stopping.is_set():
+            if not await self.vacuum_slice():
+                break
+            await asyncio.sleep(SLICE_PAUSE)
+        self.stats["runs"] += 1
+        if total:
+            logger.info(f"Retention rolled up {total} history rows older than "
+                        f"{time.strftime('%Y-%m-%d %H:%M', time.gmtime(cutoff))} UTC")
+        return total
+
+    async def run(self):
+        await self.check_vacuum_mode()
+        while not self.stopping.is_set():
+            try:
+                await self.run_once()
+            except Exception as e:
+                self.stats["failed"] += 1
+                logger.error(f"Retention run failed: {e}")
+            try:
+                await asyncio.wait_for(self.stopping.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        # Stops between slices rather than cancelling one mid-transaction.
+        if self.task is None:
+            return
+        self.stopping.set()
+        await asyncio.gather(self.task, return_exceptions=True)
+        self.task = None
@@ -1,18 +1,24 @@
 #!/bin/bash
 # ServerGuard Remote Installer v3.0
-# Args: API_URL TOKEN LOG_HOST
+# Args: API_URL TOKEN LOG_HOST [BUNDLE_HASH] [SYNC_KEY] [FLEET_KEY]
 
 API_URL="$1"
 API_TOKEN="$2"
 LOG_HOST="$3"
+BUNDLE_HASH="$4"
+SYNC_KEY="$5"
+FLEET_KEY="$6"
+SRC_DIR="$(cd "$(dirname "$0")" && pwd)"
 
 echo ">>> Installing ServerGuard Agent..."
 
-# 1. Install Dependencies
-if command -v apt-get &> /dev/null; then
-    apt-get update -qq && apt-get install -y curl netcat-openbsd
+# 1. Install Dependencies (skip the package index refresh when already present)
+if command -v curl &> /dev/null && command -v nc &> /dev/null && command -v python3 &> /dev/null; then
+    :
+elif command -v apt-get &> /dev/null; then
+    apt-get update -qq && apt-get install -y curl netcat-openbsd python3
 elif command -v yum &> /dev/null; then
-    yum install -y curl nc
+    yum install -y curl nc python3
 fi
 
 # 2. Configure
@@ -23,16 +29,60 @@ API_TOKEN="$API_TOKEN"
 LOG_HOST="$LOG_HOST"
 EOF
 chmod 644 /etc/server-guard/agent.env
+# Allowlist sync key for sg-agentd; root-only, unlike agent.env which the
+# login hooks read as the connecting user.
+if [ -n "$SYNC_KEY" ]; then
+    (umask 077; echo "$SYNC_KEY" > /etc/server-guard/sync.key)
+fi
+# Controller's fleet SSH key, only when the admin opted in at deploy time:
+# it gives the controller passwordless SSH as this user for fleet operations
+# (status, session kills, config pushes). The line is tagged
+# "serverguard-fleet"; a redeploy without fleet access removes it.
+sed -i '/ serverguard-fleet$/d' ~/.ssh/authorized_keys 2> /dev/null
+if [ -n "$FLEET_KEY" ]; then
+    read -r KEY_TYPE KEY_BODY _ <<< "$FLEET_KEY"
+    (umask 077; mkdir -p ~/.ssh; echo "$KEY_TYPE $KEY_BODY serverguard-fleet" >> ~/.ssh/authorized_keys)
+fi
 
 # 3. Install Binaries
-# We assume files are in /tmp from SCP
-mv /tmp/sg-check-access /usr/local/bin/sg-check-access
-mv /tmp/sg-logger /usr/local/bin/sg-logger
-mv /tmp/sg-sftp-wrapper /usr/local/bin/sg-sftp-wrapper
+# Files sit next to this installer (bundle dir, or /tmp from SCP)
+mv "$SRC_DIR/sg-check-access" /usr/local/bin/sg-check-access
+mv "$SRC_DIR/sg-logger" /usr/local/bin/sg-logger
+mv "$SRC_DIR/sg-sftp-wrapper" /usr/local/bin/sg-sftp-wrapper
+mv "$SRC_DIR/sg-agentd" /usr/local/bin/sg-agentd
 
 chmod +x /usr/local/bin/sg-check-access
 chmod +x /usr/local/bin/sg-logger
 chmod +x /usr/local/bin/sg-sftp-wrapper
+chmod +x /usr/local/bin/sg-agentd
+
+# 3b. Agent Daemon
+# Holds the controller connection for sg-check-access and batches command
+# logs from the prompt hook. The hooks fall back to curl/sg-logger when it
+# is not running.
+if command -v systemctl &> /dev/null && [ -d /run/systemd/system ]; then
+    cat > /etc/systemd/system/sg-agentd.service <<EOF
+[Unit]
+Description=ServerGuard agent daemon
+After=network-online.target
+
+[Service]
+ExecStart=/usr/local/bin/sg-agentd
+Restart=always
+RestartSec=2
+RuntimeDirectory=server-guard
+RuntimeDirectoryPreserve=yes
+
+[Install]
+WantedBy=multi-user.target
+EOF
+    systemctl daemon-reload
+    systemctl enable sg-agentd > /dev/null 2>&1
+    systemctl restart sg-agentd
+else
+    pkill -f /usr/local/bin/sg-agentd 2> /dev/null
+    nohup /usr/local/bin/sg-agentd >> /var/log/sg-agentd.log 2>&1 &
+fi
 
 # 4. Hooks
 # Profile
@@ -44,16 +94,24 @@ fi
 EOF
 
 # BashRC
+# Replaced on every install so upgrades pick up hook changes. With sg-agentd
+# running a prompt costs one builtin write to /dev/udp and no new process;
+# the history number keeps a bare Enter from re-sending the last command.
 BASHRC="/etc/bash.bashrc"
-if ! grep -q "SERVERGUARD HOOK" "$BASHRC"; then
-    cat >> "$BASHRC" <<EOF
-
+sed -i '/^# --- SERVERGUARD HOOK ---$/,/^# --- END SERVERGUARD ---$/d' "$BASHRC"
+cat >> "$BASHRC" <<'EOF'
 # --- SERVERGUARD HOOK ---
 sg_monitor_hook() {
-    if [ ! -x /usr/local/bin/sg-logger ]; then return; fi
-    local LAST_CMD=\$(history 1 | sed "s/^[ ]*[0-9]*[ ]*//")
-    if [ -n "\$LAST_CMD" ]; then
-        /usr/local/bin/sg-logger "\$LAST_CMD" &
+    local entry
+    entry=$(HISTTIMEFORMAT= builtin history 1)
+    [[ $entry =~ ^[[:space:]]*([0-9]+)[*[:space:]]+(.+)$ ]] || return
+    [ "${BASH_REMATCH[1]}" = "$SG_LAST_HIST" ] && return
+    SG_LAST_HIST=${BASH_REMATCH[1]}
+    local cmd="${BASH_REMATCH[2]:0:4000}" ip="${SSH_CONNECTION%% *}"
+    if [ -S /run/server-guard/agentd.sock ]; then
+        printf 'cmd\t%s\t%s\t%s' "${USER:-$LOGNAME}" "${ip:-LOCAL}" "$cmd" 2> /dev/null > /dev/udp/127.0.0.1/9998
+    elif [ -x /usr/local/bin/sg-logger ]; then
+        /usr/local/bin/sg-logger "$cmd" &
     fi
 }
 if [ -x /usr/local/bin/sg-logger ]; then
@@ -61,7 +119,6 @@ if [ -x /usr/local/bin/sg-logger ]; then
 fi
 # --- END SERVERGUARD ---
 EOF
-fi
 
 # 5. SSHD Config
 SSHD_CONFIG="/etc/ssh/sshd_config"
@@ -75,4 +132,8 @@ fi
 # Reload SSH
 service sshd reload || systemctl reload sshd
 
+if [ -n "$BUNDLE_HASH" ]; then
+    echo "$BUNDLE_HASH" > /etc/server-guard/bundle.sha256
+fi
+
 echo ">>> Agent Installed Successfully."
@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+# ServerGuard Agent Daemon (sg-agentd)
+# One resident process per host between the shell hooks and the controller,
+# so logins and prompts no longer spawn curl/nc/python of their own:
+#   - unix socket AGENTD_SOCKET: "CHECK <ip> <user>\n" -> "<http status>\n".
+#     IPs in the local allowlist copy (long-polled from the controller's
+#     /allowlist, HMAC-verified) are admitted on the spot and the login is
+#     reported over UDP; anything else goes to /check-access over a pool of
+#     keep-alive HTTP connections.
+#   - 127.0.0.1:AGENTD_UDP_PORT: "cmd\t<user>\t<ip>\t<command>" datagrams from
+#     the prompt hook, which bash writes through /dev/udp without forking.
+# Commands are packed into multi-record datagrams for the controller's
+# UDP ingest, along with a heartbeat every AGENTD_HEARTBEAT_INTERVAL
+# seconds. Stdlib only: agents have python3 but not pip packages.
+import os
+import sys
+import hmac
+import json
+import time
+import queue
+import random
+import signal
+import socket
+import hashlib
+import logging
+import ipaddress
+import threading
+import http.client
+import socketserver
+from urllib.parse import urlsplit, urlencode, urljoin
+
+logger = logging.getLogger("ServerGuard.agentd")
+
+# --- Configuration ---
+ENV_FILE = os.getenv("AGENTD_ENV_FILE", "/etc/server-guard/agent.env")
+SOCKET_PATH = os.getenv("AGENTD_SOCKET", "/run/server-guard/agentd.sock")
+UDP_PORT = int(os.getenv("AGENTD_UDP_PORT", "9998"))
+LOG_PORT = int(os.getenv("LOG_PORT", "9999"))
+HTTP_TIMEOUT = 3
+HTTP_POOL = int(os.getenv("AGENTD_HTTP_POOL", "4"))
+# Datagrams stay under a typical MTU so a lost fragment never drops a batch.
+MAX_DATAGRAM = int(os.getenv("AGENTD_MAX_DATAGRAM", "1400"))
+FLUSH_INTERVAL = float(os.getenv("AGENTD_FLUSH_INTERVAL", "0.2"))
+QUEUE_SIZE = 10000
+MAX_COMMAND = 4096
+# Allowlist sync: written by agent_installer.sh when the controller has a
+# signing secret. Without it every check goes to the controller.
+SYNC_KEY_FILE = os.getenv("AGENTD_SYNC_KEY_FILE", "/etc/server-guard/sync.key")
+STATE_FILE = os.getenv("AGENTD_STATE_FILE", "/var/lib/server-guard/allowlist.json")
+SYNC_WAIT = 25
+SYNC_RETRY = 5
+# The controller reports an agent offline after about four missed beats.
+HEARTBEAT_INTERVAL = float(os.getenv("AGENTD_HEARTBEAT_INTERVAL", "30"))
+BUNDLE_FILE = "/etc/server-guard/bundle.sha256"
+
+
+def read_key(path=SYNC_KEY_FILE):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+
+def load_env(path=ENV_FILE):
+    # agent.env is KEY="value" lines written by agent_installer.sh.
+    env = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                key, sep, value = line.strip().partition("=")
+                if sep and not key.startswith("#"):
+                    env[key.strip()] = value.strip().strip('"').strip()
+    except OSError as e:
+        logger.error(f"Cannot read {path}: {e}")
+    return env
+
+
+class Controller:
+    # Small pool of keep-alive connections to /check-access. A reused
+    # connection that fails (the controller closed it while idle) is dropped
+    # and the request retried on the next one, ending with a fresh connect.
+    def __init__(self, api_url, token, pool=HTTP_POOL, timeout=HTTP_TIMEOUT):
+        parts = urlsplit(api_url)
+        self.connection_class = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = parts.path or "/check-access"
+        self.token = token
+        self.timeout = timeout
+        self.idle = queue.LifoQueue(pool)
+        self.stats = {"checks": 0, "connects": 0, "reused": 0, "failed": 0}
+
+    def _acquire(self):
+        try:
+            return self.idle.get_nowait(), True
+        except queue.Empty:
+            self.stats["connects"] += 1
+            return self.connection_class(self.host, self.port, timeout=self.timeout), False
+
+    def _release(self, conn, response):
+        if response.will_close:
+            conn.close()
+            return
+        try:
+            self.idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def check(self, ip, user):
+        # HTTP status of the controller's decision, or 0 if it is unreachable.
+        self.stats["checks"] += 1
+        target = f"{self.path}?{urlencode({'ip': ip, 'user': user})}"
+        headers = {"X-Guard-Token": self.token}
+        while True:
+            conn, reused = self._acquire()
+            try:
+                conn.request("GET", target, headers=headers)
+                response = conn.getresponse()
+                response.read()
+            except socket.timeout as e:
+                conn.close()
+                self.stats["failed"] += 1
+                logger.warning(f"Controller timed out: {e}")
+                return 0
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                if reused:
+                    continue
+                self.stats["failed"] += 1
+                logger.warning(f"Controller unreachable: {e}")
+                return 0
+            if reused:
+                self.stats["reused"] += 1
+            self._release(conn, response)
+            return response.status
+
+
+class LocalAllowlist:
+    # Agent-side copy of the controller allowlist. Addresses are one dict
+    # lookup; prefixes are keyed by (family, length, network) and probed once
+    # per distinct length in use, so a check stays in the microseconds.
+    # Entries carry the controller's expiry and lapse on their own.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = 0
+        self.exact = {}
+        self.prefixes = {}
+        self.lengths = {4: (), 6: ()}
+
+    def apply(self, entries, version, full):
+        exact = {} if full else dict(self.exact)
+        prefixes = {} if full else dict(self.prefixes)
+        for entry, expiry in entries:
+            if "/" not in entry:
+                exact[entry] = expiry
+                continue
+            try:
+                network = ipaddress.ip_network(entry)
+            except ValueError:
+                continue
+            prefixes[(network.version, network.prefixlen, int(network.network_address))] = expiry
+        now = time.time()
+        exact = {k: v for k, v in exact.items() if v > now}
+        prefixes = {k: v for k, v in prefixes.items() if v > now}
+        lengths = {4: set(), 6: set()}
+        for family, length, _ in prefixes:
+            lengths[family].add(length)
+        # Swap in whole dicts so lock-free readers never see a half update.
+        with self.lock:
+            self.exact, self.prefixes = exact, prefixes
+            self.lengths = {family: sorted(found, reverse=True) for family, found in lengths.items()}
+            self.version = version
+
+    def allows(self, ip, now=None):
+        now = now or time.time()
+        expiry = self.exact.get(ip)
+        if expiry is not None and expiry > now:
+            return True
+        prefixes = self.prefixes
+        if not prefixes:
+            return False
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return False
+        bits = address.max_prefixlen
+        value = int(address)
+        for length in self.lengths[address.version]:
+            expiry = prefixes.get((address.version, length, value >> (bits - length) << (bits - length)))
+            if expiry is not None and expiry > now:
+                return True
+        return False
+
+    def load(self, path=STATE_FILE):
+        try:
+            with open(path) as f:
+                state = json.load(f)
+            self.apply(state["entries"], state["version"], True)
+            logger.info(f"Loaded allowlist copy v{self.version} from {path}")
+        except (OSError, ValueError, KeyError) as e:
+            logger.info(f"No usable allowlist copy at {path}: {e}")
+
+    def save(self, path=STATE_FILE):
+        # Survives a daemon restart while the controller is down.
+        with self.lock:
+            entries = list(self.exact.items()) + [
+                (f"{(ipaddress.IPv4Address if family == 4 else ipaddress.IPv6Address)(net)}/{length}", expiry)
+                for (family, length, net), expiry in self.prefixes.items()
+            ]
+            state = {"version": self.version, "entries": entries}
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(state, f, separators=(",", ":"))
+        os.replace(tmp, path)
+
+
+class AllowlistSync:
+    # Long-polls GET /allowlist with If-None-Match: "<version>" and applies
+    # the signed full snapshot or delta it returns. Bodies whose signature
+    # does not match, and full snapshots older than the copy, are ignored.
+    def __init__(self, api_url, token, key, local, wait=SYNC_WAIT, retry=SYNC_RETRY):
+        parts = urlsplit(urljoin(api_url, "allowlist"))
+        self.connection_class = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = f"{parts.path}?wait={wait}"
+        self.token = token
+        self.key = key.encode()
+        self.local = local
+        self.wait = wait
+        self.retry = retry
+        self.stats = {"full": 0, "delta": 0, "not_modified": 0, "rejected": 0, "failed": 0}
+
+    def poll(self, conn):
+        headers = {"X-Guard-Token": self.token}
+        if self.local.version:
+            headers["If-None-Match"] = f'"{self.local.version}"'
+        conn.request("GET", self.path, headers=headers)
+        response = conn.getresponse()
+        body = response.read()
+        if response.status == 304:
+            self.stats["not_modified"] += 1
+            return
+        if response.status != 200:
+            raise http.client.HTTPException(f"/allowlist returned {response.status}")
+        expected = hmac.new(self.key, body, hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(expected, response.getheader("X-Signature", "")):
+            self.stats["rejected"] += 1
+            raise http.client.HTTPException("bad allowlist signature")
+        data = json.loads(body)
+        if data["full"] and data["version"] < self.local.version:
+            self.stats["rejected"] += 1
+            return
+        self.local.apply(data["entries"], data["version"], data["full"])
+        self.stats["full" if data["full"] else "delta"] += 1
+        self.local.save()
+
+    def run(self):
+        conn = None
+        while True:
+            if conn is None:
+                conn = self.connection_class(self.host, self.port, timeout=self.wait + 10)
+            try:
+                self.poll(conn)
+            except (OSError, ValueError, KeyError, http.client.HTTPException) as e:
+                self.stats["failed"] += 1
+                logger.warning(f"Allowlist sync failed, retrying in {self.retry}s: {e}")
+                conn.close()
+                conn = None
+                time.sleep(self.retry)
+
+
+class CommandBatcher:
+    # Packs command records into {"token": ..., "records": [...]} envelopes,
+    # which the controller's ingest unpacks. A datagram goes out when the
+    # next record would push it past MAX_DATAGRAM, or FLUSH_INTERVAL after
+    # its first record, whichever comes first.
+    def __init__(self, log_host, token, key="", max_datagram=MAX_DATAGRAM, flush_interval=FLUSH_INTERVAL):
+        self.address = (log_host, LOG_PORT)
+        self.key = key.encode()
+        self.prefix = '{"token":%s,"records":[' % json.dumps(token)
+        self.budget = max_datagram - len(self.prefix) - 2
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(QUEUE_SIZE)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.stats = {"records": 0, "datagrams": 0, "dropped": 0, "failed": 0}
+
+    def put(self, user, ip, cmd):
+        self.put_record({"type": "cmd", "user": user, "ip": ip, "cmd": cmd[:MAX_COMMAND]})
+
+    def put_access(self, user, ip):
+        # Logins admitted locally still land in the controller's history,
+        # signed with the sync key so the token alone cannot forge them
+        # (snapshot.access_message on the controller).
+        ts = int(time.time())
+        sig = hmac.new(self.key, f"access\n{ip}\n{user}\n{ts}".encode(), hashlib.sha256).hexdigest()
+        self.put_record({"type": "access", "user": user, "ip": ip, "status": "ALLOWED", "ts": ts, "sig": sig})
+
+    def put_record(self, record):
+        record.setdefault("ts", int(time.time()))
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.stats["dropped"] += 1
+
+    def flush(self, pending):
+        if not pending:
+            return
+        data = (self.prefix + ",".join(pending) + "]}").encode()
+        try:
+            self.sock.sendto(data, self.address)
+            self.stats["datagrams"] += 1
+            self.stats["records"] += len(pending)
+        except OSError as e:
+            self.stats["failed"] += 1
+            logger.warning(f"Could not send {len(pending)} records to {self.address[0]}: {e}")
+
+    def run(self):
+        pending, size, deadline = [], 0, None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                record = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                self.flush(pending)
+                pending, size, deadline = [], 0, None
+                continue
+            encoded = json.dumps(record, separators=(",", ":"))
+            if pending and size + len(encoded) + 1 > self.budget:
+                self.flush(pending)
+                pending, size, deadline = [], 0, None
+            pending.append(encoded)
+            size += len(encoded) + 1
+            if deadline is None:
+                deadline = time.monotonic() + self.flush_interval
+            elif time.monotonic() >= deadline:
+                self.flush(pending)
+                pending, size, deadline = [], 0, None
+
+
+class CheckHandler(socketserver.StreamRequestHandler):
+    # One request per connection; closing after the answer lets a plain
+    # `nc -U` client exit without extra flags.
+    timeout = 10
+
+    def handle(self):
+        try:
+            line = self.rfile.readline(1024).decode(errors="replace").split()
+        except OSError:
+            return
+        if len(line) == 3 and line[0] == "CHECK":
+            status = self.server.check(line[1], line[2])
+            self.wfile.write(f"{status:03d}\n".encode())
+        else:
+            self.wfile.write(b"400\n")
+
+
+class CheckServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, controller, local=None, batcher=None):
+        if os.path.exists(path):
+            os.unlink(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        super().__init__(path, CheckHandler)
+        # Every login user runs the hooks as themselves.
+        os.chmod(path, 0o666)
+        self.controller = controller
+        # Local decisions need the batcher to report them, or history
+        # would miss those logins.
+        self.local = local if batcher is not None else None
+        self.batcher = batcher
+        self.stats = {"local": 0}
+
+    def check(self, ip, user):
+        if self.local is not None and self.local.allows(ip):
+            self.stats["local"] += 1
+            self.batcher.put_access(user, ip)
+            return 200
+        return self.controller.check(ip, user)
+
+
+def send_heartbeats(batcher, local=None, interval=HEARTBEAT_INTERVAL):
+    # Beats carry the installed bundle and allowlist copy version for the
+    # controller's fleet health view. Jitter keeps a fleet restarted
+    # together from beating in lockstep.
+    while True:
+        try:
+            with open(BUNDLE_FILE) as f:
+                bundle = f.read().strip()
+        except OSError:
+            bundle = ""
+        batcher.put_record({"type": "heartbeat", "bundle": bundle, "synced": local.version if local else 0})
+        time.sleep(interval * random.uniform(0.9, 1.1))
+
+
+def serve_commands(batcher, port=UDP_PORT):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", port))
+    while True:
+        data, _ = sock.recvfrom(65535)
+        parts = data.decode(errors="replace").split("\t", 3)
+        if len(parts) == 4 and parts[0] == "cmd" and parts[3].strip():
+            batcher.put(parts[1] or "?", parts[2] or "LOCAL", parts[3])
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    env = load_env()
+    api_url, token, log_host = env.get("API_URL"), env.get("API_TOKEN", ""), env.get("LOG_HOST")
+    if not api_url:
+        logger.error("API_URL missing; nothing to serve")
+        return 1
+
+    controller = Controller(api_url, token)
+    batcher = local = sync = None
+    key = read_key()
+    if log_host:
+        batcher = CommandBatcher(log_host, token, key)
+        threading.Thread(target=batcher.run, daemon=True).start()
+        threading.Thread(target=serve_commands, args=(batcher,), daemon=True).start()
+    if key:
+        local = LocalAllowlist()
+        local.load()
+        sync = AllowlistSync(api_url, token, key, local)
+        threading.Thread(target=sync.run, daemon=True).start()
+    if batcher is not None:
+        threading.Thread(target=send_heartbeats, args=(batcher, local), daemon=True).start()
+    server = CheckServer(SOCKET_PATH, controller, local, batcher)
+
+    def stop(signum, frame):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    logger.info(f"sg-agentd serving {SOCKET_PATH} and 127.0.0.1:{UDP_PORT} for {api_url}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(SOCKET_PATH):
+            os.unlink(SOCKET_PATH)
+        logger.info(f"sg-agentd stopped: checks {controller.stats} {server.stats}, "
+                    f"commands {batcher.stats if batcher else {}}, sync {sync.stats if sync else {}}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
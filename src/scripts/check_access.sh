@@ -10,8 +10,9 @@ fi
 LOG_FILE="/tmp/sg-debug.log"
 
 # 3. ULTIMATE TOKEN SANITIZATION
-# Trim whitespace
-API_TOKEN=$(echo "$API_TOKEN" | xargs)
+# Trim whitespace (parameter expansion, no subprocess)
+API_TOKEN="${API_TOKEN#"${API_TOKEN%%[![:space:]]*}"}"
+API_TOKEN="${API_TOKEN%"${API_TOKEN##*[![:space:]]}"}"
 
 # Check for bad values
 if [ "$API_TOKEN" = "None" ] || [ "$API_TOKEN" = "null" ] || [ -z "$API_TOKEN" ]; then
@@ -29,11 +30,11 @@ fi
 
 # 5. Get Connection Info
 if [ -n "$SSH_CONNECTION" ]; then
-    IP=$(echo "$SSH_CONNECTION" | awk '{print $1}')
+    IP="${SSH_CONNECTION%% *}"
 else
     IP="127.0.0.1"
 fi
-USER=$(whoami)
+USER="${USER:-$(id -un)}"
 
 # 6. Bypass Localhost
 if [ "$IP" = "127.0.0.1" ] || [ "$IP" = "::1" ]; then
@@ -41,11 +42,24 @@ if [ "$IP" = "127.0.0.1" ] || [ "$IP" = "::1" ]; then
 fi
 
 # 7. Execute Request
-HTTP_CODE=$(curl -4 -m 3 -s -o /dev/null -w "%{http_code}" \
-    -H "X-Guard-Token: $API_TOKEN" \
-    "${API_URL}?ip=${IP}&user=${USER}" 2>>$LOG_FILE)
-
-CURL_RET=$?
+# sg-agentd answers over its keep-alive connection to the controller
+# ("000" when the controller is unreachable); curl only runs when the
+# daemon is not there.
+AGENTD_SOCKET="/run/server-guard/agentd.sock"
+HTTP_CODE=""
+CURL_RET=0
+if [ -S "$AGENTD_SOCKET" ]; then
+    HTTP_CODE=$(printf 'CHECK %s %s\n' "$IP" "$USER" | nc -U -w 5 "$AGENTD_SOCKET" 2>>$LOG_FILE)
+    if [ "$HTTP_CODE" = "000" ]; then
+        CURL_RET=7
+    fi
+fi
+if [ -z "$HTTP_CODE" ]; then
+    HTTP_CODE=$(curl -4 -m 3 -s -o /dev/null -w "%{http_code}" \
+        -H "X-Guard-Token: $API_TOKEN" \
+        "${API_URL}?ip=${IP}&user=${USER}" 2>>$LOG_FILE)
+    CURL_RET=$?
+fi
 
 # 8. Handle Curl Errors
 if [ $CURL_RET -ne 0 ]; then
@@ -0,0 +1,119 @@
+import os
+import hmac
+import json
+import time
+import hashlib
+import logging
+import secrets
+
+logger = logging.getLogger("ServerGuard.snapshot")
+
+# --- Configuration ---
+# Agents keep a copy of the allowlist synced from GET /allowlist. Bodies are
+# HMAC-SHA256 signed with a per-agent key derived from this secret and the
+# agent's token; the key is handed over once by the SSH deploy and never
+# travels over HTTP, so a party that sees the token still cannot forge one.
+SECRET_FILE = os.getenv("ALLOWLIST_SECRET_FILE",
+                        os.path.join(os.path.dirname(os.getenv("DB_PATH", "/data/guard.db")), "allowlist.key"))
+# Upper bound on ?wait= for long-polling agents.
+MAX_WAIT = 30
+# Logins an agent admitted from its copy arrive over UDP signed with the
+# same key; older ones are refused so a captured record cannot be replayed
+# much later.
+ACCESS_MAX_AGE = 300
+
+
+def load_secret(path=SECRET_FILE):
+    # Generated on first start. link() only succeeds for one of several
+    # workers starting together, and readers never see a partial file.
+    try:
+        with open(path, "rb") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        pass
+    tmp = f"{path}.{os.getpid()}.tmp"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        f.write(secrets.token_hex(32).encode())
+        f.flush()
+        os.fsync(f.fileno())
+    try:
+        os.link(tmp, path)
+        logger.info(f"Generated allowlist signing secret at {path}")
+    except FileExistsError:
+        pass
+    finally:
+        os.unlink(tmp)
+    with open(path, "rb") as f:
+        return f.read().strip()
+
+
+def access_message(ip, user, ts):
+    # What sg-agentd signs for an "access" record (see CommandBatcher.put_access).
+    return f"access\n{ip}\n{user}\n{ts}".encode()
+
+
+def parse_etag(value):
+    # '"123"' or 'W/"123"' -> 123; anything else -> None (full snapshot).
+    if not value:
+        return None
+    value = value.strip()
+    if value.startswith("W/"):
+        value = value[2:]
+    try:
+        return int(value.strip('"'))
+    except ValueError:
+        return None
+
+
+class SnapshotFeed:
+    # Renders Allowlist.changes_since() for agents. The full snapshot is
+    # serialized once per allowlist version however many agents fetch it.
+    def __init__(self, allowlist, secret=None):
+        self.allowlist = allowlist
+        self.secret = secret
+        self.keys = {}
+        self.full = (None, None)
+        self.stats = {"full": 0, "delta": 0, "not_modified": 0}
+
+    def agent_key(self, token):
+        # "" until the secret is loaded; deploys then install without sync.
+        if not self.secret:
+            return ""
+        key = self.keys.get(token)
+        if key is None:
+            key = self.keys[token] = hmac.new(self.secret, f"agent:{token}".encode(), hashlib.sha256).hexdigest()
+        return key
+
+    def sign(self, token, body):
+        return hmac.new(self.agent_key(token).encode(), body, hashlib.sha256).hexdigest()
+
+    def verify_access(self, token, ip, user, ts, signature, now=None):
+        # The key never crosses the network, so knowing the token (which sits
+        # in a world-readable agent.env) is not enough to forge a record.
+        if not self.secret or not isinstance(signature, str) or not isinstance(ts, int):
+            return False
+        if abs((now or time.time()) - ts) > ACCESS_MAX_AGE:
+            return False
+        return hmac.compare_digest(self.sign(token, access_message(ip, user, ts)), signature)
+
+    def render(self, since=None):
+        # (version, body). since=None is the full snapshot, otherwise only
+        # entries approved after that version.
+        version = self.allowlist.version
+        if since is None:
+            self.stats["full"] += 1
+            if self.full[0] == version:
+                return self.full
+        else:
+            self.stats["delta"] += 1
+        entries = self.allowlist.changes_since(since or 0)
+        body = json.dumps({
+            "version": version,
+            "full": since is None,
+            "generated": int(time.time()),
+            "entries": [[entry, expiry] for entry, expiry, _ in entries],
+        }, separators=(",", ":")).encode()
+        if since is None:
+            self.full = (version, body)
+        return version, body
@@ -0,0 +1,266 @@
+import os
+import time
+import asyncio
+import logging
+import contextlib
+from collections import OrderedDict
+
+logger = logging.getLogger("ServerGuard.sshpool")
+
+# --- Configuration ---
+# Connections to agent hosts are kept open and reused by fleet operations.
+# The controller authenticates with its own fleet key, which deploys add to
+# the host's authorized_keys when the admin opts in, so no password has to
+# be stored; a password or key given at deploy time is only kept in memory
+# as a fallback (and is all there is for hosts deployed without the key).
+FLEET_KEY = os.getenv("FLEET_SSH_KEY",
+                      os.path.join(os.path.dirname(os.getenv("DB_PATH", "/data/guard.db")), "fleet_ed25519"))
+POOL_MAX = int(os.getenv("SSH_POOL_MAX", "1000"))
+POOL_IDLE = float(os.getenv("SSH_POOL_IDLE", "600"))
+POOL_CONCURRENCY = int(os.getenv("SSH_POOL_CONCURRENCY", "100"))
+OP_TIMEOUT = float(os.getenv("SSH_OP_TIMEOUT", "20"))
+CONNECT_TIMEOUT = 15
+KEEPALIVE = 30
+REAP_INTERVAL = 30
+
+SCHEMA = (
+    # host_key is pinned on the first connection (trust on first use); every
+    # later one, deploys included, refuses any other key until an admin
+    # clears the pin with /unpin.
+    """CREATE TABLE IF NOT EXISTS fleet_hosts (
+        ip TEXT PRIMARY KEY,
+        port INTEGER NOT NULL DEFAULT 22,
+        user TEXT NOT NULL DEFAULT 'root',
+        host_key TEXT,
+        updated INTEGER
+    )""",
+)
+
+
+async def create_schema(conn):
+    for statement in SCHEMA:
+        await conn.execute(statement)
+
+
+class HostKeyChanged(Exception):
+    pass
+
+
+def load_fleet_key(path=FLEET_KEY):
+    # Generated on first use; returns (private key, "ssh-ed25519 AAAA... comment").
+    import asyncssh
+    if not os.path.exists(path):
+        key = asyncssh.generate_private_key("ssh-ed25519", comment="serverguard-fleet")
+        tmp = f"{path}.{os.getpid()}.tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(key.export_private_key())
+        os.replace(tmp, path)
+        logger.info(f"Generated fleet SSH key at {path}")
+    key = asyncssh.read_private_key(path)
+    return key, key.export_public_key().decode().strip()
+
+
+class SSHPool:
+    # One multiplexed connection per host, LRU-ordered. Concurrent callers
+    # for the same host share a single connect; at most `concurrency`
+    # operations run at once; connections idle for `idle_timeout` (or the
+    # least recently used beyond `max_size`) are closed by the reaper.
+    def __init__(self, db, key_path=FLEET_KEY, max_size=POOL_MAX, idle_timeout=POOL_IDLE,
+                 concurrency=POOL_CONCURRENCY):
+        self.db = db
+        self.key_path = key_path
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.concurrency = concurrency
+        self.hosts = {}
+        self.secrets = {}
+        self.conns = OrderedDict()
+        self.pending = {}
+        self.busy = {}
+        self.fleet_key = None
+        self.public_key = None
+        self.sem = None
+        self.reaper = None
+        self.stats = {"connects": 0, "reused": 0, "evicted": 0, "failed": 0, "ops": 0, "host_key_mismatch": 0}
+
+    async def load(self):
+        rows = await self.db.fetchall("SELECT ip, port, user, host_key FROM fleet_hosts")
+        self.hosts = {ip: [port, user, host_key] for ip, port, user, host_key in rows}
+        try:
+            self.fleet_key, self.public_key = await asyncio.to_thread(load_fleet_key, self.key_path)
+        except (OSError, ValueError) as e:
+            logger.error(f"Fleet SSH key unavailable, pooled connections need deploy credentials: {e}")
+
+    def start(self):
+        self.sem = asyncio.Semaphore(self.concurrency)
+        if self.reaper is None:
+            self.reaper = asyncio.create_task(self.reap())
+
+    async def stop(self):
+        if self.reaper is not None:
+            self.reaper.cancel()
+            await asyncio.gather(self.reaper, return_exceptions=True)
+            self.reaper = None
+        conns = [conn for conn, _ in self.conns.values()]
+        self.conns.clear()
+        for conn in conns:
+            conn.close()
+        await asyncio.gather(*(conn.wait_closed() for conn in conns), return_exceptions=True)
+
+    async def remember(self, ip, port, user, password=None, key_file=None):
+        # Called by deploys. The key file is read now because the caller
+        # deletes its temporary copy afterwards.
+        if key_file:
+            import asyncssh
+            key = await asyncio.to_thread(asyncssh.read_private_key, key_file)
+        else:
+            key = None
+        self.secrets[ip] = (password, key)
+        host_key = self.hosts.get(ip, [None, None, None])[2]
+        self.hosts[ip] = [port, user, host_key]
+        await self.db.execute(
+            "INSERT INTO fleet_hosts (ip, port, user, updated) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (ip) DO UPDATE SET port = excluded.port, user = excluded.user, updated = excluded.updated",
+            (ip, port, user, int(time.time())))
+
+    async def _pin(self, ip, host_key):
+        self.hosts[ip][2] = host_key
+        await self.db.execute("UPDATE fleet_hosts SET host_key = ?, updated = ? WHERE ip = ?",
+                              (host_key, int(time.time()), ip))
+
+    async def unpin(self, ip):
+        # For a host that was really reinstalled: the next connection pins
+        # whatever key it presents. False if the host is unknown.
+        if ip not in self.hosts:
+            return False
+        self.discard(ip)
+        await self._pin(ip, None)
+        return True
+
+    async def _connect(self, ip):
+        import asyncssh
+        if ip not in self.hosts:
+            raise KeyError(f"{ip} was never deployed from this controller")
+        port, user, host_key = self.hosts[ip]
+        password, key = self.secrets.get(ip, (None, None))
+        keys = [k for k in (key, self.fleet_key) if k is not None]
+        known_hosts = ([asyncssh.import_public_key(host_key)], [], []) if host_key else None
+        try:
+            conn = await asyncssh.connect(ip, port=port, username=user, password=password, client_keys=keys or None,
+                                          known_hosts=known_hosts, connect_timeout=CONNECT_TIMEOUT,
+                                          keepalive_interval=KEEPALIVE)
+        except asyncssh.HostKeyNotVerifiable:
+            self.stats["host_key_mismatch"] += 1
+            logger.error(f"Host key of {ip} does not match the pinned one, refusing to connect")
+            raise HostKeyChanged(f"host key of {ip} changed since it was pinned; "
+                                 f"if the host was reinstalled, run /unpin {ip} and deploy again") from None
+        self.stats["connects"] += 1
+        if not host_key:
+            await self._pin(ip, conn.get_server_host_key().export_public_key().decode().strip())
+        # Drop the pooled entry as soon as the connection dies.
+        watcher = asyncio.ensure_future(conn.wait_closed())
+        watcher.add_done_callback(lambda _: self._forget(ip, conn))
+        return conn
+
+    def _forget(self, ip, conn):
+        current = self.conns.get(ip)
+        if current is not None and current[0] is conn:
+            del self.conns[ip]
+
+    async def get(self, ip, fresh=False):
+        # fresh=True (deploys) opens a new connection with the current
+        # credentials instead of reusing the pooled one.
+        entry = self.conns.get(ip)
+        if entry is not None and not fresh:
+            self.conns.move_to_end(ip)
+            self.stats["reused"] += 1
+            return entry[0]
+        task = self.pending.get(ip)
+        if task is None:
+            task = self.pending[ip] = asyncio.ensure_future(self._connect(ip))
+            task.add_done_callback(lambda _: self.pending.pop(ip, None))
+        try:
+            conn = await asyncio.shield(task)
+        except Exception:
+            self.stats["failed"] += 1
+            raise
+        old = self.conns.pop(ip, None)
+        if old is not None and old[0] is not conn:
+            old[0].close()
+        self.conns[ip] = (conn, time.monotonic())
+        self._trim()
+        return conn
+
+    def discard(self, ip):
+        entry = self.conns.pop(ip, None)
+        if entry is not None:
+            entry[0].close()
+
+    def _trim(self):
+        # Over max_size: close least recently used connections nobody is using.
+        for ip in list(self.conns):
+            if len(self.conns) <= self.max_size:
+                break
+            if not self.busy.get(ip):
+                self.discard(ip)
+                self.stats["evicted"] += 1
+
+    @contextlib.asynccontextmanager
+    async def connection(self, ip, fresh=False):
+        conn = await self.get(ip, fresh)
+        self.busy[ip] = self.busy.get(ip, 0) + 1
+        try:
+            yield conn
+        finally:
+            self.busy[ip] -= 1
+            if not self.busy[ip]:
+                del self.busy[ip]
+            if ip in self.conns:
+                self.conns[ip] = (self.conns[ip][0], time.monotonic())
+
+    async def run(self, ip, op, timeout=OP_TIMEOUT):
+        # op(conn, ip) under the concurrency cap. A pooled connection that
+        # turns out to be dead gets one retry on a fresh one.
+        import asyncssh
+        if self.sem is None:
+            self.start()
+        async with self.sem:
+            self.stats["ops"] += 1
+            for attempt in (0, 1):
+                reused = ip in self.conns
+                try:
+                    async with self.connection(ip) as conn:
+                        return await asyncio.wait_for(op(conn, ip), timeout)
+                except (asyncssh.ConnectionLost, asyncssh.ChannelOpenError, BrokenPipeError):
+                    self.discard(ip)
+                    if not reused or attempt:
+                        raise
+
+    async def map(self, ips, op, timeout=OP_TIMEOUT, on_result=None):
+        # Runs op on every host in parallel; {ip: (ok, result or error, seconds)}.
+        results = {}
+
+        async def one(ip):
+            started = time.monotonic()
+            try:
+                result = (True, await self.run(ip, op, timeout))
+            except asyncio.TimeoutError:
+                result = (False, f"timed out after {timeout:.0f}s")
+            except Exception as e:
+                result = (False, str(e) or type(e).__name__)
+            results[ip] = result + (time.monotonic() - started,)
+            if on_result is not None:
+                on_result(ip, *results[ip])
+
+        await asyncio.gather(*(one(ip) for ip in ips))
+        return results
+
+    async def reap(self, interval=REAP_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            cutoff = time.monotonic() - self.idle_timeout
+            for ip, (conn, last_used) in list(self.conns.items()):
+                if last_used < cutoff and not self.busy.get(ip):
+                    self.discard(ip)
+                    self.stats["evicted"] += 1
@@ -0,0 +1,121 @@
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+import aiosqlite
+
+import metrics
+
+logger = logging.getLogger("ServerGuard.storage")
+
+# --- Connection Tuning ---
+# WAL lets the reader pool run alongside the single writer; NORMAL sync is
+# durable across process crashes and only risks the last commit on power loss.
+# auto_vacuum only takes effect on a DB without tables yet (see retention.py).
+PRAGMAS = (
+    "PRAGMA auto_vacuum=INCREMENTAL",
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=134217728",
+    "PRAGMA busy_timeout=5000",
+)
+READER_PRAGMAS = ("PRAGMA query_only=1",)
+
+# sqlite3 keeps compiled statements per connection; with long-lived
+# connections every helper query is prepared once and reused.
+STATEMENT_CACHE = 256
+READERS = 4
+
+QUERY_SECONDS = metrics.histogram("sg_sqlite_query_seconds", "SQLite statement time including pool wait", ("op",))
+FETCHONE = QUERY_SECONDS.labels("fetchone")
+FETCHALL = QUERY_SECONDS.labels("fetchall")
+EXECUTE = QUERY_SECONDS.labels("execute")
+EXECUTEMANY = QUERY_SECONDS.labels("executemany")
+
+
+class Storage:
+    def __init__(self, path, readers=READERS):
+        self.path = path
+        self.reader_count = readers
+        self.writer = None
+        self._readers = asyncio.Queue()
+        self._connections = []
+        self._write_lock = asyncio.Lock()
+
+    async def _connect(self, pragmas):
+        conn = await aiosqlite.connect(self.path, cached_statements=STATEMENT_CACHE)
+        for pragma in pragmas:
+            await conn.execute(pragma)
+        self._connections.append(conn)
+        return conn
+
+    async def open(self):
+        if self.writer is not None:
+            return
+        # Writer first so the WAL switch is persisted before readers attach.
+        self.writer = await self._connect(PRAGMAS)
+        for _ in range(self.reader_count):
+            conn = await self._connect(PRAGMAS + READER_PRAGMAS)
+            self._readers.put_nowait(conn)
+        logger.info(f"Storage open: {self.path} (1 writer, {self.reader_count} readers, WAL)")
+
+    async def close(self):
+        async with self._write_lock:
+            for conn in self._connections:
+                try:
+                    await conn.close()
+                except Exception as e:
+                    logger.error(f"Storage close failed: {e}")
+            self._connections.clear()
+            self.writer = None
+            self._readers = asyncio.Queue()
+
+    @asynccontextmanager
+    async def read(self):
+        conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def write(self):
+        async with self._write_lock:
+            try:
+                yield self.writer
+                await self.writer.commit()
+            except Exception:
+                await self.writer.rollback()
+                raise
+
+    async def fetchone(self, sql, params=()):
+        started = time.perf_counter()
+        async with self.read() as conn:
+            async with conn.execute(sql, params) as cursor:
+                row = await cursor.fetchone()
+        FETCHONE.observe(time.perf_counter() - started)
+        return row
+
+    async def fetchall(self, sql, params=()):
+        started = time.perf_counter()
+        async with self.read() as conn:
+            async with conn.execute(sql, params) as cursor:
+                rows = await cursor.fetchall()
+        FETCHALL.observe(time.perf_counter() - started)
+        return rows
+
+    async def execute(self, sql, params=()):
+        started = time.perf_counter()
+        async with self.write() as conn:
+            cursor = await conn.execute(sql, params)
+        EXECUTE.observe(time.perf_counter() - started)
+        return cursor.rowcount
+
+    async def executemany(self, sql, rows):
+        started = time.perf_counter()
+        async with self.write() as conn:
+            await conn.executemany(sql, rows)
+        EXECUTEMANY.observe(time.perf_counter() - started)
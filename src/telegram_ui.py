@@ -0,0 +1,636 @@
+import os
+import time
+import asyncio
+import logging
+from aiogram import Bot, Dispatcher, Router, types, F
+from aiogram.filters import Command
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, BufferedInputFile
+from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.enums import ParseMode
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.memory import MemoryStorage
+from dispatcher import escape
+from allowlist import normalize
+import fleet
+import audit
+import geoip
+import heartbeat
+import history
+import profiler
+
+logger = logging.getLogger("ServerGuard.telegram")
+
+# Admin chat UI. bot.py imports this module only after its HTTP and UDP
+# listeners are up: aiogram alone takes seconds to import, and nothing on
+# the /check-access path needs it. `core` is the controller module.
+core = None
+bot = None
+router = Router()
+
+def setup(controller):
+    global core, bot
+    core = controller
+    session = AiohttpSession(api=TelegramAPIServer.from_base(core.TG_API_SERVER)) if core.TG_API_SERVER else None
+    bot = Bot(token=core.TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    dp = Dispatcher(storage=MemoryStorage())
+    dp.include_router(router)
+    return bot, dp
+
+# --- FSM States ---
+class AddServer(StatesGroup):
+    ip = State()
+    port = State()
+    user = State()
+    auth_method = State()
+    access = State()
+    credentials = State()
+
+class FleetDeploy(StatesGroup):
+    hosts = State()
+    auth_method = State()
+    access = State()
+    credentials = State()
+
+# --- SSH Deployment Logic ---
+async def register_agent(ip):
+    return await core.add_server_db(f"Agent {ip}", ip)
+
+def is_registered(ip):
+    return ip in core.servers.token_by_ip
+
+async def deploy_agent(ip, port, user, password=None, key_file=None, fleet_access=False):
+    try:
+        bundle = fleet.build_bundle()
+    except FileNotFoundError as e:
+        return False, str(e)
+    status, log = await fleet.deploy_host(core.pool, ip, port, user, bundle, register_agent, core.API_URL, core.PUBLIC_IP,
+                                          password, key_file, force=True, agent_key=core.feed.agent_key,
+                                          fleet_access=fleet_access)
+    return status != "failed", log
+
+async def deploy_fleet(hosts, status_msg, password=None, key_file=None, fleet_access=False):
+    counts = {"installed": 0, "skipped": 0, "failed": 0}
+    failures = []
+
+    def render(done=False):
+        title = "✅ <b>Fleet deploy finished</b>" if done else "⏳ <b>Fleet deploy running</b>"
+        finished = sum(counts.values())
+        msg = (f"{title}\n{finished}/{len(hosts)} hosts\n"
+               f"🆕 installed: {counts['installed']} | ⏭ skipped: {counts['skipped']} | ❌ failed: {counts['failed']}")
+        for ip, detail in failures[:20]:
+            msg += f"\n❌ <code>{escape(ip)}</code>: {escape(detail[:120])}"
+        return msg
+
+    def on_result(ip, status, detail):
+        counts[status] += 1
+        if status == "failed":
+            failures.append((ip, detail))
+
+    async def refresh():
+        last = None
+        while True:
+            await asyncio.sleep(3)
+            text = render()
+            if text != last:
+                try:
+                    await status_msg.edit_text(text)
+                    last = text
+                except Exception as e:
+                    logger.warning(f"Fleet progress update failed: {e}")
+
+    updater = asyncio.create_task(refresh())
+    try:
+        await fleet.deploy_fleet(core.pool, hosts, register_agent, core.API_URL, core.PUBLIC_IP, password, key_file,
+                                 is_registered=is_registered, on_result=on_result, agent_key=core.feed.agent_key,
+                                 fleet_access=fleet_access)
+    finally:
+        updater.cancel()
+    await status_msg.edit_text(render(done=True))
+
+async def ask_fleet_access(message: types.Message, user):
+    # Opt-in for the controller's fleet key; see fleet.deploy_host.
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🗝 Install fleet key", callback_data="access_yes")],
+        [InlineKeyboardButton(text="🚫 Deploy only", callback_data="access_no")]
+    ])
+    await message.answer(
+        "🗝 <b>Fleet access</b>\n"
+        f"Install this controller's SSH key in <b>{escape(user)}</b>'s authorized_keys on the target? "
+        "It gives the controller <b>permanent passwordless SSH</b> for fleet status, session kills and "
+        "config pushes. Without it those only work until the controller restarts, and a redeploy "
+        "without it removes a key installed earlier.",
+        reply_markup=kb)
+
+async def read_credentials(message: types.Message, auth_method, tag):
+    if auth_method == "pass":
+        return message.text, None
+    if not message.document:
+        return None, None
+    file = await bot.get_file(message.document.file_id)
+    key_file = f"/tmp/key_{tag}_{int(time.time())}"
+    await bot.download_file(file.file_path, key_file)
+    os.chmod(key_file, 0o600)
+    return None, key_file
+
+# --- Telegram Handlers ---
+
+@router.message(Command("start"))
+async def cmd_start(message: types.Message):
+    if message.from_user.id != core.ADMIN_ID:
+        return
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="➕ Add Server", callback_data="add_server")],
+        [InlineKeyboardButton(text="🚀 Fleet Deploy", callback_data="fleet_deploy")],
+        [InlineKeyboardButton(text="🩺 Fleet Status", callback_data="fleet_status")],
+        [InlineKeyboardButton(text="💓 Agent Health", callback_data="fleet_health")],
+        [InlineKeyboardButton(text="📜 History", callback_data="menu_history")],
+        [InlineKeyboardButton(text="🔐 Whitelist", callback_data="menu_whitelist")]
+    ])
+    await message.answer(
+        f"🛡 <b>Server Guard Controller</b>\nIP: <code>{core.PUBLIC_IP}</code>\n\nSystem Online.",
+        reply_markup=kb
+    )
+
+@router.callback_query(F.data == "add_server")
+async def start_add_server(call: types.CallbackQuery, state: FSMContext):
+    await call.message.answer("🌐 Enter <b>IP Address</b> of new server:")
+    await state.set_state(AddServer.ip)
+    await call.answer()
+
+@router.message(AddServer.ip)
+async def process_ip(message: types.Message, state: FSMContext):
+    await state.update_data(ip=message.text.strip())
+    await message.answer("🔌 Enter SSH Port (default 22):")
+    await state.set_state(AddServer.port)
+
+@router.message(AddServer.port)
+async def process_port(message: types.Message, state: FSMContext):
+    txt = message.text.strip()
+    port = int(txt) if txt.isdigit() else 22
+    await state.update_data(port=port)
+    await message.answer("👤 Enter SSH Username (default root):")
+    await state.set_state(AddServer.user)
+
+@router.message(AddServer.user)
+async def process_user(message: types.Message, state: FSMContext):
+    user = message.text.strip() or "root"
+    await state.update_data(user=user)
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔑 Password", callback_data="auth_pass")],
+        [InlineKeyboardButton(text="📄 SSH Key", callback_data="auth_key")]
+    ])
+    await message.answer("🔐 Auth Method:", reply_markup=kb)
+    await state.set_state(AddServer.auth_method)
+
+@router.callback_query(AddServer.auth_method)
+async def process_auth_method(call: types.CallbackQuery, state: FSMContext):
+    method = call.data.split("_")[1]
+    await state.update_data(auth_method=method)
+    await ask_fleet_access(call.message, (await state.get_data())['user'])
+    await state.set_state(AddServer.access)
+    await call.answer()
+
+@router.callback_query(AddServer.access)
+async def process_access(call: types.CallbackQuery, state: FSMContext):
+    await state.update_data(fleet_access=call.data == "access_yes")
+    if (await state.get_data())['auth_method'] == "pass":
+        await call.message.answer("⌨️ Enter Password:")
+    else:
+        await call.message.answer("📂 Send Private Key File:")
+    await state.set_state(AddServer.credentials)
+    await call.answer()
+
+@router.message(AddServer.credentials)
+async def process_credentials(message: types.Message, state: FSMContext):
+    data = await state.get_data()
+    auth_method = data['auth_method']
+    status_msg = await message.answer(f"⏳ Connecting to {data['ip']}...")
+    
+    password, key_file = await read_credentials(message, auth_method, data['ip'])
+    if not password and not key_file:
+        await message.answer("❌ File expected.")
+        return
+
+    success, log = await deploy_agent(data['ip'], data['port'], data['user'], password, key_file,
+                                      data.get('fleet_access', False))
+    if key_file and os.path.exists(key_file):
+        os.remove(key_file)
+        
+    if success:
+        await status_msg.edit_text(f"✅ <b>Success!</b>\nServer {data['ip']} attached.")
+    else:
+        clean_log = str(log).replace("<", "&lt;")[:3000]
+        await status_msg.edit_text(f"❌ <b>Failed:</b>\n<pre>{clean_log}</pre>")
+    await state.clear()
+
+@router.callback_query(F.data == "fleet_deploy")
+async def start_fleet_deploy(call: types.CallbackQuery, state: FSMContext):
+    await call.message.answer(
+        "📋 Send the <b>host list</b> as text or a file.\n"
+        "One per line: <code>ip</code>, <code>ip:port</code> or <code>user@ip:port</code>"
+    )
+    await state.set_state(FleetDeploy.hosts)
+    await call.answer()
+
+@router.message(FleetDeploy.hosts)
+async def process_fleet_hosts(message: types.Message, state: FSMContext):
+    if message.document:
+        text = (await bot.download(message.document)).read().decode(errors="replace")
+    else:
+        text = message.text or ""
+    hosts = fleet.parse_hosts(text)
+    if not hosts:
+        await message.answer("❌ No hosts found. Send the list again:")
+        return
+    await state.update_data(hosts=hosts)
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔑 Password", callback_data="auth_pass")],
+        [InlineKeyboardButton(text="📄 SSH Key", callback_data="auth_key")]
+    ])
+    await message.answer(f"🖥 {len(hosts)} hosts. 🔐 Auth Method (shared):", reply_markup=kb)
+    await state.set_state(FleetDeploy.auth_method)
+
+@router.callback_query(FleetDeploy.auth_method)
+async def process_fleet_auth_method(call: types.CallbackQuery, state: FSMContext):
+    method = call.data.split("_")[1]
+    await state.update_data(auth_method=method)
+    users = sorted({h[2] for h in (await state.get_data())['hosts']})
+    await ask_fleet_access(call.message, ", ".join(users))
+    await state.set_state(FleetDeploy.access)
+    await call.answer()
+
+@router.callback_query(FleetDeploy.access)
+async def process_fleet_access(call: types.CallbackQuery, state: FSMContext):
+    await state.update_data(fleet_access=call.data == "access_yes")
+    if (await state.get_data())['auth_method'] == "pass":
+        await call.message.answer("⌨️ Enter Password:")
+    else:
+        await call.message.answer("📂 Send Private Key File:")
+    await state.set_state(FleetDeploy.credentials)
+    await call.answer()
+
+@router.message(FleetDeploy.credentials)
+async def process_fleet_credentials(message: types.Message, state: FSMContext):
+    data = await state.get_data()
+    password, key_file = await read_credentials(message, data['auth_method'], "fleet")
+    if not password and not key_file:
+        await message.answer("❌ File expected.")
+        return
+    await state.clear()
+    hosts = [tuple(h) for h in data['hosts']]
+    status_msg = await message.answer(f"⏳ Deploying to {len(hosts)} hosts...")
+    try:
+        await deploy_fleet(hosts, status_msg, password, key_file, data.get('fleet_access', False))
+    except FileNotFoundError as e:
+        await status_msg.edit_text(f"❌ <b>Failed:</b> {escape(e)}")
+    finally:
+        if key_file and os.path.exists(key_file):
+            os.remove(key_file)
+
+def parse_filters(text, keys):
+    # "/cmd key:value ... words" -> ({key: value}, "words"); since takes an age like 7d.
+    filters, words = {}, []
+    for part in text.split()[1:]:
+        key, _, value = part.partition(":")
+        if value and key in keys:
+            filters[key] = value
+        else:
+            words.append(part)
+    query = {}
+    for key, value in filters.items():
+        if key == "server":
+            if not value.isdigit():
+                raise ValueError(f"Bad server id: {value}")
+            query["server_id"] = int(value)
+        elif key == "since":
+            query["since"] = int(time.time()) - audit.parse_age(value)
+        elif key == "status":
+            query["status"] = value.upper()
+        else:
+            query[key] = value
+    return query, " ".join(words) or None
+
+def parse_search(text):
+    # "/search [user:x] [ip:x] [server:id] [since:7d] words..."
+    query, words = parse_filters(text, ("user", "ip", "server", "since"))
+    query["text"] = words
+    return query
+
+def render_search(rows, next_cursor):
+    if not rows:
+        return "🔎 No matching commands.", None
+    msg = "🔎 <b>Command Search:</b>\n"
+    for r in rows:
+        ts = time.strftime('%m-%d %H:%M', time.localtime(r[6]))
+        srv = escape(r[2]) if r[2] else "?"
+        where = geoip.label(core.geo.lookup(r[4]), org=False)
+        where = f" {where}" if where else ""
+        msg += f"🕒 {ts} <b>{srv}</b> | {escape(r[3])}@{escape(r[4])}{where}\n<code>{escape(r[5][:200])}</code>\n"
+    kb = None
+    if next_cursor is not None:
+        kb = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="▶️ Older", callback_data=f"search_next_{next_cursor}")]
+        ])
+    return msg[:4000], kb
+
+@router.message(Command("search"))
+async def cmd_search(message: types.Message, state: FSMContext):
+    if message.from_user.id != core.ADMIN_ID:
+        return
+    try:
+        query = parse_search(message.text or "")
+    except ValueError as e:
+        await message.answer(f"❌ {escape(e)}")
+        return
+    await state.update_data(search=query)
+    rows, next_cursor = await core.commands.search(**query)
+    msg, kb = render_search(rows, next_cursor)
+    await message.answer(msg, reply_markup=kb)
+
+@router.callback_query(F.data.startswith("search_next_"))
+async def search_next(call: types.CallbackQuery, state: FSMContext):
+    query = (await state.get_data()).get("search", {})
+    cursor = int(call.data.rsplit("_", 1)[1])
+    rows, next_cursor = await core.commands.search(cursor=cursor, **query)
+    msg, kb = render_search(rows, next_cursor)
+    await call.message.edit_text(msg, reply_markup=kb)
+    await call.answer()
+
+def render_history(rows, newer, older):
+    if not rows:
+        return "📜 History empty.", None
+    msg = "📜 <b>Access Attempts:</b>\n"
+    for r in rows:
+        ts = time.strftime('%m-%d %H:%M', time.localtime(r[5]))
+        icon = "✅" if r[4] == "ALLOWED" else "⛔"
+        srv = escape(core.servers.name(r[1]) or "?")
+        where = geoip.label(history.geo(r), org=False)
+        where = f" {where}" if where else ""
+        if history.is_rollup(r):
+            # Hourly rollup past raw retention: one line per hour and outcome.
+            msg += f"{icon} <b>{srv}</b> | {escape(r[3])}@{escape(r[2])}{where} ({ts}h) ×{r[6]}\n"
+        else:
+            msg += f"{icon} <b>{srv}</b> | {escape(r[3])}@{escape(r[2])}{where} ({ts})\n"
+    buttons = []
+    if newer:
+        buttons.append(InlineKeyboardButton(text="◀️ Newer", callback_data=f"hist_newer_{newer}"))
+    if older:
+        buttons.append(InlineKeyboardButton(text="Older ▶️", callback_data=f"hist_older_{older}"))
+    kb = InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+    return msg, kb
+
+@router.callback_query(F.data == "menu_history")
+async def show_history(call: types.CallbackQuery, state: FSMContext):
+    await state.update_data(history={})
+    rows, newer, older = await history.page(core.db)
+    msg, kb = render_history(rows, newer, older)
+    await call.message.edit_text(msg, reply_markup=kb)
+
+@router.message(Command("history"))
+async def cmd_history(message: types.Message, state: FSMContext):
+    # "/history [server:id] [ip:x] [user:x] [status:blocked] [since:1d]"
+    if message.from_user.id != core.ADMIN_ID:
+        return
+    try:
+        filters, _ = parse_filters(message.text or "", ("server", "ip", "user", "status", "since"))
+    except ValueError as e:
+        await message.answer(f"❌ {escape(e)}")
+        return
+    await state.update_data(history=filters)
+    rows, newer, older = await history.page(core.db, filters)
+    msg, kb = render_history(rows, newer, older)
+    await message.answer(msg, reply_markup=kb)
+
+@router.callback_query(F.data.startswith("hist_"))
+async def history_page(call: types.CallbackQuery, state: FSMContext):
+    _, direction, cursor = call.data.split("_", 2)
+    filters = (await state.get_data()).get("history", {})
+    rows, newer, older = await history.page(core.db, filters, cursor, direction)
+    msg, kb = render_history(rows, newer, older)
+    await call.message.edit_text(msg, reply_markup=kb)
+    await call.answer()
+
+@router.callback_query(F.data == "menu_whitelist")
+async def show_whitelist(call: types.CallbackQuery):
+    now = int(time.time())
+    rows = core.allowlist.active(now)
+    msg = "🔐 <b>Whitelisted IPs:</b>\n"
+    if not rows: msg += "None."
+    for r in rows:
+        left = int((r[1] - now) / 60)
+        msg += f"🌐 <code>{r[0]}</code> ({left}m)\n"
+    await call.message.edit_text(msg, reply_markup=None)
+
+@router.callback_query(F.data.startswith("allow_"))
+async def process_callback_allow(call: types.CallbackQuery):
+    try:
+        entry = await core.approve_ip(call.data.split("_", 1)[1])
+    except ValueError as e:
+        await call.answer(str(e)[:200], show_alert=True)
+        return
+    try:
+        await call.message.edit_text(f"✅ <b>Access Granted</b>\n🌐 {escape(entry)} (1h)")
+    except: pass
+
+@router.message(Command("allow"))
+async def cmd_allow(message: types.Message):
+    # "/allow <ip|cidr> [ttl]", e.g. "/allow 10.20.0.0/16 12h"; ttl defaults to 1h.
+    if message.from_user.id != core.ADMIN_ID:
+        return
+    parts = (message.text or "").split()
+    try:
+        if len(parts) not in (2, 3):
+            raise ValueError("Usage: /allow <ip|cidr> [ttl]")
+        ttl = audit.parse_age(parts[2]) if len(parts) == 3 else 3600
+        entry = await core.approve_ip(parts[1], ttl / 3600)
+    except ValueError as e:
+        await message.answer(f"❌ {escape(e)}")
+        return
+    await message.answer(f"✅ <b>Access Granted</b>\n🌐 <code>{escape(entry)}</code> ({escape(parts[2]) if len(parts) == 3 else '1h'})")
+
+# --- Fleet Operations ---
+# Pooled SSH to every host deployed from this controller (core.pool).
+def render_failures(results, limit=10):
+    failed = [(ip, r[1]) for ip, r in results.items() if not r[0]]
+    msg = ""
+    for ip, error in failed[:limit]:
+        msg += f"\n❌ <code>{escape(ip)}</code>: {escape(str(error)[:100])}"
+    if len(failed) > limit:
+        msg += f"\n… and {len(failed) - limit} more"
+    return msg
+
+def render_fleet_status(results, digest, elapsed):
+    reachable = {ip: r[1] for ip, r in results.items() if r[0]}
+    down = sorted(ip for ip, s in reachable.items() if s.get("agentd") != "up")
+    outdated = sorted(ip for ip, s in reachable.items() if s.get("bundle") != digest)
+    sessions = sum(int(s.get("sessions") or 0) for s in reachable.values())
+    msg = (f"🩺 <b>Fleet Status</b> ({elapsed:.1f}s)\n"
+           f"🖥 {len(reachable)}/{len(results)} reachable | 👥 {sessions} SSH sessions\n"
+           f"🟢 agentd up: {len(reachable) - len(down)} | 🔴 down: {len(down)}\n"
+           f"📦 outdated bundle: {len(outdated)}")
+    if down:
+        msg += "\n🔴 " + ", ".join(f"<code>{escape(ip)}</code>" for ip in down[:15])
+    if outdated:
+        msg += "\n📦 " + ", ".join(f"<code>{escape(ip)}</code>" for ip in outdated[:15])
+    return msg + render_failures(results)
+
+@router.callback_query(F.data == "fleet_status")
+async def show_fleet_status(call: types.CallbackQuery):
+    hosts = list(core.pool.hosts)
+    if not hosts:
+        await call.answer("No deployed hosts yet", show_alert=True)
+        return
+    await call.answer()
+    status_msg = await call.message.answer(f"⏳ Checking {len(hosts)} hosts...")
+    try:
+        digest = fleet.build_bundle().digest
+    except FileNotFoundError:
+        digest = None
+    started = time.monotonic()
+    results = await fleet.collect_status(core.pool, hosts)
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔄 Push Config", callback_data="fleet_push")]
+    ])
+    await status_msg.edit_text(render_fleet_status(results, digest, time.monotonic() - started), reply_markup=kb)
+
+@router.callback_query(F.data == "fleet_push")
+async def fleet_push(call: types.CallbackQuery):
+    # Rewrites agent.env and the sync key from the controller's current
+    # settings and restarts sg-agentd, e.g. after PUBLIC_IP changed.
+    hosts = list(core.pool.hosts)
+    await call.answer()
+    status_msg = await call.message.answer(f"⏳ Pushing config to {len(hosts)} hosts...")
+    started = time.monotonic()
+    results = await fleet.push_config(core.pool, hosts, core.agent_env)
+    done = sum(1 for r in results.values() if r[0])
+    await status_msg.edit_text(f"🔄 <b>Config pushed</b> to {done}/{len(hosts)} hosts "
+                               f"({time.monotonic() - started:.1f}s)" + render_failures(results))
+
+def render_fleet_health(tracker, server_ids, digest, limit=15):
+    # From heartbeats alone: no SSH, so it answers instantly at any fleet size.
+    now = time.time()
+    online, offline = tracker.counts()
+    unknown = sum(1 for s in server_ids if s not in tracker.last_seen)
+    outdated = [s for s, info in tracker.info.items()
+                if digest and info and info.get("bundle") not in ("", None, digest) and s not in tracker.offline]
+    msg = (f"💓 <b>Agent Health</b>\n"
+           f"🟢 online: {online} | 🔴 offline: {offline} | ❔ no heartbeat yet: {unknown}\n"
+           f"📦 outdated bundle: {len(outdated)}\n"
+           f"<i>Offline after {heartbeat.format_age(tracker.timeout)} of silence</i>")
+    silent = sorted(tracker.offline.items(), key=lambda item: item[1])
+    for server_id, last_seen in silent[:limit]:
+        msg += f"\n🔴 {core.server_label(server_id)}, last seen {heartbeat.format_age(now - last_seen)} ago"
+    if len(silent) > limit:
+        msg += f"\n… and {len(silent) - limit} more"
+    if outdated:
+        msg += "\n📦 " + ", ".join(core.server_label(s) for s in outdated[:limit])
+    return msg
+
+@router.callback_query(F.data == "fleet_health")
+async def show_fleet_health(call: types.CallbackQuery):
+    await call.answer()
+    try:
+        digest = fleet.build_bundle().digest
+    except FileNotFoundError:
+        digest = None
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🔄 Refresh", callback_data="fleet_health")],
+        [InlineKeyboardButton(text="🩺 Fleet Status", callback_data="fleet_status")]
+    ])
+    await call.message.answer(render_fleet_health(core.heartbeats, core.servers.names, digest), reply_markup=kb)
+
+async def kill_everywhere(target, status_msg):
+    hosts = list(core.pool.hosts)
+    started = time.monotonic()
+    results = await fleet.kill_sessions(core.pool, hosts, target)
+    killed = sum(r[1] for r in results.values() if r[0])
+    reached = sum(1 for r in results.values() if r[0])
+    await status_msg.edit_text(f"🔪 <b>{killed}</b> sessions from <code>{escape(target)}</code> killed "
+                               f"on {reached}/{len(hosts)} hosts ({time.monotonic() - started:.1f}s)"
+                               + render_failures(results))
+
+@router.message(Command("kill"))
+async def cmd_kill(message: types.Message):
+    # "/kill <ip|cidr>": end open SSH/SFTP sessions from it on every host.
+    if message.from_user.id != core.ADMIN_ID:
+        return
+    parts = (message.text or "").split()
+    try:
+        if len(parts) != 2:
+            raise ValueError("Usage: /kill <ip|cidr>")
+        target = normalize(parts[1])
+    except ValueError as e:
+        await message.answer(f"❌ {escape(e)}")
+        return
+    status_msg = await message.answer(f"⏳ Killing sessions from <code>{escape(target)}</code>...")
+    await kill_everywhere(target, status_msg)
+
+@router.message(Command("revoke"))
+async def cmd_revoke(message: types.Message):
+    # "/revoke <ip|cidr>": drop the allowlist entry and kill its open sessions.
+    if message.from_user.id != core.ADMIN_ID:
+        return
+    parts = (message.text or "").split()
+    try:
+        if len(parts) != 2:
+            raise ValueError("Usage: /revoke <ip|cidr>")
+        entry = await core.revoke_ip(parts[1])
+    except ValueError as e:
+        await message.answer(f"❌ {escape(e)}")
+        return
+    if entry is None:
+        covering = core.allowlist.match(parts[1])
+        hint = f" It is covered by <code>{escape(covering[0])}</code>." if covering else ""
+        await message.answer(f"❌ <code>{escape(parts[1])}</code> is not on the allowlist.{hint}")
+        return
+    status_msg = await message.answer(f"🚫 <b>Revoked</b> <code>{escape(entry)}</code>, killing its sessions...")
+    await kill_everywhere(entry, status_msg)
+
+@router.message(Command("unpin"))
+async def cmd_unpin(message: types.Message):
+    # "/unpin <ip>": forget a fleet host's pinned SSH host key after a reinstall.
+    if message.from_user.id != core.ADMIN_ID:
+        return
+    parts = (message.text or "").split()
+    if len(parts) != 2:
+        await message.answer("❌ Usage: /unpin <ip>")
+        return
+    if not await core.pool.unpin(parts[1]):
+        await message.answer(f"❌ <code>{escape(parts[1])}</code> was never deployed from this controller.")
+        return
+    await message.answer(f"🔓 Host key of <code>{escape(parts[1])}</code> forgotten; "
+                         "the next connection pins the key it presents.")
+
+# --- Diagnostics ---
+@router.message(Command("profile"))
+async def cmd_profile(message: types.Message):
+    # "/profile [seconds]": sample this process and send collapsed stacks.
+    if message.from_user.id != core.ADMIN_ID:
+        return
+    parts = (message.text or "").split()
+    try:
+        if len(parts) > 2:
+            raise ValueError("Usage: /profile [seconds]")
+        seconds = float(parts[1]) if len(parts) == 2 else 10
+        if not 0 < seconds <= profiler.PROFILE_MAX_SECONDS:
+            raise ValueError(f"Seconds must be between 0 and {profiler.PROFILE_MAX_SECONDS:g}")
+    except ValueError as e:
+        await message.answer(f"❌ {escape(e)}")
+        return
+    status_msg = await message.answer(f"⏳ Profiling for {seconds:g}s...")
+    try:
+        profile = await core.sampler.profile(seconds, threads=True)
+    except RuntimeError as e:
+        await status_msg.edit_text(f"❌ {escape(e)}")
+        return
+    document = BufferedInputFile(profile.collapsed().encode(), filename=f"serverguard-{int(time.time())}.folded")
+    stalls = core.watchdog.stats["stalls"]
+    await status_msg.delete()
+    await message.answer_document(
+        document,
+        caption=f"🔥 <b>Profile</b> (loop time per coroutine)\n<pre>{escape(profiler.render_summary(profile, limit=12))}</pre>\n"
+                f"🐢 Loop stalls since start: {stalls}, longest {core.watchdog.longest:.2f}s"
+    )
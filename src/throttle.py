@@ -0,0 +1,148 @@
+import os
+import time
+import logging
+from array import array
+from collections import OrderedDict
+
+logger = logging.getLogger("ServerGuard.throttle")
+
+# --- Configuration ---
+# BLOCKED attempts are counted per source IP and per (IP, server) over a
+# sliding window. Crossing either threshold marks the IP hostile for
+# HOSTILE_TTL seconds: it gets 403 without an alert and only one in
+# HOSTILE_SAMPLE attempts is written to history.
+WINDOW = float(os.getenv("BRUTE_WINDOW", "60"))
+IP_THRESHOLD = int(os.getenv("BRUTE_IP_THRESHOLD", "30"))
+PAIR_THRESHOLD = int(os.getenv("BRUTE_PAIR_THRESHOLD", "15"))
+HOSTILE_TTL = int(os.getenv("HOSTILE_TTL", "3600"))
+HOSTILE_SAMPLE = int(os.getenv("HOSTILE_SAMPLE", "100"))
+HOSTILE_MAX = int(os.getenv("HOSTILE_MAX", "100000"))
+# 4 x 16384 uint32 counters per window: 256KB per sketch, 1MB in total.
+SKETCH_WIDTH = int(os.getenv("BRUTE_SKETCH_WIDTH", "16384"))
+SKETCH_DEPTH = 4
+
+
+class DecayingSketch:
+    # Count-min sketch over a sliding window, approximated by two fixed
+    # windows: estimate = current + previous * (1 - elapsed / window).
+    # Memory is fixed at 2 * width * depth counters whatever the key count.
+    def __init__(self, width=SKETCH_WIDTH, depth=SKETCH_DEPTH, window=WINDOW):
+        self.width = width
+        self.depth = depth
+        self.window = window
+        self.current = self._empty()
+        self.previous = self._empty()
+        self.totals = [0, 0]
+        self.started = None
+
+    def _empty(self):
+        return array("I", bytes(4 * self.width * self.depth))
+
+    def _rotate(self, now):
+        if self.started is None:
+            self.started = now
+        elapsed = now - self.started
+        if elapsed < self.window:
+            return elapsed
+        if elapsed < 2 * self.window:
+            self.previous, self.totals = self.current, [self.totals[1], 0]
+            self.started += self.window
+        else:
+            self.previous, self.totals = self._empty(), [0, 0]
+            self.started = now
+        self.current = self._empty()
+        return now - self.started
+
+    def _slots(self, key):
+        # Double hashing: row i uses h1 + i * h2, one hash() per key.
+        h = hash(key)
+        h1, h2 = h & 0xFFFFFFFF, ((h >> 32) & 0xFFFFFFFF) | 1
+        width = self.width
+        return [row * width + (h1 + row * h2) % width for row in range(self.depth)]
+
+    def _estimate(self, counters, slots, total):
+        # Count-mean-min: every counter also holds ~(total - c) / (width - 1)
+        # from colliding keys. Subtracting that noise floor keeps estimates
+        # near the truth even when a scan spreads millions of keys over
+        # the sketch, where plain min() would drift past the thresholds.
+        values = sorted(counters[s] for s in slots)
+        middle = len(values) // 2
+        c = (values[middle - 1] + values[middle]) / 2 if len(values) % 2 == 0 else values[middle]
+        return max(0.0, min(values[0], c - (total - c) / (self.width - 1)))
+
+    def add(self, key, now=None):
+        now = time.monotonic() if now is None else now
+        elapsed = self._rotate(now)
+        slots = self._slots(key)
+        current = self.current
+        for s in slots:
+            current[s] += 1
+        self.totals[1] += 1
+        estimate = self._estimate(current, slots, self.totals[1])
+        if self.totals[0]:
+            weight = 1 - elapsed / self.window
+            estimate += self._estimate(self.previous, slots, self.totals[0]) * weight
+        return estimate
+
+
+class BruteForceGuard:
+    def __init__(self, window=WINDOW, ip_threshold=IP_THRESHOLD, pair_threshold=PAIR_THRESHOLD,
+                 ttl=HOSTILE_TTL, sample=HOSTILE_SAMPLE, max_hostile=HOSTILE_MAX, width=SKETCH_WIDTH):
+        self.ip_counts = DecayingSketch(width, window=window)
+        self.pair_counts = DecayingSketch(width, window=window)
+        self.ip_threshold = ip_threshold
+        self.pair_threshold = pair_threshold
+        self.ttl = ttl
+        self.sample = max(1, sample)
+        self.max_hostile = max_hostile
+        # ip -> [expiry, attempts since marked]; insertion order is expiry
+        # order, so pruning only ever looks at the head.
+        self.hostile = OrderedDict()
+        self.stats = {"observed": 0, "hostile_marked": 0, "suppressed": 0, "sampled": 0, "evicted": 0}
+
+    def _prune(self, now):
+        while self.hostile:
+            ip, entry = next(iter(self.hostile.items()))
+            if entry[0] > now:
+                break
+            del self.hostile[ip]
+
+    def is_hostile(self, ip, now=None):
+        entry = self.hostile.get(ip)
+        return entry is not None and entry[0] > (now or time.time())
+
+    def mark(self, ip, expiry):
+        # Returns False if ip was already hostile (e.g. marked by another worker).
+        now = time.time()
+        self._prune(now)
+        if self.is_hostile(ip, now):
+            return False
+        self.hostile.pop(ip, None)
+        self.hostile[ip] = [expiry, 0]
+        while len(self.hostile) > self.max_hostile:
+            self.hostile.popitem(last=False)
+            self.stats["evicted"] += 1
+        self.stats["hostile_marked"] += 1
+        return True
+
+    def observe(self, ip, server_id):
+        # Counts one BLOCKED attempt. Returns (ip_count, pair_count) when it
+        # pushes ip over a threshold, else None.
+        self.stats["observed"] += 1
+        now = time.monotonic()
+        ip_count = self.ip_counts.add(ip, now)
+        pair_count = self.pair_counts.add((ip, server_id), now)
+        if ip_count >= self.ip_threshold or pair_count >= self.pair_threshold:
+            return int(ip_count), int(pair_count)
+        return None
+
+    def suppress(self, ip):
+        # Called per attempt from a hostile ip; True when this one should
+        # still be written to history (1 in `sample`).
+        entry = self.hostile[ip]
+        entry[1] += 1
+        self.stats["suppressed"] += 1
+        if entry[1] % self.sample == 1 or self.sample == 1:
+            self.stats["sampled"] += 1
+            return True
+        return False
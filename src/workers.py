@@ -0,0 +1,232 @@
+import os
+import sys
+import json
+import fcntl
+import asyncio
+import logging
+
+logger = logging.getLogger("ServerGuard.workers")
+
+# --- Configuration ---
+# WORKERS > 1 runs one leader plus WORKERS-1 follower processes sharing the
+# HTTP and UDP ports through SO_REUSEPORT. Only the leader polls Telegram and
+# sends messages; followers forward alerts to it over a local unix socket and
+# receive allowlist/server changes back as broadcasts.
+WORKERS = int(os.getenv("CONTROLLER_WORKERS", "1"))
+WORKER_INDEX = int(os.getenv("SG_WORKER_INDEX", "0"))
+IPC_SOCKET = os.getenv("IPC_SOCKET", f"/tmp/serverguard-{os.getenv('HTTP_PORT', '8080')}.sock")
+RESTART_DELAY = 1
+CONNECT_TIMEOUT = 30
+# Unsent bytes a peer may hold before it counts as stuck. broadcast() and
+# send() never wait, so without a cap a stalled peer grows the buffer forever.
+MAX_BUFFER = int(os.getenv("IPC_MAX_BUFFER", str(4 * 1024 * 1024)))
+
+
+def is_leader():
+    return WORKER_INDEX == 0
+
+
+def acquire_leadership(path=IPC_SOCKET):
+    # flock makes the election exclusive even if a second controller is
+    # started by mistake against the same socket path.
+    handle = open(path + ".lock", "w")
+    try:
+        fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        handle.close()
+        raise RuntimeError(f"Another controller already leads {path}")
+    return handle
+
+
+def encode(message):
+    return (json.dumps(message, separators=(",", ":")) + "\n").encode()
+
+
+class IPCServer:
+    # Leader side: accepts followers, hands their messages to on_message and
+    # broadcasts state changes to all of them.
+    def __init__(self, on_message, path=IPC_SOCKET):
+        self.path = path
+        self.on_message = on_message
+        self.peers = set()
+        self.server = None
+        self.stats = {"received": 0, "broadcast": 0, "peers_lost": 0, "peers_dropped": 0}
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(self._serve, path=self.path)
+        os.chmod(self.path, 0o600)
+
+    async def _serve(self, reader, writer):
+        self.peers.add(writer)
+        try:
+            while line := await reader.readline():
+                self.stats["received"] += 1
+                try:
+                    await self.on_message(json.loads(line))
+                except Exception as e:
+                    logger.error(f"IPC message failed: {e}")
+        finally:
+            self.peers.discard(writer)
+            self.stats["peers_lost"] += 1
+            writer.close()
+
+    def broadcast(self, message):
+        data = encode(message)
+        self.stats["broadcast"] += 1
+        for writer in list(self.peers):
+            if writer.is_closing():
+                self.peers.discard(writer)
+                continue
+            if writer.transport.get_write_buffer_size() > MAX_BUFFER:
+                # A follower this far behind has missed state it cannot catch
+                # up on; dropping it makes it exit and the supervisor starts a
+                # fresh one that loads current state.
+                logger.warning(f"Disconnecting IPC follower with {MAX_BUFFER // 1024} KiB+ unread")
+                self.peers.discard(writer)
+                self.stats["peers_dropped"] += 1
+                writer.transport.abort()
+                continue
+            writer.write(data)
+
+    async def stop(self):
+        if self.server is None:
+            return
+        self.server.close()
+        for writer in list(self.peers):
+            writer.close()
+        await self.server.wait_closed()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class IPCClient:
+    # Follower side: one connection to the leader. Losing it means the leader
+    # is gone, so on_lost is expected to shut the follower down.
+    def __init__(self, on_message, on_lost, path=IPC_SOCKET):
+        self.path = path
+        self.on_message = on_message
+        self.on_lost = on_lost
+        self.writer = None
+        self.task = None
+        self.stats = {"sent": 0, "received": 0, "dropped": 0}
+
+    async def connect(self, timeout=CONNECT_TIMEOUT):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            try:
+                reader, self.writer = await asyncio.open_unix_connection(self.path)
+                break
+            except OSError:
+                if loop.time() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+        self.task = asyncio.create_task(self._listen(reader))
+
+    async def _listen(self, reader):
+        try:
+            while line := await reader.readline():
+                self.stats["received"] += 1
+                try:
+                    await self.on_message(json.loads(line))
+                except Exception as e:
+                    logger.error(f"IPC message failed: {e}")
+        finally:
+            self.on_lost()
+
+    def send(self, message):
+        if self.writer is None or self.writer.is_closing():
+            logger.error(f"IPC send dropped, leader unreachable: {message.get('op')}")
+            return
+        if self.writer.transport.get_write_buffer_size() > MAX_BUFFER:
+            # The leader is not reading; shed rather than buffer without bound.
+            if not self.stats["dropped"]:
+                logger.error("IPC send buffer full, leader is not reading; dropping messages")
+            self.stats["dropped"] += 1
+            return
+        self.writer.write(encode(message))
+        self.stats["sent"] += 1
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+
+class RemoteDispatcher:
+    # Stand-in for TelegramDispatcher in followers: same call surface, but
+    # every message is forwarded to the leader's dispatcher.
+    def __init__(self, client):
+        self.client = client
+        self.heap = ()
+        self.stats = {"forwarded": 0}
+
+    def _forward(self, message):
+        self.stats["forwarded"] += 1
+        self.client.send(message)
+
+    def send(self, text, reply_markup=None, priority=None):
+        self._forward({"op": "send", "text": text, "markup": dump_markup(reply_markup), "priority": priority})
+
+    def alert(self, key, text, reply_markup=None, ip=None):
+        self._forward({"op": "alert", "key": list(key), "text": text, "markup": dump_markup(reply_markup), "ip": ip})
+
+    def cmd_log(self, key, header, line, ip=None):
+        self._forward({"op": "cmd", "key": list(key), "header": header, "line": line, "ip": ip})
+
+    def start(self):
+        pass
+
+    async def stop(self, timeout=None):
+        pass
+
+
+def dump_markup(markup):
+    # Markup is normally already a plain Bot API dict; aiogram models are dumped.
+    if markup is None or isinstance(markup, dict):
+        return markup
+    return markup.model_dump(exclude_none=True)
+
+
+class Supervisor:
+    # Leader side: keeps WORKERS-1 follower processes running.
+    def __init__(self, count, script, cwd):
+        self.count = count
+        self.script = script
+        self.cwd = cwd
+        self.procs = {}
+        self.tasks = []
+        self.stopping = False
+
+    async def _run(self, index):
+        env = dict(os.environ, SG_WORKER_INDEX=str(index), IPC_SOCKET=IPC_SOCKET)
+        while not self.stopping:
+            proc = await asyncio.create_subprocess_exec(sys.executable, self.script, cwd=self.cwd, env=env)
+            self.procs[index] = proc
+            logger.info(f"Worker {index} started (pid {proc.pid})")
+            code = await proc.wait()
+            if self.stopping:
+                break
+            logger.error(f"Worker {index} exited with {code}, restarting")
+            await asyncio.sleep(RESTART_DELAY)
+
+    def start(self):
+        for index in range(1, self.count):
+            self.tasks.append(asyncio.create_task(self._run(index)))
+
+    async def stop(self, timeout=10):
+        self.stopping = True
+        for proc in self.procs.values():
+            if proc.returncode is None:
+                proc.terminate()
+        for proc in self.procs.values():
+            try:
+                await asyncio.wait_for(proc.wait(), timeout)
+            except asyncio.TimeoutError:
+                proc.kill()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)